@@ -0,0 +1,19 @@
+"""
+Rebuild the daily sales rollups (sales_daily) from completed orders.
+
+Run once after upgrading, or whenever the rollups need to be re-derived:
+    cd /app/backend && python backfill_sales_rollups.py
+"""
+import asyncio
+
+from server import rebuild_sales_rollups, client
+
+
+async def main():
+    rows = await rebuild_sales_rollups()
+    print(f"Sales rollups rebuilt: {rows} rows")
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+"""
+Rebuild the running per-account debit/credit totals (account_totals) from posted journal entries.
+
+Run once after upgrading, or whenever balances need to be checked against the journal:
+    cd /app/backend && python rebuild_account_totals.py           # verify and correct
+    cd /app/backend && python rebuild_account_totals.py --verify  # report drift only
+"""
+import asyncio
+import sys
+
+from server import rebuild_account_totals, client
+
+
+async def main():
+    fix = "--verify" not in sys.argv[1:]
+    result = await rebuild_account_totals(fix=fix)
+    for m in result['mismatches']:
+        print(f"{m['account_code']}: stored {m['stored_debit']}/{m['stored_credit']}, "
+              f"journal {m['expected_debit']}/{m['expected_credit']}")
+    action = "corrected" if result['fixed'] else "found"
+    print(f"Checked {result['accounts']} accounts, {len(result['mismatches'])} mismatches {action}")
+    client.close()
+    if result['mismatches'] and not fix:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
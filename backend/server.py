@@ -1,17 +1,29 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query, UploadFile, File, Form, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
+import io
+import csv
+import re
+import asyncio
 import logging
+import time
+import hashlib
+import random
+from collections import OrderedDict
 from pathlib import Path
 import aiofiles
 import shutil
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
 from typing import List, Optional, Literal
 import uuid
+import numpy as np
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
@@ -24,6 +36,60 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Multi-document transactions need a replica set (see DEPLOYMENT.md).
+# Set MONGO_TRANSACTIONS=false only for a standalone mongod; postings are then not atomic.
+USE_TRANSACTIONS = os.environ.get('MONGO_TRANSACTIONS', 'true').lower() == 'true'
+
+async def run_in_transaction(callback):
+    """Run callback(session) in one transaction; with_transaction retries TransientTransactionError"""
+    if not USE_TRANSACTIONS:
+        return await callback(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(callback)
+
+async def run_at_snapshot(callback):
+    """Run read-only callback(session) with every read at one point in time (snapshot read concern).
+    
+    Unlike a transaction this is not cut off by transactionLifetimeLimitSeconds, only by the server's
+    snapshot history window (minSnapshotHistoryWindowInSeconds, 300 s by default); needs MongoDB 5.0+.
+    """
+    if not USE_TRANSACTIONS:
+        return await callback(None)
+    async with await client.start_session(snapshot=True) as session:
+        return await callback(session)
+
+class LRUCache:
+    """Small per-process LRU cache; entries optionally expire after ttl seconds"""
+    
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+    
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.data[key] = (value, expires)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+    
+    def delete(self, key):
+        self.data.pop(key, None)
+    
+    def clear(self):
+        self.data.clear()
+
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'otnt-erp-secret-key-2024')
 JWT_ALGORITHM = 'HS256'
@@ -119,6 +185,7 @@ class BrandResponse(BaseModel):
 
 # Product Models
 ProductType = Literal['robot', 'goods', 'accessory', 'part', 'service']
+CostingMethod = Literal['average', 'fifo']
 
 class ProductCreate(BaseModel):
     name: str
@@ -134,6 +201,8 @@ class ProductCreate(BaseModel):
     sale_price: Optional[float] = None
     warranty_months: int = 0
     track_serial: bool = False
+    costing_method: CostingMethod = 'average'
+    barcode: Optional[str] = None
     images: List[str] = []
     specifications: dict = {}
     compatible_models: List[str] = []
@@ -157,6 +226,8 @@ class ProductResponse(BaseModel):
     sale_price: Optional[float] = None
     warranty_months: int = 0
     track_serial: bool = False
+    costing_method: str = 'average'
+    barcode: Optional[str] = None
     images: List[str] = []
     specifications: dict = {}
     compatible_models: List[str] = []
@@ -179,6 +250,8 @@ class ProductUpdate(BaseModel):
     sale_price: Optional[float] = None
     warranty_months: Optional[int] = None
     track_serial: Optional[bool] = None
+    costing_method: Optional[CostingMethod] = None
+    barcode: Optional[str] = None
     images: Optional[List[str]] = None
     specifications: Optional[dict] = None
     compatible_models: Optional[List[str]] = None
@@ -210,6 +283,8 @@ class WarehouseCreate(BaseModel):
     phone: Optional[str] = None
     manager_id: Optional[str] = None
     is_default: bool = False
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 class WarehouseResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -221,6 +296,8 @@ class WarehouseResponse(BaseModel):
     manager_id: Optional[str] = None
     manager_name: Optional[str] = None
     is_default: bool = False
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
     is_active: bool = True
     created_at: str
 
@@ -256,6 +333,19 @@ class InventoryDocCreate(BaseModel):
     note: Optional[str] = None
     lines: List[InventoryLineCreate]
 
+class StocktakeCreate(BaseModel):
+    warehouse_id: str
+    category_id: Optional[str] = None  # Limit a cycle count to one category
+    product_ids: List[str] = []        # ...or to specific products
+    note: Optional[str] = None
+
+class StocktakeScan(BaseModel):
+    code: str          # Serial number, IMEI, product barcode or SKU
+    quantity: int = 1  # Ignored for serials; negative to correct a miscount
+
+class StocktakeScanBatch(BaseModel):
+    scans: List[StocktakeScan]
+
 class InventoryDocResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -286,8 +376,22 @@ class StockBalanceResponse(BaseModel):
     warehouse_id: str
     warehouse_name: str
     quantity: int
+    reserved: int = 0
+    available: int = 0
     avg_cost: float = 0
     total_value: float = 0
+    min_qty: Optional[int] = None
+    max_qty: Optional[int] = None
+    reorder_point: Optional[int] = None
+    low_stock: bool = False
+    value_known: bool = True  # False for as_of rows valued across ledger rows that carry no cost
+
+class ReorderRuleUpdate(BaseModel):
+    product_id: str
+    warehouse_id: str
+    min_qty: int = 0
+    max_qty: Optional[int] = None
+    reorder_point: int
 
 # Stock Ledger Entry
 class StockLedgerResponse(BaseModel):
@@ -303,6 +407,7 @@ class StockLedgerResponse(BaseModel):
     quantity_change: int
     quantity_after: int
     unit_cost: float
+    value_change: float = 0
     created_at: str
 
 # ==================== SERIAL/IMEI MODELS ====================
@@ -317,6 +422,14 @@ class SerialItemCreate(BaseModel):
     cost_price: float = 0
     note: Optional[str] = None
 
+class SerialBulkCreate(BaseModel):
+    product_id: str
+    warehouse_id: str
+    serial_numbers: List[str] = []
+    serial_range: Optional[str] = None  # e.g. DX50-2026-0001..0800
+    cost_price: float = 0
+    note: Optional[str] = None
+
 class SerialItemResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -425,6 +538,7 @@ class SalesOrderResponse(BaseModel):
     created_by: Optional[str] = None
     created_by_name: Optional[str] = None
     confirmed_at: Optional[str] = None
+    reserved_until: Optional[str] = None
     completed_at: Optional[str] = None
     created_at: str
 
@@ -921,6 +1035,8 @@ async def create_product(data: ProductCreate, user: dict = Depends(require_admin
     existing = await db.products.find_one({"$or": [{"slug": data.slug}, {"sku": data.sku}]})
     if existing:
         raise HTTPException(status_code=400, detail="Product slug or SKU already exists")
+    if data.barcode and await db.products.find_one({"barcode": data.barcode}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=400, detail="Product barcode already exists")
     
     # Auto-enable serial tracking for robots
     track_serial = data.track_serial or data.product_type == 'robot'
@@ -945,15 +1061,33 @@ async def create_product(data: ProductCreate, user: dict = Depends(require_admin
 async def update_product(product_id: str, data: ProductUpdate, user: dict = Depends(require_admin)):
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    if data.barcode and await db.products.find_one(
+        {"barcode": data.barcode, "id": {"$ne": product_id}}, {"_id": 0, "id": 1}
+    ):
+        raise HTTPException(status_code=400, detail="Product barcode already exists")
+    
+    # An explicit empty barcode clears it (None means "leave unchanged")
+    update = {"$set": update_data}
+    if data.barcode is not None and not data.barcode.strip():
+        del update_data['barcode']
+        update["$unset"] = {"barcode": ""}
     
     result = await db.products.find_one_and_update(
         {"id": product_id},
-        {"$set": update_data},
-        return_document=True
+        update,
+        return_document=False
     )
     if not result:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    # Switching costing method: FIFO layers are rebuilt from the current balance on the next movement
+    if data.costing_method and data.costing_method != result.get('costing_method', 'average'):
+        await db.cost_layers.delete_many({"product_id": product_id})
+    result.update(update_data)
+    if "$unset" in update:
+        result.pop('barcode', None)
+    scan_cache.delete(('product', product_id))
+    
     return ProductResponse(**{k: v for k, v in result.items() if k != '_id'})
 
 @api_router.delete("/admin/products/{product_id}")
@@ -961,6 +1095,7 @@ async def delete_product(product_id: str, user: dict = Depends(require_admin)):
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    scan_cache.delete(('product', product_id))
     return {"message": "Product deleted"}
 
 # ==================== STORE ROUTES (PUBLIC) ====================
@@ -1054,8 +1189,8 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
     type_counts = await db.products.aggregate(pipeline).to_list(10)
     products_by_type = {t['_id']: t['count'] for t in type_counts if t['_id']}
     
-    # Low stock count (less than 5)
-    low_stock_count = await db.products.count_documents({"stock_quantity": {"$lt": 5}, "product_type": {"$ne": "service"}})
+    # Low stock count: (product, warehouse) balances at or below their own reorder rule
+    low_stock_count = await db.stock_balance.count_documents({"low_stock": True})
     
     # Total stock value
     stock_pipeline = [
@@ -1153,6 +1288,75 @@ async def delete_warehouse(warehouse_id: str, user: dict = Depends(require_admin
         raise HTTPException(status_code=404, detail="Warehouse not found")
     return {"message": "Warehouse deleted"}
 
+# ==================== DOCUMENT NUMBERING ====================
+
+# Numbers reserved per counter round trip. Above 1, each worker takes a block of numbers
+# (unique but not strictly increasing across workers) so the daily counter stops being hot.
+SEQUENCE_BLOCK_SIZE = max(1, int(os.environ.get('SEQUENCE_BLOCK_SIZE', '1')))
+sequence_blocks = {}
+sequence_lock = asyncio.Lock()
+seeded_sequences = set()
+
+# Where each prefix's numbers are stored, to seed a counter from numbers issued before it existed
+SEQUENCE_SOURCES = {
+    **{prefix: ("inventory_docs", "doc_number") for prefix in ('PN', 'PX', 'PC', 'PD', 'PT', 'PK')},
+    **{prefix: ("journal_entries", "entry_number") for prefix in ('JV', 'INV', 'SL', 'PU', 'ADJ')},
+    'SO': ("sales_orders", "order_number"),
+    'REP': ("repair_tickets", "ticket_number"),
+    'KK': ("stocktakes", "stocktake_number"),
+}
+
+async def seed_sequence(prefix: str, key: str):
+    """Raise the (prefix, day) counter to the highest number already stored for that day.
+    
+    Numbers issued by the old count-based numbering (or by a lost counter) would otherwise be handed
+    out again and fail on the unique index. $max only ever raises the counter, so racing seeds are safe.
+    """
+    if key in seeded_sequences:
+        return
+    source = SEQUENCE_SOURCES.get(prefix)
+    if source:
+        collection, field = source
+        highest = 0
+        # Anchored prefix regex: an index range over that day's numbers only
+        async for doc in db[collection].find({field: {"$regex": f"^{re.escape(key)}-"}}, {"_id": 0, field: 1}):
+            suffix = doc[field].rsplit('-', 1)[-1]
+            if suffix.isdigit():
+                highest = max(highest, int(suffix))
+        if highest:
+            await db.counters.update_one({"_id": key}, {"$max": {"seq": highest}}, upsert=True)
+    seeded_sequences.difference_update([k for k in seeded_sequences if k.startswith(f"{prefix}-")])
+    seeded_sequences.add(key)
+
+async def next_sequence(prefix: str) -> str:
+    """Next number like PN-20240206-001 from an atomic per-(prefix, day) counter.
+    
+    Counters are bumped outside posting transactions so they never cause write
+    conflicts; a rolled-back posting leaves a gap in the sequence.
+    """
+    key = f"{prefix}-{datetime.now(timezone.utc).strftime('%Y%m%d')}"
+    await seed_sequence(prefix, key)
+    
+    if SEQUENCE_BLOCK_SIZE == 1:
+        counter = await db.counters.find_one_and_update(
+            {"_id": key}, {"$inc": {"seq": 1}}, upsert=True, return_document=True
+        )
+        return f"{key}-{str(counter['seq']).zfill(3)}"
+    
+    async with sequence_lock:
+        block = sequence_blocks.get(key)
+        if not block or block[0] > block[1]:
+            counter = await db.counters.find_one_and_update(
+                {"_id": key}, {"$inc": {"seq": SEQUENCE_BLOCK_SIZE}}, upsert=True, return_document=True
+            )
+            # Drop exhausted blocks from previous days
+            for old_key in [k for k in sequence_blocks if k.startswith(f"{prefix}-")]:
+                del sequence_blocks[old_key]
+            block = sequence_blocks[key] = [counter['seq'] - SEQUENCE_BLOCK_SIZE + 1, counter['seq']]
+        seq = block[0]
+        block[0] += 1
+    return f"{key}-{str(seq).zfill(3)}"
+
 # ==================== INVENTORY DOCUMENT ROUTES ====================
 
 async def generate_doc_number(doc_type: str) -> str:
@@ -1164,17 +1368,7 @@ async def generate_doc_number(doc_type: str) -> str:
         'adjustment': 'PD', # Phiếu điều chỉnh
         'return': 'PT'    # Phiếu trả
     }
-    prefix = prefix_map.get(doc_type, 'PK')
-    date_str = datetime.now(timezone.utc).strftime('%Y%m%d')
-    
-    # Count today's documents
-    start_of_day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    count = await db.inventory_docs.count_documents({
-        "doc_type": doc_type,
-        "created_at": {"$gte": start_of_day.isoformat()}
-    })
-    
-    return f"{prefix}-{date_str}-{str(count + 1).zfill(3)}"
+    return await next_sequence(prefix_map.get(doc_type, 'PK'))
 
 @api_router.get("/admin/inventory/documents", response_model=List[InventoryDocResponse])
 async def list_inventory_docs(
@@ -1236,6 +1430,19 @@ async def get_inventory_doc(doc_id: str, user: dict = Depends(get_current_user))
 
 @api_router.post("/admin/inventory/documents", response_model=InventoryDocResponse)
 async def create_inventory_doc(data: InventoryDocCreate, user: dict = Depends(get_current_user)):
+    doc = await insert_inventory_doc(data, user)
+    return InventoryDocResponse(**doc)
+
+async def insert_inventory_doc(
+    data: InventoryDocCreate,
+    user: dict,
+    run_id: Optional[str] = None,
+    products: Optional[dict] = None
+) -> dict:
+    """Validate and insert a draft inventory document; run_id tags documents created by a batch run.
+    
+    Batch callers pass the products they already loaded (id -> product) to skip the lookup.
+    """
     # Validate warehouse exists
     warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0})
     if not warehouse:
@@ -1253,16 +1460,21 @@ async def create_inventory_doc(data: InventoryDocCreate, user: dict = Depends(ge
     doc_number = await generate_doc_number(data.doc_type)
     now = datetime.now(timezone.utc).isoformat()
     
-    # Process lines
+    # Process lines; products are checked with one $in query
+    if products is None:
+        product_ids = list({line.product_id for line in data.lines})
+        products = {p['id']: p for p in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1}
+        ).to_list(len(product_ids))}
+    missing = [line.product_id for line in data.lines if line.product_id not in products]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Product {missing[0]} not found")
+    
     lines = []
     total_items = 0
     total_value = 0
     
     for line_data in data.lines:
-        product = await db.products.find_one({"id": line_data.product_id}, {"_id": 0})
-        if not product:
-            raise HTTPException(status_code=400, detail=f"Product {line_data.product_id} not found")
-        
         line_id = str(uuid.uuid4())
         line_total = line_data.quantity * line_data.unit_cost
         
@@ -1296,19 +1508,31 @@ async def create_inventory_doc(data: InventoryDocCreate, user: dict = Depends(ge
         "created_at": now,
         "updated_at": now
     }
+    if run_id:
+        doc['run_id'] = run_id
     
     await db.inventory_docs.insert_one(doc)
     
     # Enrich response
+    doc.pop('_id', None)
     doc['warehouse_name'] = warehouse['name']
     doc['created_by_name'] = user['full_name']
-    
-    return InventoryDocResponse(**{k: v for k, v in doc.items() if k != '_id'})
+    return doc
 
 @api_router.post("/admin/inventory/documents/{doc_id}/post")
-async def post_inventory_doc(doc_id: str, user: dict = Depends(get_current_user)):
-    """Post/confirm the inventory document - updates stock"""
-    doc = await db.inventory_docs.find_one({"id": doc_id}, {"_id": 0})
+async def post_inventory_doc(
+    doc_id: str,
+    run_async: bool = Query(False, alias="async"),
+    user: dict = Depends(get_current_user)
+):
+    """Post/confirm the inventory document - updates stock. With async=true, returns a job id instead."""
+    if run_async:
+        return await submit_job('post_inventory_doc', {"doc_id": doc_id}, user)
+    return await run_in_transaction(lambda session: post_inventory_doc_in_session(doc_id, user, session))
+
+async def post_inventory_doc_in_session(doc_id: str, user: dict, session=None):
+    """Apply a draft inventory document: stock balances, ledger, status and journal"""
+    doc = await db.inventory_docs.find_one({"id": doc_id}, {"_id": 0}, session=session)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
@@ -1316,159 +1540,605 @@ async def post_inventory_doc(doc_id: str, user: dict = Depends(get_current_user)
         raise HTTPException(status_code=400, detail="Document already posted or cancelled")
     
     now = datetime.now(timezone.utc).isoformat()
+    doc_type = doc['doc_type']
+    warehouse_id = doc['warehouse_id']
+    dest_warehouse_id = doc.get('dest_warehouse_id') if doc_type == 'transfer' else None
+    
+    # Phase 1: prefetch every balance the document touches in one query
+    product_ids = list({line['product_id'] for line in doc['lines']})
+    warehouse_ids = [warehouse_id] + ([dest_warehouse_id] if dest_warehouse_id else [])
+    balances = await load_stock_balances(product_ids, warehouse_ids, session)
+    products = {
+        p['id']: p for p in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "sku": 1, "costing_method": 1, "track_serial": 1}, session=session
+        ).to_list(None)
+    }
+    fifo_ids = [pid for pid, p in products.items() if p.get('costing_method') == 'fifo']
+    cost_layers = await load_cost_layers(fifo_ids, warehouse_ids, balances, session)
+    
+    # Issues and transfers must be fully covered; every shortage is reported at once
+    if doc_type in ['issue', 'transfer']:
+        raise_if_unavailable(await check_availability(
+            [{"product_id": line['product_id'], "warehouse_id": warehouse_id, "quantity": line['quantity']}
+             for line in doc['lines']],
+            session, balances
+        ))
+    
+    # A downward adjustment may not leave less on hand than confirmed orders have reserved
+    if doc_type == 'adjustment':
+        problems = []
+        for line in doc['lines']:
+            balance = balances.get((line['product_id'], warehouse_id))
+            reserved = balance.get('reserved', 0) if balance else 0
+            if balance and line['quantity'] < balance['quantity'] and line['quantity'] < reserved:
+                sku = products.get(line['product_id'], {}).get('sku', line['product_id'])
+                problems.append(f"{sku}: adjusting to {line['quantity']} leaves less than the {reserved} reserved for confirmed orders")
+        raise_if_unavailable(problems)
+    
+    # Receipts register the serials listed on their lines (ranges allowed); a listed set must match the quantity
+    serial_items = []
+    if doc_type == 'receipt':
+        problems = []
+        for line in doc['lines']:
+            product = products.get(line['product_id'], {})
+            if not product.get('track_serial'):
+                continue
+            serials = expand_serial_numbers(line.get('serial_numbers') or [])
+            if serials and len(serials) != line['quantity']:
+                problems.append(f"{product.get('sku', line['product_id'])}: {len(serials)} serial numbers for quantity {line['quantity']}")
+            serial_items.extend(
+                {"serial_number": sn, "product_id": line['product_id'], "cost_price": line['unit_cost']} for sn in serials
+            )
+        raise_if_unavailable(problems)
+    
+    # Transfers move the serials listed on their lines; each must be in stock at the source warehouse
+    moved_serials = []
+    if doc_type == 'transfer':
+        problems = []
+        listed = {}
+        for line in doc['lines']:
+            product = products.get(line['product_id'], {})
+            serials = expand_serial_numbers(line.get('serial_numbers') or [])
+            if not product.get('track_serial') or not serials:
+                continue
+            if len(serials) != line['quantity']:
+                problems.append(f"{product.get('sku', line['product_id'])}: {len(serials)} serial numbers for quantity {line['quantity']}")
+            for sn in serials:
+                if sn in listed:
+                    problems.append(f"{sn}: listed more than once")
+                listed[sn] = line['product_id']
+        if listed:
+            found = {
+                s['serial_number']: s async for s in db.serial_items.find(
+                    {"serial_number": {"$in": list(listed)}},
+                    {"_id": 0, "id": 1, "serial_number": 1, "product_id": 1, "warehouse_id": 1, "status": 1},
+                    session=session
+                )
+            }
+            for sn, product_id in listed.items():
+                serial = found.get(sn)
+                if not serial or serial['product_id'] != product_id:
+                    problems.append(f"{sn}: not a serial of this product")
+                elif serial['status'] != 'in_stock' or serial.get('warehouse_id') != warehouse_id:
+                    problems.append(f"{sn}: not in stock in the source warehouse")
+                else:
+                    moved_serials.append(serial['id'])
+        raise_if_unavailable(problems)
+    
+    # Phase 2: compute new quantities and costs in memory, line by line
+    touched = set()
+    ledger_entries = []
+    journal_lines = []
     
-    # Process each line
     for line in doc['lines']:
         product_id = line['product_id']
         quantity = line['quantity']
         unit_cost = line['unit_cost']
-        warehouse_id = doc['warehouse_id']
+        key = (product_id, warehouse_id)
+        current_qty = balances[key]['quantity'] if key in balances else 0
         
         # Determine quantity change based on doc type
-        if doc['doc_type'] in ['receipt', 'return']:
+        if doc_type in ['receipt', 'return']:
             qty_change = quantity  # Increase stock
-        elif doc['doc_type'] in ['issue']:
-            qty_change = -quantity  # Decrease stock
-            # Check available stock
-            balance = await db.stock_balance.find_one({"product_id": product_id, "warehouse_id": warehouse_id}, {"_id": 0})
-            current_qty = balance['quantity'] if balance else 0
-            if current_qty < quantity:
-                product = await db.products.find_one({"id": product_id}, {"_id": 0, "name": 1})
-                raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}: available {current_qty}, requested {quantity}")
-        elif doc['doc_type'] == 'transfer':
-            # For transfers, decrease from source
+        elif doc_type in ['issue', 'transfer']:
+            # Decrease stock (for transfers, from source)
             qty_change = -quantity
-            balance = await db.stock_balance.find_one({"product_id": product_id, "warehouse_id": warehouse_id}, {"_id": 0})
-            current_qty = balance['quantity'] if balance else 0
-            if current_qty < quantity:
-                product = await db.products.find_one({"id": product_id}, {"_id": 0, "name": 1})
-                raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}: available {current_qty}, requested {quantity}")
-        elif doc['doc_type'] == 'adjustment':
+        elif doc_type == 'adjustment':
             # Adjustment can be positive or negative
-            balance = await db.stock_balance.find_one({"product_id": product_id, "warehouse_id": warehouse_id}, {"_id": 0})
-            current_qty = balance['quantity'] if balance else 0
             qty_change = quantity - current_qty  # Set to exact quantity
         else:
             qty_change = quantity
         
-        # Update stock balance for source warehouse
-        await update_stock_balance(product_id, warehouse_id, qty_change, unit_cost)
-        
-        # Create ledger entry
-        ledger_entry = {
-            "id": str(uuid.uuid4()),
-            "product_id": product_id,
-            "warehouse_id": warehouse_id,
-            "doc_id": doc_id,
-            "doc_number": doc['doc_number'],
-            "doc_type": doc['doc_type'],
-            "quantity_change": qty_change,
-            "unit_cost": unit_cost,
-            "created_at": now
-        }
-        
-        # Get new balance for ledger
-        new_balance = await db.stock_balance.find_one({"product_id": product_id, "warehouse_id": warehouse_id}, {"_id": 0})
-        ledger_entry['quantity_after'] = new_balance['quantity'] if new_balance else 0
-        
-        await db.stock_ledger.insert_one(ledger_entry)
+        if product_id in fifo_ids:
+            layer_cost = unit_cost or (balances[key].get('avg_cost', 0) if key in balances else 0)
+            before, after, taken = move_fifo_stock(
+                balances, cost_layers, product_id, warehouse_id, qty_change,
+                new_layer(qty_change, layer_cost, now, doc['doc_number'])
+            )
+            if qty_change < 0:
+                unit_cost = layers_value(taken) / -qty_change
+            if doc_type == 'issue':
+                # Issued value (COGS) comes from the consumed layers, not the line's unit_cost
+                journal_lines.append({**line, "unit_cost": unit_cost, "total_cost": layers_value(taken)})
+            elif doc_type == 'adjustment' and qty_change < 0:
+                # Shortages are written off at the consumed layers' cost, signed as a loss
+                journal_lines.append({**line, "unit_cost": unit_cost, "total_cost": -layers_value(taken)})
+            else:
+                journal_lines.append(line)
+        else:
+            taken = None
+            before, after = move_stock(balances, product_id, warehouse_id, qty_change, unit_cost)
+            journal_lines.append(line)
+        touched.add(key)
+        ledger_entries.append(make_ledger_entry(
+            doc_id, doc['doc_number'], doc_type, qty_change, unit_cost, before, after, now
+        ))
         
         # For transfers, also update destination warehouse
-        if doc['doc_type'] == 'transfer' and doc.get('dest_warehouse_id'):
-            dest_warehouse_id = doc['dest_warehouse_id']
-            await update_stock_balance(product_id, dest_warehouse_id, quantity, unit_cost)
-            
-            # Create ledger entry for destination
-            dest_ledger = {
-                "id": str(uuid.uuid4()),
-                "product_id": product_id,
-                "warehouse_id": dest_warehouse_id,
-                "doc_id": doc_id,
-                "doc_number": doc['doc_number'],
-                "doc_type": doc['doc_type'],
-                "quantity_change": quantity,
-                "unit_cost": unit_cost,
-                "created_at": now
-            }
-            dest_balance = await db.stock_balance.find_one({"product_id": product_id, "warehouse_id": dest_warehouse_id}, {"_id": 0})
-            dest_ledger['quantity_after'] = dest_balance['quantity'] if dest_balance else 0
-            await db.stock_ledger.insert_one(dest_ledger)
-    
-    # Update document status
-    await db.inventory_docs.update_one(
-        {"id": doc_id},
-        {"$set": {"status": "posted", "posted_at": now, "updated_at": now}}
+        if dest_warehouse_id:
+            if taken is not None:
+                # FIFO layers move with the goods, keeping their original cost and age
+                before, after, _ = move_fifo_stock(balances, cost_layers, product_id, dest_warehouse_id, quantity, taken)
+            else:
+                before, after = move_stock(balances, product_id, dest_warehouse_id, quantity, unit_cost)
+            touched.add((product_id, dest_warehouse_id))
+            ledger_entries.append(make_ledger_entry(
+                doc_id, doc['doc_number'], doc_type, quantity, unit_cost, before, after, now
+            ))
+    
+    # Phase 3: one bulk write each for balances and cost layers, one insert for ledger rows
+    await write_stock_balances([balances[key] for key in touched], now, session)
+    await write_cost_layers(cost_layers, now, session)
+    if ledger_entries:
+        await db.stock_ledger.insert_many(ledger_entries, session=session)
+    
+    if serial_items:
+        await register_serials(
+            serial_items, warehouse_id, user['id'], doc_id, doc['doc_number'],
+            f"Nhập kho - {doc['doc_number']}", session
+        )
+    if moved_serials:
+        # Guarded on the checked state; a serial sold or moved meanwhile fails the whole posting
+        result = await db.serial_items.update_many(
+            {"id": {"$in": moved_serials}, "status": "in_stock", "warehouse_id": warehouse_id},
+            {"$set": {"warehouse_id": dest_warehouse_id, "updated_at": now}},
+            session=session
+        )
+        if result.modified_count != len(moved_serials):
+            raise HTTPException(status_code=409, detail="Serials changed while posting, please retry")
+        await db.serial_movements.insert_many([
+            serial_movement_doc(
+                serial_id, "transfer", warehouse_id, dest_warehouse_id, doc_id, doc['doc_number'],
+                user['id'], f"Chuyển kho - {doc['doc_number']}", now
+            ) for serial_id in moved_serials
+        ], session=session)
+    
+    # Update document status (guarded so a concurrent post cannot apply twice)
+    result = await db.inventory_docs.update_one(
+        {"id": doc_id, "status": "draft"},
+        {"$set": {"status": "posted", "posted_at": now, "updated_at": now}},
+        session=session
     )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Document already posted or cancelled")
     
     # Update product stock quantities
-    await sync_product_stock()
-    
-    # Create automated journal entry for inventory transaction
-    try:
-        await create_inventory_journal(
-            doc_id=doc_id,
-            doc_number=doc['doc_number'],
-            doc_type=doc['doc_type'],
-            lines=doc['lines'],
-            user_id=user['id'],
-            description=f"Tự động ghi nhận kho - {doc['doc_number']}"
-        )
-    except Exception as e:
-        logger.warning(f"Failed to create inventory journal: {e}")
+    await sync_product_stock(product_ids, session)
+    
+    # Create automated journal entry for inventory transaction (same transaction)
+    await create_inventory_journal(
+        doc_id=doc_id,
+        doc_number=doc['doc_number'],
+        doc_type=doc_type,
+        lines=journal_lines,
+        user_id=user['id'],
+        description=f"Tự động ghi nhận kho - {doc['doc_number']}",
+        session=session
+    )
     
     return {"message": "Document posted successfully", "doc_number": doc['doc_number']}
 
-async def update_stock_balance(product_id: str, warehouse_id: str, qty_change: int, unit_cost: float):
-    """Update or create stock balance"""
-    existing = await db.stock_balance.find_one(
-        {"product_id": product_id, "warehouse_id": warehouse_id},
-        {"_id": 0}
-    )
+def apply_stock_movement(balance: Optional[dict], qty_change: int, unit_cost: float) -> dict:
+    """Compute quantity/avg_cost/total_value after a movement (moving weighted average)"""
+    if not balance:
+        return {
+            "quantity": qty_change,
+            "avg_cost": unit_cost,
+            "total_value": qty_change * unit_cost
+        }
     
-    if existing:
-        new_qty = existing['quantity'] + qty_change
-        # Calculate new average cost (weighted average)
-        if qty_change > 0 and unit_cost > 0:
-            old_value = existing['quantity'] * existing.get('avg_cost', 0)
-            new_value = qty_change * unit_cost
-            new_avg_cost = (old_value + new_value) / new_qty if new_qty > 0 else 0
+    new_qty = balance['quantity'] + qty_change
+    # Calculate new average cost (weighted average)
+    if qty_change > 0 and unit_cost > 0:
+        old_value = balance['quantity'] * balance.get('avg_cost', 0)
+        new_value = qty_change * unit_cost
+        new_avg_cost = (old_value + new_value) / new_qty if new_qty > 0 else 0
+    else:
+        new_avg_cost = balance.get('avg_cost', 0)
+    
+    return {
+        "quantity": new_qty,
+        "avg_cost": new_avg_cost,
+        "total_value": new_qty * new_avg_cost
+    }
+
+def move_stock(balances: dict, product_id: str, warehouse_id: str, qty_change: int, unit_cost: float) -> tuple:
+    """Apply a movement to an in-memory balance map; returns the (before, after) balances"""
+    key = (product_id, warehouse_id)
+    before = balances.get(key)
+    after = {
+        **(before or {"product_id": product_id, "warehouse_id": warehouse_id}),
+        **apply_stock_movement(before, qty_change, unit_cost)
+    }
+    balances[key] = after
+    return before, after
+
+# ==================== FIFO COST LAYERS ====================
+# Products with costing_method 'fifo' keep their receipts as an ordered array of layers in one
+# cost_layers doc per (product, warehouse); issues consume the oldest layers first.
+
+def take_layers(layers: List[dict], quantity: int, fallback_cost: float) -> tuple:
+    """Consume quantity from the oldest layers; returns (remaining, taken)"""
+    remaining = list(layers)
+    taken = []
+    while quantity > 0 and remaining:
+        layer = remaining[0]
+        used = min(layer['quantity'], quantity)
+        taken.append({**layer, "quantity": used})
+        quantity -= used
+        if used == layer['quantity']:
+            remaining.pop(0)
         else:
-            new_avg_cost = existing.get('avg_cost', 0)
-        
-        await db.stock_balance.update_one(
+            remaining[0] = {**layer, "quantity": layer['quantity'] - used}
+    if quantity > 0:
+        # More issued than layered (should not pass availability checks): cost it at the running average
+        taken.append({"quantity": quantity, "unit_cost": fallback_cost, "received_at": None, "doc_number": None})
+    return remaining, taken
+
+def layers_value(layers: List[dict]) -> float:
+    return sum(layer['quantity'] * layer['unit_cost'] for layer in layers)
+
+def move_fifo_stock(
+    balances: dict,
+    cost_layers: dict,
+    product_id: str,
+    warehouse_id: str,
+    qty_change: int,
+    new_layers: Optional[List[dict]] = None
+) -> tuple:
+    """FIFO counterpart of move_stock; returns (before, after, taken layers).
+    
+    Incoming stock appends new_layers; outgoing stock takes from the front. The balance's
+    total_value is the value of the remaining layers.
+    """
+    key = (product_id, warehouse_id)
+    before = balances.get(key)
+    layers = cost_layers.get(key, [])
+    taken = []
+    if qty_change > 0:
+        layers = layers + (new_layers or [])
+    elif qty_change < 0:
+        layers, taken = take_layers(layers, -qty_change, before.get('avg_cost', 0) if before else 0)
+    cost_layers[key] = layers
+    
+    quantity = (before['quantity'] if before else 0) + qty_change
+    total_value = layers_value(layers)
+    after = {
+        **(before or {"product_id": product_id, "warehouse_id": warehouse_id}),
+        "quantity": quantity,
+        "avg_cost": total_value / quantity if quantity > 0 else (before.get('avg_cost', 0) if before else 0),
+        "total_value": total_value
+    }
+    balances[key] = after
+    return before, after, taken
+
+def new_layer(quantity: int, unit_cost: float, received_at: str, doc_number: str) -> List[dict]:
+    return [{"quantity": quantity, "unit_cost": unit_cost, "received_at": received_at, "doc_number": doc_number}]
+
+async def load_cost_layers(product_ids: List[str], warehouse_ids: List[str], balances: dict, session=None) -> dict:
+    """Layers for FIFO products keyed by (product_id, warehouse_id), in one read.
+    
+    Stock that predates FIFO (no layer doc yet) starts as a single layer at the balance's avg_cost.
+    """
+    if not product_ids:
+        return {}
+    docs = await db.cost_layers.find(
+        {"product_id": {"$in": product_ids}, "warehouse_id": {"$in": warehouse_ids}},
+        {"_id": 0},
+        session=session
+    ).to_list(None)
+    layers = {(d['product_id'], d['warehouse_id']): d['layers'] for d in docs}
+    
+    for product_id in product_ids:
+        for warehouse_id in warehouse_ids:
+            key = (product_id, warehouse_id)
+            balance = balances.get(key)
+            if key not in layers and balance and balance['quantity'] > 0:
+                layers[key] = new_layer(balance['quantity'], balance.get('avg_cost', 0), balance.get('updated_at'), None)
+    return layers
+
+async def write_cost_layers(cost_layers: dict, now: str, session=None):
+    """Persist the layer arrays in a single bulk write"""
+    if not cost_layers:
+        return
+    await db.cost_layers.bulk_write([
+        UpdateOne(
             {"product_id": product_id, "warehouse_id": warehouse_id},
-            {"$set": {
-                "quantity": new_qty,
-                "avg_cost": new_avg_cost,
-                "total_value": new_qty * new_avg_cost,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+            {"$set": {"layers": layers, "updated_at": now}},
+            upsert=True
         )
-    else:
-        # Create new balance
-        await db.stock_balance.insert_one({
-            "id": str(uuid.uuid4()),
-            "product_id": product_id,
-            "warehouse_id": warehouse_id,
-            "quantity": qty_change,
-            "avg_cost": unit_cost,
-            "total_value": qty_change * unit_cost,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        })
+        for (product_id, warehouse_id), layers in cost_layers.items()
+    ], ordered=False, session=session)
+
+def make_ledger_entry(
+    doc_id: str,
+    doc_number: str,
+    doc_type: str,
+    qty_change: int,
+    unit_cost: float,
+    before: Optional[dict],
+    after: dict,
+    now: str
+) -> dict:
+    """Build a stock_ledger row; value_change lets point-in-time queries sum values as well as quantities"""
+    return {
+        "id": str(uuid.uuid4()),
+        "product_id": after['product_id'],
+        "warehouse_id": after['warehouse_id'],
+        "doc_id": doc_id,
+        "doc_number": doc_number,
+        "doc_type": doc_type,
+        "quantity_change": qty_change,
+        "quantity_after": after['quantity'],
+        "unit_cost": unit_cost,
+        "value_change": after['total_value'] - (before.get('total_value', 0) if before else 0),
+        "created_at": now
+    }
+
+async def load_stock_balances(product_ids: List[str], warehouse_ids: List[str], session=None) -> dict:
+    """Fetch balances for a set of products/warehouses, keyed by (product_id, warehouse_id)"""
+    if not product_ids or not warehouse_ids:
+        return {}
+    balances = await db.stock_balance.find(
+        {"product_id": {"$in": product_ids}, "warehouse_id": {"$in": warehouse_ids}},
+        {"_id": 0},
+        session=session
+    ).to_list(None)
+    return {(b['product_id'], b['warehouse_id']): b for b in balances}
+
+async def write_stock_balances(balances: List[dict], now: str, session=None):
+    """Upsert computed balances in a single bulk write, refreshing each row's low_stock flag"""
+    if not balances:
+        return
+    operations = [
+        UpdateOne(
+            {"product_id": b['product_id'], "warehouse_id": b['warehouse_id']},
+            {
+                "$set": {
+                    "quantity": b['quantity'],
+                    "avg_cost": b['avg_cost'],
+                    "total_value": b['total_value'],
+                    "low_stock": is_low_stock(b),
+                    "updated_at": now
+                },
+                "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}
+            },
+            upsert=True
+        )
+        for b in balances
+    ]
+    await db.stock_balance.bulk_write(operations, ordered=False, session=session)
 
-async def sync_product_stock():
+async def sync_product_stock(product_ids: Optional[List[str]] = None, session=None):
     """Sync total stock quantities to products collection"""
     pipeline = [
         {"$group": {"_id": "$product_id", "total_qty": {"$sum": "$quantity"}}}
     ]
-    stock_totals = await db.stock_balance.aggregate(pipeline).to_list(10000)
+    if product_ids is not None:
+        pipeline.insert(0, {"$match": {"product_id": {"$in": product_ids}}})
+    stock_totals = await db.stock_balance.aggregate(pipeline, session=session).to_list(None)
+    
+    if stock_totals:
+        await db.products.bulk_write([
+            UpdateOne({"id": item['_id']}, {"$set": {"stock_quantity": item['total_qty']}})
+            for item in stock_totals
+        ], ordered=False, session=session)
+
+# ==================== STOCK AVAILABILITY ====================
+
+async def check_availability(items: List[dict], session=None, balances: Optional[dict] = None) -> List[str]:
+    """Every shortage for a document's items ({product_id, warehouse_id, quantity, serial_numbers}).
+    
+    Quantities are summed per (product, warehouse) and checked with one $in read on stock_balance
+    (skipped when the caller already prefetched balances); serials are checked with one $in read
+    on serial_items. Returns an empty list when everything is available.
+    """
+    required = {}
+    serial_requests = []
+    for item in items:
+        key = (item['product_id'], item['warehouse_id'])
+        required[key] = required.get(key, 0) + item['quantity']
+        for sn in item.get('serial_numbers') or []:
+            serial_requests.append((sn, key))
+    
+    if balances is None:
+        balances = await load_stock_balances(
+            list({k[0] for k in required}), list({k[1] for k in required}), session
+        )
     
-    for item in stock_totals:
-        await db.products.update_one(
-            {"id": item['_id']},
-            {"$set": {"stock_quantity": item['total_qty']}}
+    problems = []
+    short = []
+    for key, quantity in required.items():
+        available = available_quantity(balances.get(key))
+        if available < quantity:
+            short.append((key[0], available, quantity))
+    
+    if serial_requests:
+        serials = {
+            s['serial_number']: s for s in await db.serial_items.find(
+                {"serial_number": {"$in": [sn for sn, _ in serial_requests]}},
+                {"_id": 0, "serial_number": 1, "product_id": 1, "warehouse_id": 1, "status": 1},
+                session=session
+            ).to_list(None)
+        }
+        seen = set()
+        for sn, (product_id, warehouse_id) in serial_requests:
+            serial = serials.get(sn)
+            if sn in seen:
+                problems.append(f"Serial {sn} listed more than once")
+            elif (not serial or serial['product_id'] != product_id
+                    or serial['warehouse_id'] != warehouse_id or serial['status'] != 'in_stock'):
+                problems.append(f"Serial {sn} not available in warehouse")
+            seen.add(sn)
+    
+    if short:
+        # Names are only needed for the error message
+        names = {
+            p['id']: p['name'] for p in await db.products.find(
+                {"id": {"$in": [pid for pid, _, _ in short]}}, {"_id": 0, "id": 1, "name": 1}, session=session
+            ).to_list(None)
+        }
+        problems = [
+            f"Insufficient stock for {names.get(pid, pid)}: available {available}, requested {quantity}"
+            for pid, available, quantity in short
+        ] + problems
+    
+    return problems
+
+def raise_if_unavailable(problems: List[str]):
+    """Report all shortages in a single 400"""
+    if problems:
+        raise HTTPException(status_code=400, detail="; ".join(problems))
+
+def available_quantity(balance: Optional[dict]) -> int:
+    """On-hand quantity not promised to a confirmed order"""
+    if not balance:
+        return 0
+    return balance['quantity'] - balance.get('reserved', 0)
+
+# ==================== STOCK RESERVATIONS ====================
+
+RESERVATION_HOURS = int(os.environ.get('RESERVATION_HOURS', '72'))
+RESERVATION_SWEEP_SECONDS = int(os.environ.get('RESERVATION_SWEEP_SECONDS', '300'))
+
+async def reserve_stock(order: dict, items: List[dict], now: str, session=None) -> str:
+    """Hold stock for an order: bump the reserved counter on each balance and record the reservation.
+    
+    Each $inc only applies while quantity - reserved still covers it, so two orders cannot
+    promise the same unit even if they race past the availability check. Returns expires_at.
+    """
+    required = {}
+    for item in items:
+        key = (item['product_id'], item['warehouse_id'])
+        required[key] = required.get(key, 0) + item['quantity']
+    
+    expires_at = (datetime.fromisoformat(now) + timedelta(hours=RESERVATION_HOURS)).isoformat()
+    reservations = []
+    for (product_id, warehouse_id), quantity in required.items():
+        result = await db.stock_balance.update_one(
+            {
+                "product_id": product_id,
+                "warehouse_id": warehouse_id,
+                "$expr": {"$gte": [{"$subtract": ["$quantity", {"$ifNull": ["$reserved", 0]}]}, quantity]}
+            },
+            {"$inc": {"reserved": quantity}},
+            session=session
         )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="Stock changed while reserving, please retry")
+        reservations.append({
+            "id": str(uuid.uuid4()),
+            "order_id": order['id'],
+            "order_number": order['order_number'],
+            "product_id": product_id,
+            "warehouse_id": warehouse_id,
+            "quantity": quantity,
+            "status": "active",
+            "expires_at": expires_at,
+            "created_at": now,
+            "updated_at": now
+        })
+    
+    if reservations:
+        await db.stock_reservations.insert_many(reservations, session=session)
+    return expires_at
+
+async def release_reservations(query: dict, status: str, now: str, session=None, limit: int = 0) -> int:
+    """Close active reservations matching query (consumed/released/expired) and give the quantity back"""
+    reservations = await db.stock_reservations.find(
+        {**query, "status": "active"},
+        {"_id": 0, "id": 1, "product_id": 1, "warehouse_id": 1, "quantity": 1},
+        session=session
+    ).limit(limit).to_list(None)
+    if not reservations:
+        return 0
+    
+    released = {}
+    for r in reservations:
+        key = (r['product_id'], r['warehouse_id'])
+        released[key] = released.get(key, 0) + r['quantity']
+    
+    await db.stock_reservations.update_many(
+        {"id": {"$in": [r['id'] for r in reservations]}, "status": "active"},
+        {"$set": {"status": status, "updated_at": now}},
+        session=session
+    )
+    await db.stock_balance.bulk_write([
+        UpdateOne({"product_id": pid, "warehouse_id": wid}, {"$inc": {"reserved": -quantity}})
+        for (pid, wid), quantity in released.items()
+    ], ordered=False, session=session)
+    return len(reservations)
+
+async def release_expired_reservations(batch_size: int = 1000) -> int:
+    """Release reservations past expires_at; safe to run from several workers"""
+    total = 0
+    while True:
+        now = datetime.now(timezone.utc).isoformat()
+        released = await run_in_transaction(lambda session: release_reservations(
+            {"expires_at": {"$lt": now}}, "expired", now, session, limit=batch_size
+        ))
+        total += released
+        if released < batch_size:
+            return total
+
+async def reservation_sweeper():
+    """Background loop releasing expired reservations"""
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_SECONDS)
+        try:
+            released = await release_expired_reservations()
+            if released:
+                logger.info(f"Released {released} expired stock reservations")
+        except Exception as e:
+            logger.warning(f"Reservation sweep failed: {e}")
+
+@api_router.get("/admin/inventory/reservations")
+async def list_stock_reservations(
+    user: dict = Depends(get_current_user),
+    order_id: Optional[str] = None,
+    product_id: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    status: Optional[str] = "active",
+    skip: int = 0,
+    limit: int = 100
+):
+    query = {}
+    if order_id:
+        query['order_id'] = order_id
+    if product_id:
+        query['product_id'] = product_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if status:
+        query['status'] = status
+    
+    return await db.stock_reservations.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+
+@api_router.post("/admin/inventory/reservations/release-expired")
+async def release_expired_reservations_now(user: dict = Depends(require_admin)):
+    """Run the expiry sweep immediately"""
+    released = await release_expired_reservations()
+    return {"message": f"Released {released} expired reservations", "released": released}
 
 @api_router.delete("/admin/inventory/documents/{doc_id}")
 async def delete_inventory_doc(doc_id: str, user: dict = Depends(require_admin)):
@@ -1489,15 +2159,32 @@ async def list_stock_balance(
     user: dict = Depends(get_current_user),
     warehouse_id: Optional[str] = None,
     product_id: Optional[str] = None,
-    low_stock: bool = False
+    low_stock: bool = False,
+    as_of: Optional[str] = None
 ):
-    query = {"quantity": {"$gt": 0}} if not low_stock else {"quantity": {"$lt": 5, "$gt": 0}}
-    if warehouse_id:
-        query['warehouse_id'] = warehouse_id
-    if product_id:
-        query['product_id'] = product_id
-    
-    balances = await db.stock_balance.find(query, {"_id": 0}).to_list(10000)
+    if as_of:
+        # Point-in-time: nearest snapshot plus ledger delta since it, judged against today's reorder rules
+        rules = {}
+        if low_stock:
+            rules = {
+                (r['product_id'], r['warehouse_id']): r['reorder_point'] for r in await db.stock_balance.find(
+                    {"reorder_point": {"$ne": None}}, {"_id": 0, "product_id": 1, "warehouse_id": 1, "reorder_point": 1}
+                ).to_list(None)
+            }
+        balances = [
+            b for b in await stock_as_of(parse_as_of(as_of), product_id, warehouse_id)
+            if b['quantity'] > 0 and (not low_stock or is_low_stock(
+                {**b, "reorder_point": rules.get((b['product_id'], b['warehouse_id']))}
+            ))
+        ]
+    else:
+        query = {"quantity": {"$gt": 0}} if not low_stock else {"low_stock": True}
+        if warehouse_id:
+            query['warehouse_id'] = warehouse_id
+        if product_id:
+            query['product_id'] = product_id
+        
+        balances = await db.stock_balance.find(query, {"_id": 0}).to_list(10000)
     
     # Enrich with names
     products = {p['id']: p for p in await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "sku": 1, "product_type": 1}).to_list(10000)}
@@ -1514,8 +2201,15 @@ async def list_stock_balance(
             warehouse_id=b['warehouse_id'],
             warehouse_name=warehouses.get(b['warehouse_id'], ''),
             quantity=b['quantity'],
+            reserved=b.get('reserved', 0),
+            available=available_quantity(b),
             avg_cost=b.get('avg_cost', 0),
-            total_value=b.get('total_value', 0)
+            total_value=b.get('total_value', 0),
+            min_qty=b.get('min_qty'),
+            max_qty=b.get('max_qty'),
+            reorder_point=b.get('reorder_point'),
+            low_stock=b.get('low_stock', False),
+            value_known=b.get('value_known', True)
         ))
     
     return result
@@ -1548,116 +2242,871 @@ async def list_stock_ledger(
     
     return result
 
-# ==================== SERIAL/IMEI ROUTES ====================
+# ==================== REORDER RULES ====================
 
-@api_router.get("/admin/serials", response_model=List[SerialItemResponse])
-async def list_serial_items(
-    user: dict = Depends(get_current_user),
-    product_id: Optional[str] = None,
-    warehouse_id: Optional[str] = None,
-    status: Optional[str] = None,
-    search: Optional[str] = None,
-    skip: int = 0,
-    limit: int = 100
-):
-    query = {}
-    if product_id:
-        query['product_id'] = product_id
-    if warehouse_id:
-        query['warehouse_id'] = warehouse_id
-    if status:
-        query['status'] = status
-    if search:
-        query['$or'] = [
-            {'serial_number': {'$regex': search, '$options': 'i'}},
-            {'imei': {'$regex': search, '$options': 'i'}}
-        ]
-    
-    serials = await db.serial_items.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    
-    # Enrich with names
-    products = {p['id']: p for p in await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "sku": 1}).to_list(10000)}
-    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
-    customers = {c['id']: c['name'] for c in await db.customers.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(10000)}
-    
-    result = []
-    for s in serials:
-        product = products.get(s.get('product_id'), {})
-        s['product_name'] = product.get('name')
-        s['product_sku'] = product.get('sku')
-        s['warehouse_name'] = warehouses.get(s.get('warehouse_id'))
-        s['customer_name'] = customers.get(s.get('customer_id'))
-        result.append(SerialItemResponse(**s))
-    
-    return result
+def is_low_stock(balance: dict) -> bool:
+    """On-hand quantity at or below the balance's reorder point; balances without a rule are never flagged"""
+    reorder_point = balance.get('reorder_point')
+    return reorder_point is not None and balance['quantity'] <= reorder_point
 
-@api_router.get("/admin/serials/{serial_id}", response_model=SerialItemResponse)
-async def get_serial_item(serial_id: str, user: dict = Depends(get_current_user)):
-    serial = await db.serial_items.find_one({"id": serial_id}, {"_id": 0})
-    if not serial:
-        raise HTTPException(status_code=404, detail="Serial item not found")
-    
-    # Enrich
-    if serial.get('product_id'):
-        product = await db.products.find_one({"id": serial['product_id']}, {"_id": 0, "name": 1, "sku": 1})
-        serial['product_name'] = product['name'] if product else None
-        serial['product_sku'] = product['sku'] if product else None
-    if serial.get('warehouse_id'):
-        wh = await db.warehouses.find_one({"id": serial['warehouse_id']}, {"_id": 0, "name": 1})
-        serial['warehouse_name'] = wh['name'] if wh else None
-    if serial.get('customer_id'):
-        customer = await db.customers.find_one({"id": serial['customer_id']}, {"_id": 0, "name": 1})
-        serial['customer_name'] = customer['name'] if customer else None
+@api_router.put("/admin/inventory/reorder-rules")
+async def set_reorder_rule(data: ReorderRuleUpdate, user: dict = Depends(require_admin)):
+    """Set min/max/reorder point for a product in a warehouse"""
+    if data.min_qty < 0 or data.reorder_point < 0:
+        raise HTTPException(status_code=400, detail="Quantities cannot be negative")
+    if data.max_qty is not None and data.max_qty < data.reorder_point:
+        raise HTTPException(status_code=400, detail="max_qty must be at least the reorder point")
     
-    return SerialItemResponse(**serial)
-
-@api_router.post("/admin/serials", response_model=SerialItemResponse)
-async def create_serial_item(data: SerialItemCreate, user: dict = Depends(get_current_user)):
-    # Check product exists and tracks serial
-    product = await db.products.find_one({"id": data.product_id}, {"_id": 0})
+    product = await db.products.find_one({"id": data.product_id}, {"_id": 0, "id": 1})
     if not product:
         raise HTTPException(status_code=400, detail="Product not found")
-    if not product.get('track_serial'):
-        raise HTTPException(status_code=400, detail="Product does not track serial numbers")
-    
-    # Check serial number unique
-    existing = await db.serial_items.find_one({"serial_number": data.serial_number})
-    if existing:
-        raise HTTPException(status_code=400, detail="Serial number already exists")
-    
-    # Check warehouse exists
-    warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0})
+    warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0, "id": 1})
     if not warehouse:
         raise HTTPException(status_code=400, detail="Warehouse not found")
     
-    serial_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
+    balance = await db.stock_balance.find_one_and_update(
+        {"product_id": data.product_id, "warehouse_id": data.warehouse_id},
+        {
+            "$set": {
+                "min_qty": data.min_qty,
+                "max_qty": data.max_qty,
+                "reorder_point": data.reorder_point,
+                "updated_at": now
+            },
+            "$setOnInsert": {
+                "id": str(uuid.uuid4()), "quantity": 0, "avg_cost": 0, "total_value": 0, "created_at": now
+            }
+        },
+        upsert=True,
+        return_document=True,
+        projection={"_id": 0}
+    )
+    low_stock = is_low_stock(balance)
+    await db.stock_balance.update_one(
+        {"product_id": data.product_id, "warehouse_id": data.warehouse_id},
+        {"$set": {"low_stock": low_stock}}
+    )
     
-    doc = {
-        "id": serial_id,
-        "serial_number": data.serial_number,
-        "imei": data.imei,
-        "product_id": data.product_id,
-        "warehouse_id": data.warehouse_id,
-        "status": "in_stock",
-        "cost_price": data.cost_price,
-        "note": data.note,
-        "created_at": now,
-        "updated_at": now
-    }
-    
-    await db.serial_items.insert_one(doc)
-    
-    # Create movement record
-    await create_serial_movement(serial_id, "receipt", None, data.warehouse_id, None, None, user['id'], "Nhập kho ban đầu")
+    return {**balance, "low_stock": low_stock}
+
+@api_router.delete("/admin/inventory/reorder-rules")
+async def delete_reorder_rule(product_id: str, warehouse_id: str, user: dict = Depends(require_admin)):
+    """Drop a rule; the balance is no longer flagged low_stock"""
+    balance = await db.stock_balance.find_one_and_update(
+        {"product_id": product_id, "warehouse_id": warehouse_id},
+        {"$unset": {"min_qty": "", "max_qty": "", "reorder_point": ""}},
+        return_document=True,
+        projection={"_id": 0}
+    )
+    if not balance:
+        raise HTTPException(status_code=404, detail="Reorder rule not found")
+    await db.stock_balance.update_one(
+        {"product_id": product_id, "warehouse_id": warehouse_id},
+        {"$set": {"low_stock": is_low_stock(balance)}}
+    )
+    return {"message": "Reorder rule deleted"}
+
+@api_router.get("/admin/inventory/reorder-rules")
+async def list_reorder_rules(warehouse_id: Optional[str] = None, user: dict = Depends(get_current_user)):
+    query = {"reorder_point": {"$ne": None}}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    return await db.stock_balance.find(
+        query,
+        {"_id": 0, "product_id": 1, "warehouse_id": 1, "min_qty": 1, "max_qty": 1,
+         "reorder_point": 1, "quantity": 1, "low_stock": 1}
+    ).to_list(None)
+
+@api_router.post("/admin/inventory/reorder-rules/recompute")
+async def recompute_low_stock(user: dict = Depends(require_admin)):
+    """Re-evaluate every low_stock flag (after upgrading)"""
+    operations = []
+    async for b in db.stock_balance.find(
+        {}, {"_id": 0, "product_id": 1, "warehouse_id": 1, "quantity": 1, "reorder_point": 1, "low_stock": 1}
+    ):
+        low_stock = is_low_stock(b)
+        if b.get('low_stock') != low_stock:
+            operations.append(UpdateOne(
+                {"product_id": b['product_id'], "warehouse_id": b['warehouse_id']},
+                {"$set": {"low_stock": low_stock}}
+            ))
+    if operations:
+        await db.stock_balance.bulk_write(operations, ordered=False)
+    return {"message": f"Updated {len(operations)} balances", "updated": len(operations)}
+
+@api_router.get("/admin/inventory/reorder-suggestions")
+async def get_reorder_suggestions(warehouse_id: Optional[str] = None, user: dict = Depends(get_current_user)):
+    """Balances flagged low_stock with the quantity needed to get back up to max (or the reorder point)"""
+    query = {"low_stock": True}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    balances = await db.stock_balance.find(query, {"_id": 0}).to_list(None)
     
-    doc['product_name'] = product['name']
-    doc['product_sku'] = product['sku']
-    doc['warehouse_name'] = warehouse['name']
+    product_ids = list({b['product_id'] for b in balances})
+    products = {
+        p['id']: p for p in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "name": 1, "sku": 1, "cost_price": 1}
+        ).to_list(None)
+    }
+    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
+    
+    suggestions = []
+    for b in balances:
+        product = products.get(b['product_id'], {})
+        reorder_point = b['reorder_point']
+        target = b.get('max_qty') or max(reorder_point, b.get('min_qty') or 0)
+        suggested_qty = max(target - available_quantity(b), 0)
+        suggestions.append({
+            "product_id": b['product_id'],
+            "product_name": product.get('name', ''),
+            "product_sku": product.get('sku', ''),
+            "warehouse_id": b['warehouse_id'],
+            "warehouse_name": warehouses.get(b['warehouse_id'], ''),
+            "quantity": b['quantity'],
+            "reserved": b.get('reserved', 0),
+            "available": available_quantity(b),
+            "min_qty": b.get('min_qty'),
+            "max_qty": b.get('max_qty'),
+            "reorder_point": reorder_point,
+            "suggested_qty": suggested_qty,
+            "estimated_cost": suggested_qty * (b.get('avg_cost') or product.get('cost_price', 0))
+        })
+    
+    suggestions.sort(key=lambda x: x['available'] - x['reorder_point'])
+    return suggestions
+
+# ==================== STOCK SNAPSHOTS ====================
+
+def parse_as_of(value: str) -> str:
+    """Cutoff for an as_of parameter; a bare date means the end of that day (UTC)"""
+    try:
+        if len(value) == 10:
+            cutoff = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1)
+        else:
+            cutoff = datetime.fromisoformat(value)
+            if cutoff.tzinfo is None:
+                cutoff = cutoff.replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid as_of, expected YYYY-MM-DD or an ISO datetime")
+    return cutoff.astimezone(timezone.utc).isoformat()
+
+def period_cutoff(period: str) -> str:
+    """Most recent period boundary: start of today (daily) or of this month (monthly), UTC"""
+    cutoff = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'monthly':
+        cutoff = cutoff.replace(day=1)
+    return cutoff.isoformat()
+
+async def ledger_deltas(
+    start: str,
+    end: Optional[str],
+    product_id: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    session=None
+) -> dict:
+    """Sum ledger changes with start <= created_at < end (no upper bound without end), keyed by (product_id, warehouse_id).
+    
+    unvalued counts rows without value_change (written before the ledger carried costs).
+    """
+    match = {"created_at": {"$gte": start}}
+    if end:
+        match['created_at']['$lt'] = end
+    if product_id:
+        match['product_id'] = product_id
+    if warehouse_id:
+        match['warehouse_id'] = warehouse_id
+    
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"product_id": "$product_id", "warehouse_id": "$warehouse_id"},
+            "quantity": {"$sum": "$quantity_change"},
+            "total_value": {"$sum": {"$ifNull": ["$value_change", 0]}},
+            "unvalued": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$value_change", None]}, None]}, 1, 0]}}
+        }}
+    ]
+    rows = await db.stock_ledger.aggregate(pipeline, session=session).to_list(None)
+    return {
+        (r['_id']['product_id'], r['_id']['warehouse_id']): {
+            "quantity": r['quantity'], "total_value": r['total_value'], "unvalued": r['unvalued']
+        }
+        for r in rows
+    }
+
+async def stock_as_of(
+    cutoff: str,
+    product_id: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    inclusive: bool = True
+) -> List[dict]:
+    """Stock per (product, warehouse) at cutoff: the nearest earlier snapshot plus the ledger delta since it.
+    
+    Without an earlier snapshot the ledger is walked backwards from the next snapshot, or from the live
+    stock_balance, rather than replayed from the start. A row whose walk crosses ledger rows without
+    value_change has value_known False: its quantity is right but its value is not. With inclusive=False
+    a snapshot taken exactly at cutoff is ignored (used when rebuilding it).
+    """
+    filters = {}
+    if product_id:
+        filters['product_id'] = product_id
+    if warehouse_id:
+        filters['warehouse_id'] = warehouse_id
+    
+    projection = {"_id": 0, "cutoff": 1}
+    sign = 1
+    snapshot = await db.stock_snapshots.find_one(
+        {"cutoff": {"$lte" if inclusive else "$lt": cutoff}}, projection, sort=[("cutoff", -1)]
+    )
+    if not snapshot:
+        snapshot = await db.stock_snapshots.find_one({"cutoff": {"$gt": cutoff}}, projection, sort=[("cutoff", 1)])
+        sign = -1
+    
+    totals = {}
+    if snapshot:
+        async for row in db.stock_snapshots.find({"cutoff": snapshot['cutoff'], **filters}, {"_id": 0}):
+            totals[(row['product_id'], row['warehouse_id'])] = {
+                "quantity": row['quantity'],
+                "total_value": row['total_value'],
+                "value_known": row.get('value_known', True)
+            }
+        if sign > 0:
+            deltas = await ledger_deltas(snapshot['cutoff'], cutoff, product_id, warehouse_id)
+        else:
+            deltas = await ledger_deltas(cutoff, snapshot['cutoff'], product_id, warehouse_id)
+    else:
+        async def read_live(session):
+            # Balances and later ledger rows at one point in time, so a posting in between is not half counted
+            async for b in db.stock_balance.find(filters, {"_id": 0}, session=session):
+                totals[(b['product_id'], b['warehouse_id'])] = {
+                    "quantity": b.get('quantity', 0),
+                    "total_value": b.get('total_value', b.get('quantity', 0) * b.get('avg_cost', 0)),
+                    "value_known": True
+                }
+            return await ledger_deltas(cutoff, None, product_id, warehouse_id, session=session)
+        
+        deltas = await run_at_snapshot(read_live)
+    
+    for key, delta in deltas.items():
+        total = totals.setdefault(key, {"quantity": 0, "total_value": 0, "value_known": True})
+        total['quantity'] += sign * delta['quantity']
+        total['total_value'] += sign * delta['total_value']
+        if delta['unvalued']:
+            total['value_known'] = False
+    
+    return [
+        {
+            "product_id": key[0],
+            "warehouse_id": key[1],
+            "quantity": t['quantity'],
+            "avg_cost": t['total_value'] / t['quantity'] if t['quantity'] else 0,
+            "total_value": t['total_value'],
+            "value_known": t['value_known']
+        }
+        for key, t in totals.items()
+    ]
+
+async def build_stock_snapshot(cutoff: str, period: str = 'daily', progress=None) -> int:
+    """Write quantity/value checkpoints at cutoff from the nearest snapshot (or live balances) and the ledger; idempotent"""
+    if progress:
+        await progress(0, None, f"Computing stock at {cutoff}")
+    rows = [r for r in await stock_as_of(cutoff, inclusive=False) if r['quantity'] != 0 or r['total_value'] != 0]
+    build_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    snapshot_date = (datetime.fromisoformat(cutoff) - timedelta(microseconds=1)).date().isoformat()
+    
+    for start in range(0, len(rows), 5000):
+        await db.stock_snapshots.bulk_write([
+            UpdateOne(
+                {"cutoff": cutoff, "product_id": r['product_id'], "warehouse_id": r['warehouse_id']},
+                {
+                    "$set": {
+                        "period": period,
+                        "snapshot_date": snapshot_date,
+                        "quantity": r['quantity'],
+                        "total_value": r['total_value'],
+                        "value_known": r['value_known'],
+                        "build_id": build_id,
+                        "created_at": now
+                    },
+                    "$setOnInsert": {"id": str(uuid.uuid4())}
+                },
+                upsert=True
+            )
+            for r in rows[start:start + 5000]
+        ], ordered=False)
+        if progress:
+            await progress(min(start + 5000, len(rows)), len(rows), "Writing snapshot rows")
+    # Rows left over from an earlier build of the same cutoff have gone to zero since
+    await db.stock_snapshots.delete_many({"cutoff": cutoff, "build_id": {"$ne": build_id}})
+    
+    logger.info(f"Built {period} stock snapshot at {cutoff} with {len(rows)} rows")
+    return len(rows)
+
+@api_router.post("/admin/inventory/snapshots")
+async def create_stock_snapshot(
+    period: Literal['daily', 'monthly'] = 'daily',
+    as_of: Optional[str] = None,
+    user: dict = Depends(require_admin)
+):
+    """Write a stock snapshot at as_of, or at the most recent daily/monthly boundary"""
+    cutoff = parse_as_of(as_of) if as_of else period_cutoff(period)
+    rows = await build_stock_snapshot(cutoff, period)
+    return {"message": "Snapshot created", "cutoff": cutoff, "rows": rows}
+
+@api_router.get("/admin/inventory/snapshots")
+async def list_stock_snapshots(user: dict = Depends(get_current_user), limit: int = 60):
+    pipeline = [
+        {"$group": {
+            "_id": "$cutoff",
+            "period": {"$first": "$period"},
+            "snapshot_date": {"$first": "$snapshot_date"},
+            "rows": {"$sum": 1},
+            "total_value": {"$sum": "$total_value"}
+        }},
+        {"$sort": {"_id": -1}},
+        {"$limit": limit}
+    ]
+    snapshots = await db.stock_snapshots.aggregate(pipeline).to_list(limit)
+    return [
+        {
+            "cutoff": s['_id'],
+            "period": s['period'],
+            "snapshot_date": s['snapshot_date'],
+            "rows": s['rows'],
+            "total_value": s['total_value']
+        }
+        for s in snapshots
+    ]
+
+# ==================== BARCODE SCAN ====================
+
+# Product/warehouse/customer details behind a scan change rarely; the serial itself is always read fresh
+scan_cache = LRUCache(maxsize=2048, ttl=60)
+
+async def cached_lookup(collection: str, kind: str, entity_id: Optional[str], projection: dict) -> Optional[dict]:
+    if not entity_id:
+        return None
+    key = (kind, entity_id)
+    doc = scan_cache.get(key)
+    if doc is None:
+        doc = await db[collection].find_one({"id": entity_id}, projection)
+        if doc:
+            scan_cache.set(key, doc)
+    return doc
+
+def warranty_info(serial: dict) -> Optional[dict]:
+    """Warranty window and remaining days for a sold serial"""
+    if not serial.get('warranty_start'):
+        return None
+    end = serial.get('warranty_end')
+    days_left = None
+    if end:
+        days_left = (datetime.fromisoformat(end) - datetime.now(timezone.utc)).days
+    return {
+        "start": serial['warranty_start'],
+        "end": end,
+        "active": end is not None and days_left >= 0,
+        "days_left": max(days_left, 0) if days_left is not None else None
+    }
+
+@api_router.get("/admin/scan/{code}")
+async def scan_code(code: str, user: dict = Depends(get_current_user)):
+    """Resolve a scanned serial number, IMEI or product barcode through exact-match indexes"""
+    code = code.strip()
+    product_projection = {
+        "_id": 0, "id": 1, "name": 1, "sku": 1, "barcode": 1, "product_type": 1,
+        "price": 1, "sale_price": 1, "track_serial": 1, "warranty_months": 1, "images": 1
+    }
+    
+    serial = await db.serial_items.find_one({"$or": [{"serial_number": code}, {"imei": code}]}, {"_id": 0})
+    if serial:
+        product, warehouse, customer = await asyncio.gather(
+            cached_lookup("products", "product", serial.get('product_id'), product_projection),
+            cached_lookup("warehouses", "warehouse", serial.get('warehouse_id'), {"_id": 0, "id": 1, "name": 1, "code": 1}),
+            cached_lookup("customers", "customer", serial.get('customer_id'), {"_id": 0, "id": 1, "name": 1, "phone": 1})
+        )
+        return {
+            "code": code,
+            "type": "serial",
+            "matched_on": "serial_number" if serial['serial_number'] == code else "imei",
+            "serial": serial,
+            "product": product,
+            "warehouse": warehouse,
+            "customer": customer,
+            "warranty": warranty_info(serial)
+        }
+    
+    product = await db.products.find_one({"barcode": code}, product_projection)
+    if product:
+        scan_cache.set(('product', product['id']), product)
+        stock = await db.stock_balance.find(
+            {"product_id": product['id'], "quantity": {"$gt": 0}},
+            {"_id": 0, "warehouse_id": 1, "quantity": 1, "reserved": 1}
+        ).to_list(100)
+        for row in stock:
+            warehouse = await cached_lookup("warehouses", "warehouse", row['warehouse_id'], {"_id": 0, "id": 1, "name": 1, "code": 1})
+            row['warehouse_name'] = warehouse['name'] if warehouse else None
+            row['available'] = available_quantity(row)
+        return {
+            "code": code,
+            "type": "product",
+            "matched_on": "barcode",
+            "product": product,
+            "stock": stock
+        }
+    
+    raise HTTPException(status_code=404, detail="Code not found")
+
+# ==================== WARRANTY LOOKUP ====================
+# Warranty checks by serial number, IMEI or customer phone, all through exact-match indexes.
+# Results are cached briefly; the public self-check endpoint only accepts serial/IMEI codes and is
+# rate limited per client address, in fixed windows counted per process.
+
+WARRANTY_RATE_LIMIT = int(os.environ.get('WARRANTY_RATE_LIMIT', '10'))
+WARRANTY_RATE_WINDOW = 60
+
+warranty_cache = LRUCache(maxsize=4096, ttl=60)
+warranty_rate_limits = LRUCache(maxsize=10000, ttl=WARRANTY_RATE_WINDOW)
+
+async def lookup_warranties(code: str, by_phone: bool = True) -> dict:
+    """Sold serials matching a serial number or IMEI, or (by_phone) every serial sold to the customer with that phone"""
+    code = code.strip()
+    cached = warranty_cache.get(code)
+    if cached is not None and (by_phone or cached['matched_on'] != 'phone'):
+        return cached
+    
+    projection = {"_id": 0, "serial_number": 1, "imei": 1, "product_id": 1, "customer_id": 1,
+                  "sale_order_id": 1, "warranty_start": 1, "warranty_end": 1}
+    matched_on = "serial"
+    serials = await db.serial_items.find(
+        {"$or": [{"serial_number": code}, {"imei": code}], "status": "sold"}, projection
+    ).to_list(10)
+    customer = None
+    if not serials and by_phone:
+        phone = normalize_phone(code) if PHONE_SEARCH_PATTERN.match(code) else None
+        customer = await db.customers.find_one({"phone": phone}, {"_id": 0, "id": 1, "name": 1, "phone": 1}) if phone else None
+        if customer:
+            matched_on = "phone"
+            serials = await db.serial_items.find(
+                {"customer_id": customer['id'], "status": "sold"}, projection
+            ).sort("warranty_end", -1).to_list(200)
+    if not serials:
+        # Not cached: the item may be sold a moment later
+        return {"code": code, "matched_on": None, "customer": None, "items": []}
+    
+    products = {p['id']: p['name'] for p in await db.products.find(
+        {"id": {"$in": list({s['product_id'] for s in serials})}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)}
+    if not customer and serials[0].get('customer_id'):
+        customer = await db.customers.find_one({"id": serials[0]['customer_id']}, {"_id": 0, "id": 1, "name": 1, "phone": 1})
+    
+    result = {
+        "code": code,
+        "matched_on": matched_on,
+        "customer": customer,
+        "items": [
+            {
+                "serial_number": s['serial_number'],
+                "imei": s.get('imei'),
+                "product_id": s['product_id'],
+                "product_name": products.get(s['product_id']),
+                "sale_order_id": s.get('sale_order_id'),
+                "warranty": warranty_info(s)
+            }
+            for s in serials
+        ]
+    }
+    warranty_cache.set(code, result)
+    return result
+
+@api_router.get("/admin/warranty/{code}")
+async def admin_warranty_lookup(code: str, user: dict = Depends(get_current_user)):
+    result = await lookup_warranties(code)
+    if not result['items']:
+        raise HTTPException(status_code=404, detail="No warranty found")
+    return result
+
+@api_router.get("/store/warranty/{code}")
+async def store_warranty_lookup(code: str, request: Request):
+    """Public warranty self-check by serial number or IMEI; customer details are omitted.
+    Phone lookups would expose a stranger's purchases from a guessed number, so they stay admin-only.
+    
+    Each client address gets WARRANTY_RATE_LIMIT lookups per fixed WARRANTY_RATE_WINDOW seconds. The count is
+    kept per process, so N workers allow up to N times the limit.
+    """
+    # The peer address; behind a reverse proxy uvicorn's --proxy-headers resolves it from the trusted proxy
+    client_key = request.client.host if request.client else 'unknown'
+    now = time.monotonic()
+    window_start, count = warranty_rate_limits.get(client_key, (now, 0))
+    if now - window_start >= WARRANTY_RATE_WINDOW:
+        window_start, count = now, 0
+    if count >= WARRANTY_RATE_LIMIT:
+        # Rejected attempts do not extend the window
+        raise HTTPException(status_code=429, detail="Too many warranty lookups, please try again later")
+    warranty_rate_limits.set(client_key, (window_start, count + 1))
+    
+    result = await lookup_warranties(code, by_phone=False)
+    if not result['items']:
+        raise HTTPException(status_code=404, detail="No warranty found")
+    return {
+        "code": result['code'],
+        "items": [
+            {
+                "serial_number": item['serial_number'],
+                "product_name": item['product_name'],
+                "warranty": item['warranty']
+            }
+            for item in result['items']
+        ]
+    }
+
+@api_router.get("/admin/reports/warranty-expiring")
+async def get_expiring_warranties(
+    user: dict = Depends(get_current_user),
+    days: int = 30,
+    cursor: Optional[str] = None,
+    limit: int = 500
+):
+    """Sold serials whose warranty ends within the next N days, in warranty_end order, one batch per call.
+    Pass next_cursor back to fetch the following batch."""
+    limit = max(1, min(limit, 5000))
+    now = datetime.now(timezone.utc)
+    query = {
+        "status": "sold",
+        "warranty_end": {"$gte": now.isoformat(), "$lt": (now + timedelta(days=days)).isoformat()}
+    }
+    if cursor:
+        end, _, serial_number = cursor.partition('|')
+        query['$or'] = [
+            {"warranty_end": {"$gt": end}},
+            {"warranty_end": end, "serial_number": {"$gt": serial_number}}
+        ]
+    
+    serials = await db.serial_items.find(
+        query,
+        {"_id": 0, "serial_number": 1, "imei": 1, "product_id": 1, "customer_id": 1, "sale_order_id": 1,
+         "warranty_start": 1, "warranty_end": 1}
+    ).sort([("warranty_end", 1), ("serial_number", 1)]).limit(limit).to_list(limit)
+    
+    products = {p['id']: p['name'] for p in await db.products.find(
+        {"id": {"$in": list({s['product_id'] for s in serials})}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)}
+    customers = {c['id']: c for c in await db.customers.find(
+        {"id": {"$in": list({s['customer_id'] for s in serials if s.get('customer_id')})}},
+        {"_id": 0, "id": 1, "name": 1, "phone": 1, "email": 1}
+    ).to_list(None)}
+    
+    items = []
+    for serial in serials:
+        customer = customers.get(serial.get('customer_id'), {})
+        items.append({
+            **serial,
+            "product_name": products.get(serial['product_id']),
+            "customer_name": customer.get('name'),
+            "customer_phone": customer.get('phone'),
+            "customer_email": customer.get('email'),
+            "days_left": (datetime.fromisoformat(serial['warranty_end']) - now).days
+        })
+    
+    next_cursor = None
+    if len(serials) == limit:
+        next_cursor = f"{serials[-1]['warranty_end']}|{serials[-1]['serial_number']}"
+    return {"days": days, "items": items, "next_cursor": next_cursor}
+
+# ==================== SERIAL/IMEI ROUTES ====================
+
+@api_router.get("/admin/serials", response_model=List[SerialItemResponse])
+async def list_serial_items(
+    user: dict = Depends(get_current_user),
+    product_id: Optional[str] = None,
+    warehouse_id: Optional[str] = None,
+    status: Optional[str] = None,
+    search: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100
+):
+    query = {}
+    if product_id:
+        query['product_id'] = product_id
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if status:
+        query['status'] = status
+    if search:
+        query['$or'] = [
+            {'serial_number': {'$regex': search, '$options': 'i'}},
+            {'imei': {'$regex': search, '$options': 'i'}}
+        ]
+    
+    serials = await db.serial_items.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    
+    # Enrich with names
+    products = {p['id']: p for p in await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "sku": 1}).to_list(10000)}
+    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
+    customers = {c['id']: c['name'] for c in await db.customers.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(10000)}
+    
+    result = []
+    for s in serials:
+        product = products.get(s.get('product_id'), {})
+        s['product_name'] = product.get('name')
+        s['product_sku'] = product.get('sku')
+        s['warehouse_name'] = warehouses.get(s.get('warehouse_id'))
+        s['customer_name'] = customers.get(s.get('customer_id'))
+        result.append(SerialItemResponse(**s))
+    
+    return result
+
+@api_router.get("/admin/serials/{serial_id}", response_model=SerialItemResponse)
+async def get_serial_item(serial_id: str, user: dict = Depends(get_current_user)):
+    serial = await db.serial_items.find_one({"id": serial_id}, {"_id": 0})
+    if not serial:
+        raise HTTPException(status_code=404, detail="Serial item not found")
+    
+    # Enrich
+    if serial.get('product_id'):
+        product = await db.products.find_one({"id": serial['product_id']}, {"_id": 0, "name": 1, "sku": 1})
+        serial['product_name'] = product['name'] if product else None
+        serial['product_sku'] = product['sku'] if product else None
+    if serial.get('warehouse_id'):
+        wh = await db.warehouses.find_one({"id": serial['warehouse_id']}, {"_id": 0, "name": 1})
+        serial['warehouse_name'] = wh['name'] if wh else None
+    if serial.get('customer_id'):
+        customer = await db.customers.find_one({"id": serial['customer_id']}, {"_id": 0, "name": 1})
+        serial['customer_name'] = customer['name'] if customer else None
+    
+    return SerialItemResponse(**serial)
+
+@api_router.post("/admin/serials", response_model=SerialItemResponse)
+async def create_serial_item(data: SerialItemCreate, user: dict = Depends(get_current_user)):
+    # Check product exists and tracks serial
+    product = await db.products.find_one({"id": data.product_id}, {"_id": 0})
+    if not product:
+        raise HTTPException(status_code=400, detail="Product not found")
+    if not product.get('track_serial'):
+        raise HTTPException(status_code=400, detail="Product does not track serial numbers")
+    
+    # Check serial number unique
+    existing = await db.serial_items.find_one({"serial_number": data.serial_number})
+    if existing:
+        raise HTTPException(status_code=400, detail="Serial number already exists")
+    
+    # Check warehouse exists
+    warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0})
+    if not warehouse:
+        raise HTTPException(status_code=400, detail="Warehouse not found")
+    
+    serial_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    
+    doc = {
+        "id": serial_id,
+        "serial_number": data.serial_number,
+        "imei": data.imei,
+        "product_id": data.product_id,
+        "warehouse_id": data.warehouse_id,
+        "status": "in_stock",
+        "cost_price": data.cost_price,
+        "note": data.note,
+        "created_at": now,
+        "updated_at": now
+    }
+    
+    await db.serial_items.insert_one(doc)
+    
+    # Create movement record
+    await create_serial_movement(serial_id, "receipt", None, data.warehouse_id, None, None, user['id'], "Nhập kho ban đầu")
+    
+    doc['product_name'] = product['name']
+    doc['product_sku'] = product['sku']
+    doc['warehouse_name'] = warehouse['name']
     
     return SerialItemResponse(**{k: v for k, v in doc.items() if k != '_id'})
 
-async def create_serial_movement(
+# Largest batch accepted by the bulk endpoints and by a single receipt line range
+MAX_SERIAL_BATCH = 10000
+
+def expand_serial_range(pattern: str) -> List[str]:
+    """Expand 'DX50-2026-0001..0800' (or '..DX50-2026-0800') into zero-padded serials"""
+    start, _, end = (part.strip() for part in pattern.partition('..'))
+    match = re.fullmatch(r'(.*?)(\d+)', start)
+    if not match:
+        raise HTTPException(status_code=400, detail=f"Invalid serial range {pattern}")
+    prefix, first_digits = match.groups()
+    last_digits = end[len(prefix):] if prefix and end.startswith(prefix) else end
+    if not last_digits.isdigit():
+        raise HTTPException(status_code=400, detail=f"Invalid serial range {pattern}")
+    
+    first, last = int(first_digits), int(last_digits)
+    if last < first:
+        raise HTTPException(status_code=400, detail=f"Invalid serial range {pattern}")
+    if last - first + 1 > MAX_SERIAL_BATCH:
+        raise HTTPException(status_code=400, detail=f"Serial range {pattern} exceeds {MAX_SERIAL_BATCH} items")
+    width = len(first_digits)
+    return [f"{prefix}{n:0{width}d}" for n in range(first, last + 1)]
+
+def expand_serial_numbers(values: List[str]) -> List[str]:
+    """Serial list where any 'A..B' entry is expanded as a range"""
+    result = []
+    for value in values:
+        value = value.strip()
+        if '..' in value:
+            result.extend(expand_serial_range(value))
+        elif value:
+            result.append(value)
+    return result
+
+async def register_serials(
+    items: List[dict],
+    warehouse_id: str,
+    user_id: str,
+    reference_id: Optional[str] = None,
+    reference_number: Optional[str] = None,
+    note: Optional[str] = None,
+    session=None
+) -> List[dict]:
+    """Create in-stock serials ({serial_number, imei, product_id, cost_price}) with their receipt movements.
+    
+    Duplicates are found with one $in (the unique index on serial_number backs it up under races);
+    serials and movements are written with one insert_many each. A receipt (reference_id) takes over
+    serials of the same product registered ahead of it through /admin/serials, which carry no stock
+    and no receipt_id yet, instead of rejecting them as duplicates.
+    """
+    if len(items) > MAX_SERIAL_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SERIAL_BATCH} serials per batch")
+    
+    by_serial = {}
+    repeated = []
+    for item in items:
+        if item['serial_number'] in by_serial:
+            repeated.append(item['serial_number'])
+        by_serial[item['serial_number']] = item
+    
+    adopted = []
+    existing = []
+    async for s in db.serial_items.find(
+        {"serial_number": {"$in": list(by_serial)}},
+        {"_id": 0, "id": 1, "serial_number": 1, "product_id": 1, "warehouse_id": 1, "status": 1, "receipt_id": 1},
+        session=session
+    ):
+        if (reference_id and s['product_id'] == by_serial[s['serial_number']]['product_id']
+                and s['status'] == 'in_stock' and not s.get('receipt_id')
+                and s.get('warehouse_id') in (None, warehouse_id)):
+            adopted.append(s)
+        else:
+            existing.append(s['serial_number'])
+    
+    problems = []
+    for label, serials in (("Serial numbers listed more than once", repeated), ("Serial numbers already exist", existing)):
+        if serials:
+            shown = ", ".join(sorted(set(serials))[:20])
+            more = len(set(serials)) - 20
+            problems.append(f"{label}: {shown}" + (f" (+{more} more)" if more > 0 else ""))
+    raise_if_unavailable(problems)
+    
+    now = datetime.now(timezone.utc).isoformat()
+    adopted_ids = {s['serial_number']: s['id'] for s in adopted}
+    docs = []
+    updates = []
+    movements = []
+    for item in items:
+        serial_id = adopted_ids.get(item['serial_number'])
+        if serial_id:
+            updates.append(UpdateOne({"id": serial_id}, {"$set": {
+                "warehouse_id": warehouse_id,
+                "cost_price": item.get('cost_price', 0),
+                "receipt_id": reference_id,
+                "updated_at": now
+            }}))
+        else:
+            serial_id = str(uuid.uuid4())
+            docs.append({
+                "id": serial_id,
+                "serial_number": item['serial_number'],
+                "imei": item.get('imei'),
+                "product_id": item['product_id'],
+                "warehouse_id": warehouse_id,
+                "status": "in_stock",
+                "cost_price": item.get('cost_price', 0),
+                "receipt_id": reference_id,
+                "note": note,
+                "created_at": now,
+                "updated_at": now
+            })
+        movements.append(serial_movement_doc(
+            serial_id, "receipt", None, warehouse_id, reference_id, reference_number,
+            user_id, note or "Nhập kho", now
+        ))
+    
+    if docs:
+        await db.serial_items.insert_many(docs, session=session)
+    if updates:
+        await db.serial_items.bulk_write(updates, ordered=False, session=session)
+    if movements:
+        await db.serial_movements.insert_many(movements, session=session)
+    return docs
+
+async def bulk_receive_serials(
+    product_id: str,
+    warehouse_id: str,
+    items: List[dict],
+    cost_price: float,
+    note: Optional[str],
+    user: dict
+) -> dict:
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "track_serial": 1})
+    if not product:
+        raise HTTPException(status_code=400, detail="Product not found")
+    if not product.get('track_serial'):
+        raise HTTPException(status_code=400, detail="Product does not track serial numbers")
+    warehouse = await db.warehouses.find_one({"id": warehouse_id}, {"_id": 0, "id": 1})
+    if not warehouse:
+        raise HTTPException(status_code=400, detail="Warehouse not found")
+    if not items:
+        raise HTTPException(status_code=400, detail="No serial numbers given")
+    
+    for item in items:
+        item['product_id'] = product_id
+        item['cost_price'] = cost_price
+    docs = await run_in_transaction(lambda session: register_serials(
+        items, warehouse_id, user['id'], note=note or "Nhập kho ban đầu", session=session
+    ))
+    return {"message": f"Created {len(docs)} serial items", "created": len(docs)}
+
+@api_router.post("/admin/serials/bulk")
+async def create_serial_items_bulk(data: SerialBulkCreate, user: dict = Depends(get_current_user)):
+    """Register many serials at once from a list and/or a range like DX50-2026-0001..0800"""
+    serials = expand_serial_numbers(data.serial_numbers)
+    if data.serial_range:
+        serials.extend(expand_serial_range(data.serial_range))
+    return await bulk_receive_serials(
+        data.product_id, data.warehouse_id, [{"serial_number": sn} for sn in serials],
+        data.cost_price, data.note, user
+    )
+
+@api_router.post("/admin/serials/bulk/upload")
+async def upload_serial_items(
+    file: UploadFile = File(...),
+    product_id: str = Form(...),
+    warehouse_id: str = Form(...),
+    cost_price: float = Form(0),
+    note: Optional[str] = Form(None),
+    user: dict = Depends(get_current_user)
+):
+    """Register serials from a scanner export: one 'serial[,imei]' per line (CSV, TSV or plain text)"""
+    content = (await file.read()).decode('utf-8-sig', errors='replace')
+    items = []
+    for row in csv.reader(io.StringIO(content.replace('\t', ',').replace(';', ','))):
+        cells = [c.strip() for c in row]
+        if not cells or not cells[0] or cells[0].lower() in ('serial', 'serial_number', 'sn'):
+            continue
+        if '..' in cells[0]:
+            items.extend({"serial_number": sn} for sn in expand_serial_range(cells[0]))
+        else:
+            items.append({"serial_number": cells[0], "imei": cells[1] if len(cells) > 1 and cells[1] else None})
+    return await bulk_receive_serials(product_id, warehouse_id, items, cost_price, note, user)
+
+def serial_movement_doc(
     serial_id: str,
     movement_type: str,
     from_warehouse_id: Optional[str],
@@ -1665,10 +3114,11 @@ async def create_serial_movement(
     reference_id: Optional[str],
     reference_number: Optional[str],
     created_by: str,
-    note: Optional[str] = None
-):
-    """Create serial movement record"""
-    movement = {
+    note: Optional[str] = None,
+    now: Optional[str] = None
+) -> dict:
+    """Build a serial movement record (for insert_one or batched insert_many)"""
+    return {
         "id": str(uuid.uuid4()),
         "serial_id": serial_id,
         "movement_type": movement_type,
@@ -1678,9 +3128,26 @@ async def create_serial_movement(
         "reference_number": reference_number,
         "note": note,
         "created_by": created_by,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": now or datetime.now(timezone.utc).isoformat()
     }
-    await db.serial_movements.insert_one(movement)
+
+async def create_serial_movement(
+    serial_id: str,
+    movement_type: str,
+    from_warehouse_id: Optional[str],
+    to_warehouse_id: Optional[str],
+    reference_id: Optional[str],
+    reference_number: Optional[str],
+    created_by: str,
+    note: Optional[str] = None,
+    session=None
+):
+    """Create serial movement record"""
+    movement = serial_movement_doc(
+        serial_id, movement_type, from_warehouse_id, to_warehouse_id,
+        reference_id, reference_number, created_by, note
+    )
+    await db.serial_movements.insert_one(movement, session=session)
 
 @api_router.get("/admin/serials/{serial_id}/movements", response_model=List[SerialMovementResponse])
 async def get_serial_movements(serial_id: str, user: dict = Depends(get_current_user)):
@@ -1699,7 +3166,396 @@ async def get_serial_movements(serial_id: str, user: dict = Depends(get_current_
     
     return result
 
+# ==================== STOCKTAKE ====================
+# A stocktake freezes the expected quantity of every product in a warehouse into stocktake_lines,
+# accumulates scans into the same rows, and posts the variance as a single adjustment document.
+
+STOCKTAKE_INSERT_BATCH = 5000
+
+@api_router.post("/admin/stocktakes")
+async def create_stocktake(data: StocktakeCreate, user: dict = Depends(get_current_user)):
+    """Open a stocktake and freeze the expected quantities"""
+    warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0, "id": 1, "name": 1})
+    if not warehouse:
+        raise HTTPException(status_code=400, detail="Warehouse not found")
+    
+    query = {"warehouse_id": data.warehouse_id, "quantity": {"$ne": 0}}
+    product_ids = list(data.product_ids)
+    if data.category_id:
+        product_ids += [
+            p['id'] for p in await db.products.find({"category_id": data.category_id}, {"_id": 0, "id": 1}).to_list(None)
+        ]
+    if data.category_id or data.product_ids:
+        query['product_id'] = {"$in": product_ids}
+    
+    stocktake_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    
+    # Stream the balances into frozen lines in insert_many batches (20k SKUs = a handful of round trips)
+    line_count = 0
+    batch = []
+    async for b in db.stock_balance.find(query, {"_id": 0, "product_id": 1, "quantity": 1, "avg_cost": 1}):
+        batch.append({
+            "stocktake_id": stocktake_id,
+            "product_id": b['product_id'],
+            "expected_qty": b['quantity'],
+            "avg_cost": b.get('avg_cost', 0),
+            "counted_qty": 0,
+            "serials": []
+        })
+        if len(batch) >= STOCKTAKE_INSERT_BATCH:
+            await db.stocktake_lines.insert_many(batch, ordered=False)
+            line_count += len(batch)
+            batch = []
+    if batch:
+        await db.stocktake_lines.insert_many(batch, ordered=False)
+        line_count += len(batch)
+    
+    stocktake = {
+        "id": stocktake_id,
+        "stocktake_number": await next_sequence('KK'),
+        "warehouse_id": data.warehouse_id,
+        "category_id": data.category_id,
+        "product_ids": data.product_ids,
+        "status": "counting",
+        "note": data.note,
+        "line_count": line_count,
+        "scan_count": 0,
+        "frozen_at": now,
+        "adjustment_doc_id": None,
+        "created_by": user['id'],
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.stocktakes.insert_one(stocktake)
+    
+    stocktake.pop('_id', None)
+    stocktake['warehouse_name'] = warehouse['name']
+    return stocktake
+
+@api_router.get("/admin/stocktakes")
+async def list_stocktakes(
+    user: dict = Depends(get_current_user),
+    warehouse_id: Optional[str] = None,
+    status: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50
+):
+    query = {}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    if status:
+        query['status'] = status
+    stocktakes = await db.stocktakes.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    
+    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
+    for st in stocktakes:
+        st['warehouse_name'] = warehouses.get(st['warehouse_id'])
+    return stocktakes
+
+async def get_counting_stocktake(stocktake_id: str) -> dict:
+    stocktake = await db.stocktakes.find_one({"id": stocktake_id}, {"_id": 0})
+    if not stocktake:
+        raise HTTPException(status_code=404, detail="Stocktake not found")
+    if stocktake['status'] != 'counting':
+        raise HTTPException(status_code=400, detail="Stocktake is already posted or cancelled")
+    return stocktake
+
+@api_router.post("/admin/stocktakes/{stocktake_id}/scans")
+async def record_stocktake_scans(stocktake_id: str, data: StocktakeScanBatch, user: dict = Depends(get_current_user)):
+    """Apply a batch of scans: codes are resolved with two $in reads, counts with one bulk write.
+    
+    Serials are kept as a set per product, so scanning the same unit twice counts it once. Scans that
+    cannot be counted are returned under rejected: products outside the stocktake's scope, serials that
+    are not in stock in this warehouse, and serial-tracked products scanned by SKU/barcode.
+    """
+    stocktake = await get_counting_stocktake(stocktake_id)
+    codes = list({scan.code.strip() for scan in data.scans if scan.code.strip()})
+    
+    serials = {}
+    for s in await db.serial_items.find(
+        {"$or": [{"serial_number": {"$in": codes}}, {"imei": {"$in": codes}}]},
+        {"_id": 0, "serial_number": 1, "imei": 1, "product_id": 1, "warehouse_id": 1, "status": 1}
+    ).to_list(None):
+        serials[s['serial_number']] = s
+        if s.get('imei'):
+            serials[s['imei']] = s
+    # Products by scanned code, plus the products behind scanned serials for the scope check
+    products = {}
+    codes_to_products = {}
+    for p in await db.products.find(
+        {"$or": [
+            {"barcode": {"$in": codes}},
+            {"sku": {"$in": codes}},
+            {"id": {"$in": list({s['product_id'] for s in serials.values()})}}
+        ]},
+        {"_id": 0, "id": 1, "barcode": 1, "sku": 1, "category_id": 1, "track_serial": 1}
+    ).to_list(None):
+        products[p['id']] = p
+        codes_to_products[p['sku']] = p
+        if p.get('barcode'):
+            codes_to_products[p['barcode']] = p
+    
+    scoped = stocktake.get('category_id') or stocktake.get('product_ids')
+    
+    def in_scope(product: Optional[dict]) -> bool:
+        if not scoped:
+            return True
+        return product is not None and (
+            product['id'] in (stocktake.get('product_ids') or [])
+            or (stocktake.get('category_id') and product.get('category_id') == stocktake['category_id'])
+        )
+    
+    quantities = {}
+    scanned_serials = {}
+    unknown = []
+    rejected = []
+    for scan in data.scans:
+        code = scan.code.strip()
+        if code in serials:
+            serial = serials[code]
+            if not in_scope(products.get(serial['product_id'])):
+                rejected.append({"code": code, "reason": "Product is outside the stocktake scope"})
+            elif serial['status'] != 'in_stock' or serial.get('warehouse_id') != stocktake['warehouse_id']:
+                rejected.append({"code": code, "reason": "Serial is not in stock in this warehouse"})
+            else:
+                scanned_serials.setdefault(serial['product_id'], set()).add(serial['serial_number'])
+        elif code in codes_to_products:
+            product = codes_to_products[code]
+            if not in_scope(product):
+                rejected.append({"code": code, "reason": "Product is outside the stocktake scope"})
+            elif product.get('track_serial'):
+                rejected.append({"code": code, "reason": "Product tracks serial numbers; scan each unit's serial"})
+            else:
+                quantities[product['id']] = quantities.get(product['id'], 0) + scan.quantity
+        else:
+            unknown.append(code)
+    
+    operations = []
+    for product_id in set(quantities) | set(scanned_serials):
+        update = {"$setOnInsert": {"expected_qty": 0, "avg_cost": 0}}
+        if product_id in quantities:
+            update['$inc'] = {"counted_qty": quantities[product_id]}
+        else:
+            update['$setOnInsert']['counted_qty'] = 0
+        if product_id in scanned_serials:
+            update['$addToSet'] = {"serials": {"$each": sorted(scanned_serials[product_id])}}
+        else:
+            update['$setOnInsert']['serials'] = []
+        operations.append(UpdateOne({"stocktake_id": stocktake_id, "product_id": product_id}, update, upsert=True))
+    if operations:
+        await db.stocktake_lines.bulk_write(operations, ordered=False)
+    
+    accepted = len(data.scans) - len(unknown) - len(rejected)
+    await db.stocktakes.update_one(
+        {"id": stocktake['id']},
+        {"$inc": {"scan_count": accepted}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    return {"accepted": accepted, "unknown": unknown, "rejected": rejected}
+
+def stocktake_variance_stages() -> list:
+    """counted = counted_qty + distinct serials; variance against the frozen expected_qty"""
+    return [
+        {"$addFields": {"counted": {"$add": ["$counted_qty", {"$size": {"$ifNull": ["$serials", []]}}]}}},
+        {"$addFields": {"variance": {"$subtract": ["$counted", "$expected_qty"]}}},
+        {"$addFields": {"variance_value": {"$multiply": ["$variance", "$avg_cost"]}}}
+    ]
+
+@api_router.get("/admin/stocktakes/{stocktake_id}/variance")
+async def get_stocktake_variance(
+    stocktake_id: str,
+    user: dict = Depends(get_current_user),
+    only_differences: bool = True,
+    skip: int = 0,
+    limit: int = Query(200, ge=1, le=5000)
+):
+    """Variance report: per-product expected vs counted, largest value differences first, plus totals"""
+    stocktake = await db.stocktakes.find_one({"id": stocktake_id}, {"_id": 0})
+    if not stocktake:
+        raise HTTPException(status_code=404, detail="Stocktake not found")
+    
+    pipeline = [
+        {"$match": {"stocktake_id": stocktake_id}},
+        *stocktake_variance_stages(),
+        {"$facet": {
+            "items": [
+                {"$match": {"variance": {"$ne": 0}} if only_differences else {}},
+                {"$addFields": {"abs_value": {"$abs": "$variance_value"}}},
+                {"$sort": {"abs_value": -1, "product_id": 1}},
+                {"$skip": skip},
+                {"$limit": limit},
+                {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "id", "as": "product"}},
+                {"$project": {
+                    "_id": 0,
+                    "product_id": 1,
+                    "product_name": {"$ifNull": [{"$arrayElemAt": ["$product.name", 0]}, ""]},
+                    "product_sku": {"$ifNull": [{"$arrayElemAt": ["$product.sku", 0]}, ""]},
+                    "expected_qty": 1,
+                    "counted": 1,
+                    "variance": 1,
+                    "avg_cost": 1,
+                    "variance_value": 1
+                }}
+            ],
+            "summary": [
+                {"$group": {
+                    "_id": None,
+                    "line_count": {"$sum": 1},
+                    "counted_lines": {"$sum": {"$cond": [{"$gt": ["$counted", 0]}, 1, 0]}},
+                    "variance_lines": {"$sum": {"$cond": [{"$ne": ["$variance", 0]}, 1, 0]}},
+                    "expected_qty": {"$sum": "$expected_qty"},
+                    "counted_qty": {"$sum": "$counted"},
+                    "surplus_value": {"$sum": {"$cond": [{"$gt": ["$variance", 0]}, "$variance_value", 0]}},
+                    "shortage_value": {"$sum": {"$cond": [{"$lt": ["$variance", 0]}, "$variance_value", 0]}},
+                    "net_value": {"$sum": "$variance_value"}
+                }},
+                {"$project": {"_id": 0}}
+            ]
+        }}
+    ]
+    result = (await db.stocktake_lines.aggregate(pipeline).to_list(1))[0]
+    
+    return {
+        "stocktake": stocktake,
+        "summary": result['summary'][0] if result['summary'] else {},
+        "items": result['items']
+    }
+
+@api_router.post("/admin/stocktakes/{stocktake_id}/post")
+async def post_stocktake(stocktake_id: str, user: dict = Depends(require_admin)):
+    """Post all variances as one adjustment document (applied as deltas to the current balance)"""
+    stocktake = await get_counting_stocktake(stocktake_id)
+    variances = await db.stocktake_lines.aggregate([
+        {"$match": {"stocktake_id": stocktake_id}},
+        *stocktake_variance_stages(),
+        {"$match": {"variance": {"$ne": 0}}},
+        {"$project": {"_id": 0, "product_id": 1, "variance": 1, "avg_cost": 1, "variance_value": 1}}
+    ]).to_list(None)
+    
+    doc_id = str(uuid.uuid4())
+    doc_number = await generate_doc_number('adjustment') if variances else None
+    
+    async def post(session):
+        now = datetime.now(timezone.utc).isoformat()
+        result = await db.stocktakes.update_one(
+            {"id": stocktake_id, "status": "counting"},
+            {"$set": {"status": "posted", "posted_at": now, "adjustment_doc_id": doc_id if variances else None,
+                      "adjustment_doc_number": doc_number, "updated_at": now}},
+            session=session
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Stocktake is already posted or cancelled")
+        if not variances:
+            return {"message": "Stocktake posted, no variances", "doc_number": None}
+        
+        # Adjustment lines carry the target quantity; goods moved since freezing stay accounted for
+        balances = await load_stock_balances([v['product_id'] for v in variances], [stocktake['warehouse_id']], session)
+        lines = []
+        for v in variances:
+            balance = balances.get((v['product_id'], stocktake['warehouse_id']))
+            current = balance['quantity'] if balance else 0
+            lines.append({
+                "id": str(uuid.uuid4()),
+                "product_id": v['product_id'],
+                "quantity": max(current + v['variance'], 0),
+                "unit_cost": v['avg_cost'],
+                # Signed variance value, so the journal books the net surplus/shortage
+                "total_cost": v['variance_value'],
+                "note": f"Kiểm kê {stocktake['stocktake_number']}: chênh lệch {v['variance']:+d}",
+                "serial_numbers": []
+            })
+        await db.inventory_docs.insert_one({
+            "id": doc_id,
+            "doc_number": doc_number,
+            "doc_type": "adjustment",
+            "warehouse_id": stocktake['warehouse_id'],
+            "dest_warehouse_id": None,
+            "reference": stocktake['stocktake_number'],
+            "note": f"Điều chỉnh theo kiểm kê {stocktake['stocktake_number']}",
+            "status": "draft",
+            "lines": lines,
+            "total_items": sum(l['quantity'] for l in lines),
+            "total_value": sum(l['total_cost'] for l in lines),
+            "created_by": user['id'],
+            "posted_at": None,
+            "created_at": now,
+            "updated_at": now
+        }, session=session)
+        await post_inventory_doc_in_session(doc_id, user, session)
+        return {"message": f"Stocktake posted with {len(lines)} adjusted products", "doc_number": doc_number}
+    
+    return await run_in_transaction(post)
+
+@api_router.post("/admin/stocktakes/{stocktake_id}/cancel")
+async def cancel_stocktake(stocktake_id: str, user: dict = Depends(require_admin)):
+    stocktake = await get_counting_stocktake(stocktake_id)
+    now = datetime.now(timezone.utc).isoformat()
+    await db.stocktakes.update_one(
+        {"id": stocktake['id'], "status": "counting"},
+        {"$set": {"status": "cancelled", "updated_at": now}}
+    )
+    await db.stocktake_lines.delete_many({"stocktake_id": stocktake_id})
+    return {"message": "Stocktake cancelled"}
+
 # ==================== CUSTOMER ROUTES ====================
+# Phones are stored in E.164 (unique index). phone_national and phone_last4 are indexed shadow
+# fields so counter typeahead can match a number prefix or the last four digits without a scan.
+
+DEFAULT_PHONE_COUNTRY_CODE = os.environ.get('DEFAULT_PHONE_COUNTRY_CODE', '84')
+PHONE_SEARCH_PATTERN = re.compile(r'^\+?[\d\s.\-()]+$')
+
+# Short-lived so the overview reflects new orders within seconds without invalidation plumbing
+customer_overview_cache = LRUCache(maxsize=512, ttl=30)
+
+def normalize_phone(raw: str) -> Optional[str]:
+    """E.164 form of a phone number ("0826.123.678" -> "+84826123678"), or None if it is not one"""
+    raw = (raw or '').strip()
+    digits = re.sub(r'\D', '', raw)
+    if raw.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        # National trunk prefix
+        digits = DEFAULT_PHONE_COUNTRY_CODE + digits[1:]
+    elif not digits.startswith(DEFAULT_PHONE_COUNTRY_CODE) or len(digits) < 11:
+        digits = DEFAULT_PHONE_COUNTRY_CODE + digits
+    if digits.startswith(DEFAULT_PHONE_COUNTRY_CODE + '0'):
+        # Trunk 0 kept after the country code ("+84 0826...") is dropped, as when dialling
+        digits = DEFAULT_PHONE_COUNTRY_CODE + digits[len(DEFAULT_PHONE_COUNTRY_CODE) + 1:]
+    if not 8 <= len(digits) <= 15:
+        return None
+    return '+' + digits
+
+def national_phone(e164: str) -> str:
+    """Number as dialled locally, e.g. "+84826123678" -> "0826123678" """
+    if e164.startswith('+' + DEFAULT_PHONE_COUNTRY_CODE):
+        return '0' + e164[1 + len(DEFAULT_PHONE_COUNTRY_CODE):]
+    return e164[1:]
+
+def phone_fields(raw: str) -> dict:
+    phone = normalize_phone(raw)
+    if not phone:
+        raise HTTPException(status_code=400, detail=f"Invalid phone number {raw}")
+    return {"phone": phone, "phone_national": national_phone(phone), "phone_last4": phone[-4:]}
+
+def phone_duplicate_query(raw: str, phones: dict) -> dict:
+    """Customers holding this number, including ones not yet rewritten by the phone backfill"""
+    return {"phone": {"$in": list({phones['phone'], phones['phone_national'], raw.strip()})}}
+
+def phone_search_query(search: str) -> Optional[dict]:
+    """Indexed query for a phone-like search: exact last 4 digits or a number prefix"""
+    if not PHONE_SEARCH_PATTERN.match(search):
+        return None
+    digits = re.sub(r'\D', '', search)
+    if len(digits) < 3:
+        return None
+    if search.strip().startswith('+'):
+        return {"phone": {"$regex": f"^\\+{digits}"}}
+    prefix = {"phone_national": {"$regex": f"^{digits}"}}
+    if len(digits) == 4:
+        return {"$or": [{"phone_last4": digits}, prefix]}
+    return prefix
 
 @api_router.get("/admin/customers", response_model=List[CustomerResponse])
 async def list_customers(
@@ -1709,14 +3565,22 @@ async def list_customers(
     limit: int = 100
 ):
     query = {}
-    if search:
+    sort_field = "created_at"
+    phone_query = phone_search_query(search) if search else None
+    if phone_query:
+        # Typeahead by phone walks the phone_national index in order instead of sorting matches
+        query = phone_query
+        sort_field = "phone_national"
+    elif search:
         query['$or'] = [
             {'name': {'$regex': search, '$options': 'i'}},
             {'phone': {'$regex': search, '$options': 'i'}},
             {'email': {'$regex': search, '$options': 'i'}}
         ]
     
-    customers = await db.customers.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    customers = await db.customers.find(query, {"_id": 0}).sort(
+        sort_field, 1 if phone_query else -1
+    ).skip(skip).limit(limit).to_list(limit)
     return [CustomerResponse(**c) for c in customers]
 
 @api_router.get("/admin/customers/{customer_id}", response_model=CustomerResponse)
@@ -1728,8 +3592,9 @@ async def get_customer(customer_id: str, user: dict = Depends(get_current_user))
 
 @api_router.post("/admin/customers", response_model=CustomerResponse)
 async def create_customer(data: CustomerCreate, user: dict = Depends(get_current_user)):
+    phones = phone_fields(data.phone)
     # Check phone unique
-    existing = await db.customers.find_one({"phone": data.phone})
+    existing = await db.customers.find_one(phone_duplicate_query(data.phone, phones), {"_id": 1})
     if existing:
         raise HTTPException(status_code=400, detail="Phone number already registered")
     
@@ -1739,6 +3604,7 @@ async def create_customer(data: CustomerCreate, user: dict = Depends(get_current
     doc = {
         "id": customer_id,
         **data.model_dump(),
+        **phones,
         "total_orders": 0,
         "total_spent": 0,
         "is_active": True,
@@ -1746,16 +3612,27 @@ async def create_customer(data: CustomerCreate, user: dict = Depends(get_current
         "updated_at": now
     }
     
-    await db.customers.insert_one(doc)
+    try:
+        await db.customers.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
     return CustomerResponse(**{k: v for k, v in doc.items() if k != '_id'})
 
 @api_router.put("/admin/customers/{customer_id}", response_model=CustomerResponse)
 async def update_customer(customer_id: str, data: CustomerCreate, user: dict = Depends(get_current_user)):
-    result = await db.customers.find_one_and_update(
-        {"id": customer_id},
-        {"$set": {**data.model_dump(), "updated_at": datetime.now(timezone.utc).isoformat()}},
-        return_document=True
-    )
+    phones = phone_fields(data.phone)
+    existing = await db.customers.find_one({**phone_duplicate_query(data.phone, phones), "id": {"$ne": customer_id}}, {"_id": 1})
+    if existing:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
+    try:
+        result = await db.customers.find_one_and_update(
+            {"id": customer_id},
+            {"$set": {**data.model_dump(), **phones, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            return_document=True
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Phone number already registered")
+    customer_overview_cache.delete(customer_id)
     if not result:
         raise HTTPException(status_code=404, detail="Customer not found")
     return CustomerResponse(**{k: v for k, v in result.items() if k != '_id'})
@@ -1770,18 +3647,128 @@ async def delete_customer(customer_id: str, user: dict = Depends(require_admin))
     result = await db.customers.delete_one({"id": customer_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Customer not found")
+    customer_overview_cache.delete(customer_id)
     return {"message": "Customer deleted"}
 
+async def customer_order_summary(customer_id: str) -> dict:
+    rows = await db.sales_orders.aggregate([
+        {"$match": {"customer_id": customer_id}},
+        {"$group": {
+            "_id": "$status",
+            "count": {"$sum": 1},
+            "amount": {"$sum": "$total_amount"},
+            "first_at": {"$min": "$created_at"},
+            "last_at": {"$max": "$created_at"}
+        }}
+    ]).to_list(None)
+    completed = next((r for r in rows if r['_id'] == 'completed'), None)
+    return {
+        "by_status": {r['_id']: {"count": r['count'], "amount": r['amount']} for r in rows},
+        "total_orders": sum(r['count'] for r in rows),
+        "lifetime_value": completed['amount'] if completed else 0,
+        "first_order_at": min((r['first_at'] for r in rows), default=None),
+        "last_order_at": max((r['last_at'] for r in rows), default=None)
+    }
+
+async def customer_recent_orders(customer_id: str, limit: int = 10) -> List[dict]:
+    return await db.sales_orders.find(
+        {"customer_id": customer_id},
+        {"_id": 0, "id": 1, "order_number": 1, "status": 1, "total_items": 1, "total_amount": 1,
+         "warehouse_id": 1, "created_at": 1, "completed_at": 1}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+
+async def customer_active_warranties(customer_id: str, now: str) -> List[dict]:
+    serials = await db.serial_items.find(
+        {"customer_id": customer_id, "status": "sold", "warranty_end": {"$gt": now}},
+        {"_id": 0, "id": 1, "serial_number": 1, "imei": 1, "product_id": 1, "sale_order_id": 1,
+         "warranty_start": 1, "warranty_end": 1}
+    ).sort("warranty_end", 1).to_list(500)
+    names = {p['id']: p['name'] for p in await db.products.find(
+        {"id": {"$in": list({s['product_id'] for s in serials})}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(None)} if serials else {}
+    for serial in serials:
+        serial['product_name'] = names.get(serial['product_id'])
+    return serials
+
+async def customer_open_repairs(customer_id: str) -> List[dict]:
+    return await db.repair_tickets.find(
+        {"customer_id": customer_id, "status": {"$nin": ["delivered", "cancelled"]}},
+        {"_id": 0, "id": 1, "ticket_number": 1, "product_name": 1, "serial_number": 1, "status": 1,
+         "priority": 1, "total_estimate": 1, "created_at": 1}
+    ).sort("created_at", -1).to_list(100)
+
+@api_router.get("/admin/customers/{customer_id}/overview")
+async def get_customer_overview(customer_id: str, user: dict = Depends(get_current_user)):
+    """Customer 360: profile, order summary, active warranties and open repairs fetched concurrently"""
+    cached = customer_overview_cache.get(customer_id)
+    if cached is not None:
+        return cached
+    
+    now = datetime.now(timezone.utc).isoformat()
+    customer, summary, recent_orders, warranties, repairs = await asyncio.gather(
+        db.customers.find_one({"id": customer_id}, {"_id": 0}),
+        customer_order_summary(customer_id),
+        customer_recent_orders(customer_id),
+        customer_active_warranties(customer_id, now),
+        customer_open_repairs(customer_id)
+    )
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    
+    overview = {
+        "customer": CustomerResponse(**customer).model_dump(),
+        "orders": summary,
+        "recent_orders": recent_orders,
+        "active_warranties": warranties,
+        "open_repairs": repairs,
+        "generated_at": now
+    }
+    customer_overview_cache.set(customer_id, overview)
+    return overview
+
+async def normalize_customer_phones(progress=None) -> dict:
+    """Backfill E.164 phones and shadow fields; numbers that collide or do not parse are left for review"""
+    groups = {}
+    invalid = []
+    async for customer in db.customers.find({}, {"_id": 0, "id": 1, "name": 1, "phone": 1}):
+        phone = normalize_phone(customer.get('phone'))
+        if phone:
+            groups.setdefault(phone, []).append(customer)
+        else:
+            invalid.append({"id": customer['id'], "name": customer.get('name'), "phone": customer.get('phone')})
+    
+    now = datetime.now(timezone.utc).isoformat()
+    updates = []
+    duplicates = []
+    for phone, customers in groups.items():
+        if len(customers) > 1:
+            duplicates.append({"phone": phone, "customers": [
+                {"id": c['id'], "name": c.get('name'), "phone": c.get('phone')} for c in customers
+            ]})
+            continue
+        updates.append(UpdateOne(
+            {"id": customers[0]['id']},
+            {"$set": {**phone_fields(phone), "updated_at": now}}
+        ))
+    
+    for start in range(0, len(updates), 1000):
+        await db.customers.bulk_write(updates[start:start + 1000], ordered=False)
+        if progress:
+            await progress(min(start + 1000, len(updates)), len(updates), "Updating customers")
+    return {"normalized": len(updates), "duplicates": duplicates, "invalid": invalid}
+
+@api_router.post("/admin/customers/normalize-phones")
+async def normalize_customer_phones_route(run_async: bool = Query(False, alias="async"), user: dict = Depends(require_admin)):
+    """Rewrite stored phones to E.164; duplicates and invalid numbers are reported, not changed"""
+    if run_async:
+        return await submit_job('normalize_customer_phones', {}, user)
+    return await normalize_customer_phones()
+
 # ==================== SALES ORDER ROUTES ====================
 
 async def generate_order_number() -> str:
     """Generate order number like SO-20240206-001"""
-    date_str = datetime.now(timezone.utc).strftime('%Y%m%d')
-    start_of_day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    count = await db.sales_orders.count_documents({
-        "created_at": {"$gte": start_of_day.isoformat()}
-    })
-    return f"SO-{date_str}-{str(count + 1).zfill(3)}"
+    return await next_sequence('SO')
 
 @api_router.get("/admin/sales/orders", response_model=List[SalesOrderResponse])
 async def list_sales_orders(
@@ -1846,60 +3833,63 @@ async def get_sales_order(order_id: str, user: dict = Depends(get_current_user))
     
     return SalesOrderResponse(**order)
 
-@api_router.post("/admin/sales/orders", response_model=SalesOrderResponse)
-async def create_sales_order(data: SalesOrderCreate, user: dict = Depends(get_current_user)):
-    # Validate customer
-    customer = await db.customers.find_one({"id": data.customer_id}, {"_id": 0})
-    if not customer:
-        raise HTTPException(status_code=400, detail="Customer not found")
-    
-    # Validate warehouse
-    warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0})
-    if not warehouse:
-        raise HTTPException(status_code=400, detail="Warehouse not found")
-    
-    order_id = str(uuid.uuid4())
-    order_number = await generate_order_number()
-    now = datetime.now(timezone.utc).isoformat()
-    
-    # Process lines
+def build_order_lines(data: SalesOrderCreate, products: dict):
+    """Order lines priced in memory, plus availability items and a problem per unknown product"""
     lines = []
-    total_items = 0
-    total_amount = 0
+    stock_items = []
+    problems = []
     
-    for line_data in data.lines:
-        product = await db.products.find_one({"id": line_data.product_id}, {"_id": 0})
+    for index, line_data in enumerate(data.lines, start=1):
+        product = products.get(line_data.product_id)
         if not product:
-            raise HTTPException(status_code=400, detail=f"Product {line_data.product_id} not found")
-        
-        # Validate serial numbers if product tracks serial
-        if product.get('track_serial') and line_data.serial_numbers:
-            for sn in line_data.serial_numbers:
-                serial = await db.serial_items.find_one({
-                    "serial_number": sn,
-                    "product_id": line_data.product_id,
-                    "warehouse_id": data.warehouse_id,
-                    "status": "in_stock"
-                }, {"_id": 0})
-                if not serial:
-                    raise HTTPException(status_code=400, detail=f"Serial {sn} not available in warehouse")
+            problems.append(f"Line {index}: product {line_data.product_id} not found")
+            continue
         
-        line_id = str(uuid.uuid4())
-        line_total = line_data.quantity * line_data.unit_price
+        if product.get('product_type') != 'service':
+            stock_items.append({
+                "product_id": line_data.product_id,
+                "warehouse_id": data.warehouse_id,
+                "quantity": line_data.quantity,
+                "serial_numbers": line_data.serial_numbers if product.get('track_serial') else []
+            })
         
         lines.append({
-            "id": line_id,
+            "id": str(uuid.uuid4()),
             "product_id": line_data.product_id,
             "quantity": line_data.quantity,
             "unit_price": line_data.unit_price,
-            "total_price": line_total,
+            "total_price": line_data.quantity * line_data.unit_price,
             "serial_numbers": line_data.serial_numbers,
             "note": line_data.note
         })
-        
-        total_items += line_data.quantity
-        total_amount += line_total
     
+    return lines, stock_items, problems
+
+@api_router.post("/admin/sales/orders", response_model=SalesOrderResponse)
+async def create_sales_order(data: SalesOrderCreate, user: dict = Depends(get_current_user)):
+    product_ids = list({line.product_id for line in data.lines})
+    customer, warehouse, product_list = await asyncio.gather(
+        db.customers.find_one({"id": data.customer_id}, {"_id": 0}),
+        db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0}),
+        db.products.find(
+            {"id": {"$in": product_ids}},
+            {"_id": 0, "id": 1, "product_type": 1, "track_serial": 1}
+        ).to_list(len(product_ids))
+    )
+    if not customer:
+        raise HTTPException(status_code=400, detail="Customer not found")
+    if not warehouse:
+        raise HTTPException(status_code=400, detail="Warehouse not found")
+    products = {p['id']: p for p in product_list}
+    
+    order_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    
+    lines, stock_items, problems = build_order_lines(data, products)
+    problems.extend(await check_availability(stock_items))
+    raise_if_unavailable(problems)
+    
+    order_number = await generate_order_number()
     order = {
         "id": order_id,
         "order_number": order_number,
@@ -1907,8 +3897,8 @@ async def create_sales_order(data: SalesOrderCreate, user: dict = Depends(get_cu
         "warehouse_id": data.warehouse_id,
         "status": "draft",
         "lines": lines,
-        "total_items": total_items,
-        "total_amount": total_amount,
+        "total_items": sum(line['quantity'] for line in lines),
+        "total_amount": sum(line['total_price'] for line in lines),
         "note": data.note,
         "created_by": user['id'],
         "confirmed_at": None,
@@ -1929,7 +3919,25 @@ async def create_sales_order(data: SalesOrderCreate, user: dict = Depends(get_cu
 @api_router.post("/admin/sales/orders/{order_id}/confirm")
 async def confirm_sales_order(order_id: str, user: dict = Depends(get_current_user)):
     """Confirm order - reserves stock but doesn't complete"""
-    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0})
+    return await run_in_transaction(lambda session: confirm_sales_order_in_session(order_id, session))
+
+def order_stock_items(order: dict, products: dict) -> List[dict]:
+    """Stock-tracked lines of an order as availability items"""
+    return [
+        {
+            "product_id": line['product_id'],
+            "warehouse_id": order['warehouse_id'],
+            "quantity": line['quantity'],
+            "serial_numbers": (line.get('serial_numbers') or [])
+            if products.get(line['product_id'], {}).get('track_serial') else []
+        }
+        for line in order['lines']
+        if products.get(line['product_id'], {}).get('product_type') != 'service'
+    ]
+
+async def confirm_sales_order_in_session(order_id: str, session=None):
+    """Check availability and reserve every line of a draft order"""
+    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0}, session=session)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
@@ -1937,113 +3945,233 @@ async def confirm_sales_order(order_id: str, user: dict = Depends(get_current_us
         raise HTTPException(status_code=400, detail="Order is not in draft status")
     
     now = datetime.now(timezone.utc).isoformat()
+    product_ids = list({line['product_id'] for line in order['lines']})
+    products = {
+        p['id']: p for p in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "product_type": 1, "track_serial": 1}, session=session
+        ).to_list(None)
+    }
+    
+    items = order_stock_items(order, products)
+    raise_if_unavailable(await check_availability(items, session))
+    reserved_until = await reserve_stock(order, items, now, session)
     
-    await db.sales_orders.update_one(
-        {"id": order_id},
-        {"$set": {"status": "confirmed", "confirmed_at": now, "updated_at": now}}
+    result = await db.sales_orders.update_one(
+        {"id": order_id, "status": "draft"},
+        {"$set": {"status": "confirmed", "confirmed_at": now, "reserved_until": reserved_until, "updated_at": now}},
+        session=session
     )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Order is not in draft status")
     
-    return {"message": "Order confirmed", "order_number": order['order_number']}
+    return {"message": "Order confirmed", "order_number": order['order_number'], "reserved_until": reserved_until}
 
 @api_router.post("/admin/sales/orders/{order_id}/complete")
-async def complete_sales_order(order_id: str, user: dict = Depends(get_current_user)):
-    """Complete order - deducts stock and activates warranty"""
-    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0})
+async def complete_sales_order(
+    order_id: str,
+    run_async: bool = Query(False, alias="async"),
+    user: dict = Depends(get_current_user)
+):
+    """Complete order - deducts stock and activates warranty. With async=true, returns a job id instead."""
+    if run_async:
+        return await submit_job('complete_sales_order', {"order_id": order_id}, user)
+    return await run_in_transaction(lambda session: complete_sales_order_in_session(order_id, user, session))
+
+async def complete_sales_order_in_session(order_id: str, user: dict, session=None):
+    """Deduct stock, sell serials, update customer stats and post the sales journal"""
+    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0}, session=session)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
     if order['status'] not in ['draft', 'confirmed']:
         raise HTTPException(status_code=400, detail="Order cannot be completed")
     
+    customer = await db.customers.find_one({"id": order['customer_id']}, {"_id": 0}, session=session)
+    product_ids = list({line['product_id'] for line in order['lines']})
+    products = {
+        p['id']: p for p in await db.products.find({"id": {"$in": product_ids}}, {"_id": 0}, session=session).to_list(None)
+    }
+    await complete_order(order, customer, products, user, session)
+    
+    return {"message": "Order completed, warranty activated", "order_number": order['order_number']}
+
+async def complete_order(order: dict, customer: Optional[dict], products: dict, user: dict, session=None, new_order: bool = False):
+    """Deduct stock, sell serials, update customer stats and post the sales journal for a loaded order.
+    With new_order the order is inserted as completed instead of moving an existing draft/confirmed one."""
+    order_id = order['id']
     now = datetime.now(timezone.utc).isoformat()
-    customer = await db.customers.find_one({"id": order['customer_id']}, {"_id": 0})
     
-    # Calculate total cost of goods for journal entry
+    # The order's own reservation turns into the actual deduction below
+    if not new_order:
+        await release_reservations({"order_id": order_id}, "consumed", now, session)
+    
+    warehouse_id = order['warehouse_id']
+    product_ids = list({line['product_id'] for line in order['lines']})
+    balances = await load_stock_balances(product_ids, [warehouse_id], session)
+    cost_layers = await load_cost_layers(
+        [pid for pid, p in products.items() if p.get('costing_method') == 'fifo'], [warehouse_id], balances, session
+    )
+    
+    # Stock or serials may have moved since the order was created
+    raise_if_unavailable(await check_availability(order_stock_items(order, products), session, balances))
+    ledger_entries = []
+    
+    # Serial ids for every line in one read; transitions and movements are written once below
+    order_serials = [sn for line in order['lines'] for sn in line.get('serial_numbers') or []]
+    serial_ids = {}
+    if order_serials:
+        serial_ids = {
+            s['serial_number']: s['id'] for s in await db.serial_items.find(
+                {"serial_number": {"$in": order_serials}}, {"_id": 0, "id": 1, "serial_number": 1}, session=session
+            ).to_list(None)
+        }
+    serial_updates = []
+    serial_movements = []
+    movement_note = f"Bán cho {customer['name'] if customer else 'N/A'}"
+    
+    # Calculate total cost of goods for journal entry, and per line for the sales rollups
     total_cost_of_goods = 0
+    line_costs = []
     
     # Process each line
     for line in order['lines']:
         product_id = line['product_id']
         quantity = line['quantity']
-        warehouse_id = order['warehouse_id']
         
-        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        product = products.get(product_id)
         warranty_months = product.get('warranty_months', 0) if product else 0
         
-        # Get current avg_cost for COGS calculation
-        stock_balance = await db.stock_balance.find_one(
-            {"product_id": product_id, "warehouse_id": warehouse_id}, 
-            {"_id": 0, "avg_cost": 1}
-        )
-        avg_cost = stock_balance.get('avg_cost', 0) if stock_balance else 0
-        total_cost_of_goods += quantity * avg_cost
+        # Warranty runs from completion; same dates for every serial on the line
+        warranty_end = None
+        if warranty_months > 0:
+            warranty_end = (datetime.fromisoformat(now) + timedelta(days=warranty_months * 30)).isoformat()
         
-        # Process serial numbers
-        if line.get('serial_numbers'):
-            for sn in line['serial_numbers']:
-                serial = await db.serial_items.find_one({"serial_number": sn}, {"_id": 0})
-                if serial:
-                    # Calculate warranty dates
-                    warranty_start = now
-                    warranty_end = None
-                    if warranty_months > 0:
-                        warranty_end_date = datetime.now(timezone.utc) + timedelta(days=warranty_months * 30)
-                        warranty_end = warranty_end_date.isoformat()
-                    
-                    # Update serial status
-                    await db.serial_items.update_one(
-                        {"serial_number": sn},
-                        {"$set": {
-                            "status": "sold",
-                            "warehouse_id": None,
-                            "sale_price": line['unit_price'],
-                            "customer_id": order['customer_id'],
-                            "sale_order_id": order_id,
-                            "warranty_start": warranty_start,
-                            "warranty_end": warranty_end,
-                            "updated_at": now
-                        }}
-                    )
-                    
-                    # Create movement
-                    await create_serial_movement(
-                        serial['id'], "sale", warehouse_id, None,
-                        order_id, order['order_number'], user['id'],
-                        f"Bán cho {customer['name'] if customer else 'N/A'}"
-                    )
+        for sn in line.get('serial_numbers') or []:
+            if sn not in serial_ids:
+                continue
+            serial_updates.append(UpdateOne(
+                {"serial_number": sn},
+                {"$set": {
+                    "status": "sold",
+                    "warehouse_id": None,
+                    "sale_price": line['unit_price'],
+                    "customer_id": order['customer_id'],
+                    "sale_order_id": order_id,
+                    "warranty_start": now,
+                    "warranty_end": warranty_end,
+                    "updated_at": now
+                }}
+            ))
+            serial_movements.append(serial_movement_doc(
+                serial_ids[sn], "sale", warehouse_id, None, order_id, order['order_number'],
+                user['id'], movement_note, now
+            ))
         
-        # Update stock balance
-        await update_stock_balance(product_id, warehouse_id, -quantity, 0)
+        # Deduct stock in memory; balances and ledger rows are written once below.
+        # COGS is the consumed FIFO layers, or the current avg_cost for weighted-average products.
+        if product and product.get('costing_method') == 'fifo':
+            before, after, taken = move_fifo_stock(balances, cost_layers, product_id, warehouse_id, -quantity)
+            line_cost = layers_value(taken)
+        else:
+            line_cost = quantity * balances.get((product_id, warehouse_id), {}).get('avg_cost', 0)
+            before, after = move_stock(balances, product_id, warehouse_id, -quantity, 0)
+        total_cost_of_goods += line_cost
+        line_costs.append(line_cost)
+        ledger_entries.append(make_ledger_entry(
+            order_id, order['order_number'], 'sale', -quantity, line_cost / quantity if quantity else 0, before, after, now
+        ))
     
-    # Update order status
-    await db.sales_orders.update_one(
-        {"id": order_id},
-        {"$set": {"status": "completed", "completed_at": now, "updated_at": now}}
-    )
+    await write_stock_balances(list(balances.values()), now, session)
+    await write_cost_layers(cost_layers, now, session)
+    if ledger_entries:
+        await db.stock_ledger.insert_many(ledger_entries, session=session)
+    if serial_updates:
+        await db.serial_items.bulk_write(serial_updates, ordered=False, session=session)
+        await db.serial_movements.insert_many(serial_movements, session=session)
+    
+    if new_order:
+        order.update({"status": "completed", "confirmed_at": now, "completed_at": now, "updated_at": now})
+        await db.sales_orders.insert_one(order, session=session)
+        order.pop('_id', None)
+    else:
+        # Update order status (guarded so a concurrent completion cannot apply twice)
+        result = await db.sales_orders.update_one(
+            {"id": order_id, "status": {"$in": ["draft", "confirmed"]}},
+            {"$set": {"status": "completed", "completed_at": now, "updated_at": now}},
+            session=session
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Order cannot be completed")
     
     # Update customer stats
     if customer:
         await db.customers.update_one(
             {"id": order['customer_id']},
-            {"$inc": {"total_orders": 1, "total_spent": order['total_amount']}}
+            {"$inc": {"total_orders": 1, "total_spent": order['total_amount']}},
+            session=session
         )
     
     # Sync product stock
-    await sync_product_stock()
+    await sync_product_stock([line['product_id'] for line in order['lines']], session)
+    
+    # Create automated sales journal entry (same transaction)
+    await create_sales_journal(
+        order_id=order_id,
+        order_number=order['order_number'],
+        total_amount=order['total_amount'],
+        cost_of_goods=total_cost_of_goods,
+        user_id=user['id'],
+        session=session
+    )
     
-    # Create automated sales journal entry
-    try:
-        await create_sales_journal(
-            order_id=order_id,
-            order_number=order['order_number'],
-            total_amount=order['total_amount'],
-            cost_of_goods=total_cost_of_goods,
-            user_id=user['id']
-        )
-    except Exception as e:
-        logger.warning(f"Failed to create sales journal: {e}")
+    await record_sales_rollups(order, line_costs, now, session)
+
+@api_router.post("/admin/pos/checkout", response_model=SalesOrderResponse)
+async def pos_checkout(data: SalesOrderCreate, user: dict = Depends(get_current_user)):
+    """Counter sale in one call: create the order, deduct stock, activate warranty and post the journal"""
+    async def checkout(session):
+        customer = await db.customers.find_one({"id": data.customer_id}, {"_id": 0}, session=session)
+        if not customer:
+            raise HTTPException(status_code=400, detail="Customer not found")
+        warehouse = await db.warehouses.find_one({"id": data.warehouse_id}, {"_id": 0}, session=session)
+        if not warehouse:
+            raise HTTPException(status_code=400, detail="Warehouse not found")
+        product_ids = list({line.product_id for line in data.lines})
+        products = {
+            p['id']: p for p in await db.products.find({"id": {"$in": product_ids}}, {"_id": 0}, session=session).to_list(None)
+        }
+        
+        lines, stock_items, problems = build_order_lines(data, products)
+        if problems:
+            # Availability itself is checked once inside complete_order; here only to report everything together
+            raise_if_unavailable(problems + await check_availability(stock_items, session))
+        
+        now = datetime.now(timezone.utc).isoformat()
+        order = {
+            "id": str(uuid.uuid4()),
+            "order_number": await generate_order_number(),
+            "customer_id": data.customer_id,
+            "warehouse_id": data.warehouse_id,
+            "status": "draft",
+            "lines": lines,
+            "total_items": sum(line['quantity'] for line in lines),
+            "total_amount": sum(line['total_price'] for line in lines),
+            "note": data.note,
+            "created_by": user['id'],
+            "confirmed_at": None,
+            "completed_at": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        await complete_order(order, customer, products, user, session, new_order=True)
+        
+        order['customer_name'] = customer['name']
+        order['customer_phone'] = customer['phone']
+        order['warehouse_name'] = warehouse['name']
+        order['created_by_name'] = user['full_name']
+        return SalesOrderResponse(**order)
     
-    return {"message": "Order completed, warranty activated", "order_number": order['order_number']}
+    return await run_in_transaction(checkout)
 
 @api_router.post("/admin/sales/orders/{order_id}/cancel")
 async def cancel_sales_order(order_id: str, user: dict = Depends(require_admin)):
@@ -2057,24 +4185,675 @@ async def cancel_sales_order(order_id: str, user: dict = Depends(require_admin))
     
     now = datetime.now(timezone.utc).isoformat()
     
-    await db.sales_orders.update_one(
-        {"id": order_id},
-        {"$set": {"status": "cancelled", "updated_at": now}}
-    )
+    async def cancel(session):
+        # Guarded on status so a completion committing meanwhile is not overwritten
+        result = await db.sales_orders.update_one(
+            {"id": order_id, "status": {"$nin": ["completed", "cancelled"]}},
+            {"$set": {"status": "cancelled", "updated_at": now}},
+            session=session
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=400, detail="Order is already completed or cancelled")
+        await release_reservations({"order_id": order_id}, "released", now, session)
+    
+    await run_in_transaction(cancel)
+    return {"message": "Order cancelled"}
+
+@api_router.delete("/admin/sales/orders/{order_id}")
+async def delete_sales_order(order_id: str, user: dict = Depends(require_admin)):
+    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    if order['status'] == 'completed':
+        raise HTTPException(status_code=400, detail="Cannot delete completed order")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    
+    async def delete(session):
+        result = await db.sales_orders.delete_one({"id": order_id, "status": {"$ne": "completed"}}, session=session)
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=400, detail="Cannot delete completed order")
+        await release_reservations({"order_id": order_id}, "released", now, session)
+    
+    await run_in_transaction(delete)
+    return {"message": "Order deleted"}
+
+# ==================== SALES ROLLUPS ====================
+# sales_daily holds one row per UTC day x product x warehouse, $inc'd as orders complete,
+# so sales reports read rollups instead of scanning every order and its lines. Its orders field
+# counts orders per product; whole-order counts per day x warehouse live in sales_daily_orders.
+
+def sales_rollup_rows(order: dict, line_costs: List[float]) -> dict:
+    """Per-product totals of a completed order; orders counts each order once per product"""
+    rows = {}
+    for line, cost in zip(order['lines'], line_costs):
+        row = rows.setdefault(line['product_id'], {"quantity": 0, "revenue": 0, "cost": 0, "orders": 1})
+        row['quantity'] += line['quantity']
+        row['revenue'] += line['total_price']
+        row['cost'] += cost
+    return rows
+
+def sales_rollup_update(day: str, product_id: str, warehouse_id: str, values: dict, now: str) -> UpdateOne:
+    return UpdateOne(
+        {"day": day, "product_id": product_id, "warehouse_id": warehouse_id},
+        {"$inc": values, "$set": {"updated_at": now}},
+        upsert=True
+    )
+
+async def record_sales_rollups(order: dict, line_costs: List[float], now: str, session=None):
+    day = now[:10]
+    updates = [
+        sales_rollup_update(day, product_id, order['warehouse_id'], values, now)
+        for product_id, values in sales_rollup_rows(order, line_costs).items()
+    ]
+    if updates:
+        await db.sales_daily.bulk_write(updates, ordered=False, session=session)
+        await db.sales_daily_orders.update_one(
+            {"day": day, "warehouse_id": order['warehouse_id']},
+            {"$inc": {"orders": 1}, "$set": {"updated_at": now}},
+            upsert=True, session=session
+        )
+
+async def rebuild_sales_rollup_day(day: str, session=None) -> int:
+    """Replace one day's rollups with totals recomputed from that day's completed orders and sale ledger rows.
+    
+    Orders completed before sales wrote ledger rows have no recorded cost; their goods are costed at the
+    product's current cost_price and the rollup row is marked cost_estimated.
+    """
+    next_day = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    orders = await db.sales_orders.find(
+        {"status": "completed", "completed_at": {"$gte": day, "$lt": next_day}},
+        {"_id": 0, "id": 1, "warehouse_id": 1, "lines": 1}, session=session
+    ).to_list(None)
+    costs = {}
+    async for entry in db.stock_ledger.find(
+        {"doc_id": {"$in": [o['id'] for o in orders]}, "doc_type": "sale"},
+        {"_id": 0, "doc_id": 1, "product_id": 1, "value_change": 1}, session=session
+    ):
+        key = (entry['doc_id'], entry['product_id'])
+        costs[key] = costs.get(key, 0) - entry.get('value_change', 0)
+    product_ids = list({line['product_id'] for order in orders for line in order['lines']})
+    products = {
+        p['id']: p for p in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "product_type": 1, "cost_price": 1}, session=session
+        ).to_list(None)
+    }
+    
+    totals = {}
+    order_counts = {}
+    for order in orders:
+        order_counts[order['warehouse_id']] = order_counts.get(order['warehouse_id'], 0) + 1
+        for product_id, values in sales_rollup_rows(order, [0] * len(order['lines'])).items():
+            row = totals.setdefault(
+                (product_id, order['warehouse_id']),
+                {"quantity": 0, "revenue": 0, "cost": 0, "orders": 0, "cost_estimated": False}
+            )
+            product = products.get(product_id, {})
+            if (order['id'], product_id) in costs:
+                values['cost'] = costs[(order['id'], product_id)]
+            elif product.get('product_type') != 'service':
+                values['cost'] = values['quantity'] * product.get('cost_price', 0)
+                row['cost_estimated'] = True
+            for field, value in values.items():
+                row[field] += value
+    
+    now = datetime.now(timezone.utc).isoformat()
+    await db.sales_daily.delete_many({"day": day}, session=session)
+    await db.sales_daily_orders.delete_many({"day": day}, session=session)
+    if totals:
+        await db.sales_daily.insert_many([
+            {"day": day, "product_id": product_id, "warehouse_id": warehouse_id, **values, "updated_at": now}
+            for (product_id, warehouse_id), values in totals.items()
+        ], session=session)
+        await db.sales_daily_orders.insert_many([
+            {"day": day, "warehouse_id": warehouse_id, "orders": count, "updated_at": now}
+            for warehouse_id, count in order_counts.items()
+        ], session=session)
+    return len(totals)
+
+async def rebuild_sales_rollups(progress=None) -> int:
+    """Recompute the rollups day by day, each day in its own transaction.
+    
+    Reports keep reading the other days while one is rebuilt, and an order completing on the day being
+    rebuilt write-conflicts with it instead of being lost or counted twice (the rebuild retries).
+    """
+    days = set(await db.sales_daily.distinct("day"))
+    async for order in db.sales_orders.find({"status": "completed"}, {"_id": 0, "completed_at": 1}):
+        if order.get('completed_at'):
+            days.add(order['completed_at'][:10])
+    
+    rows = 0
+    for done, day in enumerate(sorted(days), 1):
+        rows += await run_in_transaction(lambda session, day=day: rebuild_sales_rollup_day(day, session))
+        if progress:
+            await progress(done, len(days), day)
+    return rows
+
+@api_router.get("/admin/reports/sales")
+async def get_sales_report(
+    user: dict = Depends(require_admin),
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    group_by: Literal['day', 'month', 'product', 'warehouse'] = 'day',
+    warehouse_id: Optional[str] = None,
+    product_id: Optional[str] = None,
+    top: Optional[int] = None
+):
+    """Sales time series (day/month) or top-N ranking by revenue (product/warehouse) from the daily rollups"""
+    match = {}
+    if from_date or to_date:
+        match['day'] = {}
+        if from_date:
+            match['day']['$gte'] = from_date[:10]
+        if to_date:
+            match['day']['$lte'] = to_date[:10]
+    if warehouse_id:
+        match['warehouse_id'] = warehouse_id
+    if product_id:
+        match['product_id'] = product_id
+    
+    group_key = {
+        'day': "$day",
+        'month': {"$substr": ["$day", 0, 7]},
+        'product': "$product_id",
+        'warehouse': "$warehouse_id"
+    }[group_by]
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": group_key,
+            "quantity": {"$sum": "$quantity"},
+            "revenue": {"$sum": "$revenue"},
+            "cost": {"$sum": "$cost"},
+            "orders": {"$sum": "$orders"},
+            "cost_estimated": {"$max": {"$ifNull": ["$cost_estimated", False]}}
+        }},
+        {"$sort": {"_id": 1} if group_by in ('day', 'month') else {"revenue": -1}}
+    ]
+    if top:
+        pipeline.append({"$limit": top})
+    rows = await db.sales_daily.aggregate(pipeline).to_list(None)
+    
+    # Product rows count an order once per product; whole-order counts come from sales_daily_orders
+    if group_by != 'product' and not product_id:
+        order_counts = {r['_id']: r['orders'] for r in await db.sales_daily_orders.aggregate([
+            {"$match": match},
+            {"$group": {"_id": group_key, "orders": {"$sum": "$orders"}}}
+        ]).to_list(None)}
+        for row in rows:
+            row['orders'] = order_counts.get(row['_id'], 0)
+    
+    names = {}
+    if group_by == 'product':
+        names = {p['id']: p['name'] for p in await db.products.find(
+            {"id": {"$in": [r['_id'] for r in rows]}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)}
+    elif group_by == 'warehouse':
+        names = {w['id']: w['name'] for w in await db.warehouses.find(
+            {"id": {"$in": [r['_id'] for r in rows]}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)}
+    
+    items = []
+    totals = {"quantity": 0, "revenue": 0, "cost": 0, "gross_profit": 0}
+    for row in rows:
+        item = {
+            "key": row['_id'],
+            "name": names.get(row['_id']),
+            "quantity": row['quantity'],
+            "revenue": row['revenue'],
+            "cost": row['cost'],
+            "gross_profit": row['revenue'] - row['cost'],
+            "orders": row['orders'],
+            # Some cost in this row is estimated from cost_price (orders that predate sale ledger rows)
+            "cost_estimated": bool(row.get('cost_estimated'))
+        }
+        items.append(item)
+        for field in totals:
+            totals[field] += item[field]
+    
+    return {
+        "group_by": group_by, "from_date": from_date, "to_date": to_date, "items": items, "totals": totals,
+        "cost_estimated": any(item['cost_estimated'] for item in items)
+    }
+
+@api_router.post("/admin/reports/sales/rebuild")
+async def rebuild_sales_report(run_async: bool = Query(False, alias="async"), user: dict = Depends(require_admin)):
+    """Backfill the daily sales rollups from order history"""
+    if run_async:
+        return await submit_job('rebuild_sales_rollups', {}, user)
+    rows = await rebuild_sales_rollups()
+    return {"message": "Sales rollups rebuilt", "rows": rows}
+
+# ==================== ORDER ALLOCATION ====================
+# Proposes which warehouses should ship an order: fewest shipments first, then lowest shipping cost.
+# Works on a product x warehouse matrix of available stock that is cached for a few seconds; the
+# proposal is advisory and create_sales_order re-checks availability for each resulting order.
+
+ALLOCATION_SHIPMENT_COST = float(os.environ.get('ALLOCATION_SHIPMENT_COST', '30000'))
+ALLOCATION_COST_PER_KM = float(os.environ.get('ALLOCATION_COST_PER_KM', '50'))
+ALLOCATION_PAIR_SEARCH_MAX_WAREHOUSES = 64
+
+stock_matrix_cache = LRUCache(maxsize=1, ttl=15)
+
+class AllocationRequest(BaseModel):
+    lines: List[SalesOrderLineCreate]
+    customer_id: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    warehouse_ids: Optional[List[str]] = None
+
+async def load_stock_matrix() -> dict:
+    """Available (on hand minus reserved) quantity per product x active warehouse as a numpy matrix"""
+    matrix = stock_matrix_cache.get('stock')
+    if matrix is not None:
+        return matrix
+    
+    warehouses = await db.warehouses.find(
+        {"is_active": {"$ne": False}}, {"_id": 0, "id": 1, "name": 1, "latitude": 1, "longitude": 1}
+    ).sort("name", 1).to_list(None)
+    warehouse_index = {w['id']: i for i, w in enumerate(warehouses)}
+    product_index = {}
+    rows, cols, values = [], [], []
+    async for balance in db.stock_balance.find(
+        {"quantity": {"$gt": 0}}, {"_id": 0, "product_id": 1, "warehouse_id": 1, "quantity": 1, "reserved": 1}
+    ):
+        col = warehouse_index.get(balance['warehouse_id'])
+        if col is None:
+            continue
+        rows.append(product_index.setdefault(balance['product_id'], len(product_index)))
+        cols.append(col)
+        values.append(max(available_quantity(balance), 0))
+    
+    available = np.zeros((len(product_index), len(warehouses)), dtype=np.int64)
+    if values:
+        available[rows, cols] = values
+    matrix = {"warehouses": warehouses, "product_index": product_index, "available": available}
+    stock_matrix_cache.set('stock', matrix)
+    return matrix
+
+def haversine_km(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    lat, lng, lats, lngs = np.radians(lat), np.radians(lng), np.radians(lats), np.radians(lngs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * 6371 * np.arcsin(np.sqrt(a))
+
+def allocate_stock(demand: np.ndarray, available: np.ndarray, shipment_cost: np.ndarray, pinned: np.ndarray):
+    """Assign demand (P,) to warehouses given available (P, W) stock and a per-shipment cost (W,).
+    pinned (P, W) holds units already fixed to a warehouse, e.g. requested serials.
+    Prefers one warehouse covering everything, then the cheapest covering pair, then greedy largest coverage.
+    Returns the allocation (P, W) and the unallocated shortage (P,)."""
+    allocation = pinned.copy()
+    available = np.maximum(available - pinned, 0)
+    remaining = np.maximum(demand - pinned.sum(axis=1), 0)
+    used = pinned.sum(axis=0) > 0
+    
+    while remaining.any():
+        coverage = np.minimum(available, remaining[:, None]).sum(axis=0)
+        if not coverage.any():
+            break
+        total = remaining.sum()
+        # Shipping from a warehouse that already ships part of the order adds no split
+        extra_cost = np.where(used, 0, shipment_cost)
+        
+        full = coverage == total
+        if full.any():
+            w = int(np.argmin(np.where(full, extra_cost, np.inf)))
+        else:
+            w = None
+            if available.shape[1] <= ALLOCATION_PAIR_SEARCH_MAX_WAREHOUSES:
+                pair_coverage = np.minimum(
+                    available[:, :, None] + available[:, None, :], remaining[:, None, None]
+                ).sum(axis=0)
+                pair_cost = np.where(pair_coverage == total, extra_cost[:, None] + extra_cost[None, :], np.inf)
+                np.fill_diagonal(pair_cost, np.inf)
+                if np.isfinite(pair_cost).any():
+                    i, j = np.unravel_index(int(np.argmin(pair_cost)), pair_cost.shape)
+                    # Ship the larger share first; the partner then covers the rest on its own
+                    w = int(i if coverage[i] >= coverage[j] else j)
+            if w is None:
+                w = int(np.lexsort((extra_cost, -coverage))[0])
+        
+        take = np.minimum(available[:, w], remaining)
+        allocation[:, w] += take
+        available[:, w] -= take
+        remaining -= take
+        used[w] = True
+    
+    return allocation, remaining
+
+@api_router.post("/admin/sales/allocate")
+async def allocate_order(data: AllocationRequest, user: dict = Depends(get_current_user)):
+    """Propose a warehouse split for order lines; each shipment can be posted as its own sales order"""
+    product_ids = list({line.product_id for line in data.lines})
+    products = {p['id']: p for p in await db.products.find(
+        {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "name": 1, "product_type": 1, "track_serial": 1}
+    ).to_list(None)}
+    missing = [f"Line {i}: product {line.product_id} not found"
+               for i, line in enumerate(data.lines, start=1) if line.product_id not in products]
+    raise_if_unavailable(missing)
+    
+    matrix = await load_stock_matrix()
+    warehouses = matrix['warehouses']
+    if not warehouses:
+        raise HTTPException(status_code=400, detail="No active warehouses")
+    warehouse_index = {w['id']: i for i, w in enumerate(warehouses)}
+    
+    # Order products become the rows; products with no stock anywhere get an all-zero row
+    stocked = [line for line in data.lines if products[line.product_id].get('product_type') != 'service']
+    order_products = list(dict.fromkeys(line.product_id for line in stocked))
+    row_of = {pid: i for i, pid in enumerate(order_products)}
+    available = np.zeros((len(order_products), len(warehouses)), dtype=np.int64)
+    known = [(i, matrix['product_index'][pid]) for i, pid in enumerate(order_products) if pid in matrix['product_index']]
+    if known:
+        rows, source = zip(*known)
+        available[list(rows)] = matrix['available'][list(source)]
+    if data.warehouse_ids:
+        allowed = np.isin([w['id'] for w in warehouses], data.warehouse_ids)
+        available[:, ~allowed] = 0
+    
+    demand = np.zeros(len(order_products), dtype=np.int64)
+    for line in stocked:
+        demand[row_of[line.product_id]] += line.quantity
+    
+    # Requested serials fix their units to the warehouse holding them
+    pinned = np.zeros_like(available)
+    serial_warehouse = {}
+    problems = []
+    requested_serials = [sn for line in stocked if products[line.product_id].get('track_serial') for sn in line.serial_numbers]
+    if requested_serials:
+        serial_warehouse = {
+            s['serial_number']: s['warehouse_id'] for s in await db.serial_items.find(
+                {"serial_number": {"$in": requested_serials}, "status": "in_stock"},
+                {"_id": 0, "serial_number": 1, "warehouse_id": 1}
+            ).to_list(None)
+            if s.get('warehouse_id') in warehouse_index
+        }
+        for line in stocked:
+            for sn in line.serial_numbers if products[line.product_id].get('track_serial') else []:
+                if sn not in serial_warehouse:
+                    problems.append(f"Serial {sn} not available in any warehouse")
+                    continue
+                pinned[row_of[line.product_id], warehouse_index[serial_warehouse[sn]]] += 1
+    
+    # Shipping cost per warehouse: a fixed cost per shipment plus distance to the customer when both are located
+    distance = np.full(len(warehouses), np.nan)
+    if data.latitude is not None and data.longitude is not None:
+        lats = np.array([w.get('latitude') if w.get('latitude') is not None else np.nan for w in warehouses], dtype=float)
+        lngs = np.array([w.get('longitude') if w.get('longitude') is not None else np.nan for w in warehouses], dtype=float)
+        distance = haversine_km(data.latitude, data.longitude, lats, lngs)
+    shipment_cost = ALLOCATION_SHIPMENT_COST + ALLOCATION_COST_PER_KM * np.nan_to_num(distance, nan=0.0)
+    
+    allocation, shortage = allocate_stock(demand, available, shipment_cost, pinned)
+    
+    # Turn per-product allocations back into order lines, serial lines first so they land with their serials
+    left = {pid: allocation[row_of[pid]].copy() for pid in order_products}
+    shipments = {}
+    
+    def add_line(w: int, line: SalesOrderLineCreate, quantity: int, serial_numbers: List[str]):
+        shipments.setdefault(w, []).append({
+            "product_id": line.product_id,
+            "product_name": products[line.product_id]['name'],
+            "quantity": quantity,
+            "unit_price": line.unit_price,
+            "serial_numbers": serial_numbers,
+            "note": line.note
+        })
+    
+    for line in sorted(stocked, key=lambda l: not l.serial_numbers):
+        need = line.quantity
+        by_warehouse = {}
+        for sn in line.serial_numbers:
+            if sn in serial_warehouse:
+                by_warehouse.setdefault(warehouse_index[serial_warehouse[sn]], []).append(sn)
+        for w, serials in by_warehouse.items():
+            add_line(w, line, len(serials), serials)
+            left[line.product_id][w] -= len(serials)
+            need -= len(serials)
+        for w in np.flatnonzero(left[line.product_id] > 0):
+            if need <= 0:
+                break
+            quantity = int(min(left[line.product_id][w], need))
+            add_line(int(w), line, quantity, [])
+            left[line.product_id][w] -= quantity
+            need -= quantity
+    
+    # Services ride along with the largest shipment
+    services = [line for line in data.lines if products[line.product_id].get('product_type') == 'service']
+    if services:
+        main = max(shipments, key=lambda w: sum(l['quantity'] for l in shipments[w])) if shipments else None
+        if main is None:
+            main = int(np.argmin(shipment_cost))
+        for line in services:
+            add_line(main, line, line.quantity, [])
+    
+    result_shipments = []
+    for w, lines in sorted(shipments.items(), key=lambda item: -sum(l['quantity'] for l in item[1])):
+        warehouse = warehouses[w]
+        result_shipments.append({
+            "warehouse_id": warehouse['id'],
+            "warehouse_name": warehouse['name'],
+            "distance_km": None if np.isnan(distance[w]) else round(float(distance[w]), 1),
+            "shipping_cost": round(float(shipment_cost[w]), 0),
+            "total_items": sum(l['quantity'] for l in lines),
+            "lines": lines,
+            "order": {
+                "customer_id": data.customer_id,
+                "warehouse_id": warehouse['id'],
+                "lines": [{k: l[k] for k in ("product_id", "quantity", "unit_price", "serial_numbers", "note")} for l in lines]
+            }
+        })
     
-    return {"message": "Order cancelled"}
+    shortages = [
+        {
+            "product_id": pid,
+            "product_name": products[pid]['name'],
+            "requested": int(demand[row_of[pid]]),
+            "short": int(shortage[row_of[pid]])
+        }
+        for pid in order_products if shortage[row_of[pid]] > 0
+    ]
+    return {
+        "shipments": result_shipments,
+        "splits": max(len(result_shipments) - 1, 0),
+        "total_shipping_cost": round(sum(s['shipping_cost'] for s in result_shipments), 0),
+        "fully_allocated": not shortages and not problems,
+        "shortages": shortages,
+        "problems": problems
+    }
 
-@api_router.delete("/admin/sales/orders/{order_id}")
-async def delete_sales_order(order_id: str, user: dict = Depends(require_admin)):
-    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
+# ==================== STOCK REBALANCING ====================
+# Suggests transfers that even out days of cover across warehouses. Stock and recent outflow
+# (sales and issues) are laid out as product x warehouse numpy matrices; each product's stock is
+# split in proportion to where it sells, and warehouses short of cover are fed from those above it.
+
+REBALANCE_OUTFLOW_TYPES = ['sale', 'issue']
+
+async def rebalance_matrices(lookback_days: int):
+    warehouses = await db.warehouses.find(
+        {"is_active": {"$ne": False}}, {"_id": 0, "id": 1, "name": 1}
+    ).sort("name", 1).to_list(None)
+    warehouse_index = {w['id']: i for i, w in enumerate(warehouses)}
+    product_index = {}
+    
+    stock_cells = ([], [], [], [])
+    async for balance in db.stock_balance.find(
+        {"quantity": {"$gt": 0}}, {"_id": 0, "product_id": 1, "warehouse_id": 1, "quantity": 1, "reserved": 1, "avg_cost": 1}
+    ):
+        col = warehouse_index.get(balance['warehouse_id'])
+        if col is not None:
+            stock_cells[0].append(product_index.setdefault(balance['product_id'], len(product_index)))
+            stock_cells[1].append(col)
+            stock_cells[2].append(max(available_quantity(balance), 0))
+            stock_cells[3].append(balance.get('avg_cost', 0))
+    
+    since = (datetime.now(timezone.utc) - timedelta(days=lookback_days)).isoformat()
+    outflow_cells = ([], [], [])
+    async for row in db.stock_ledger.aggregate([
+        {"$match": {"created_at": {"$gte": since}, "doc_type": {"$in": REBALANCE_OUTFLOW_TYPES}, "quantity_change": {"$lt": 0}}},
+        {"$group": {"_id": {"p": "$product_id", "w": "$warehouse_id"}, "units": {"$sum": "$quantity_change"}}}
+    ]):
+        col = warehouse_index.get(row['_id']['w'])
+        if col is not None:
+            outflow_cells[0].append(product_index.setdefault(row['_id']['p'], len(product_index)))
+            outflow_cells[1].append(col)
+            outflow_cells[2].append(-row['units'])
+    
+    shape = (len(product_index), len(warehouses))
+    stock = np.zeros(shape, dtype=np.int64)
+    unit_cost = np.zeros(shape)
+    velocity = np.zeros(shape)
+    if stock_cells[0]:
+        stock[stock_cells[0], stock_cells[1]] = stock_cells[2]
+        unit_cost[stock_cells[0], stock_cells[1]] = stock_cells[3]
+    if outflow_cells[0]:
+        velocity[outflow_cells[0], outflow_cells[1]] = np.array(outflow_cells[2], dtype=float) / lookback_days
+    return warehouses, list(product_index), stock, velocity, unit_cost
+
+def plan_rebalance(stock: np.ndarray, velocity: np.ndarray, min_cover_days: float):
+    """Transfers (product row, from col, to col, quantity) moving stock toward demand-proportional targets.
+    Only warehouses below min_cover_days receive stock; donors never drop below their own target."""
+    total_velocity = velocity.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(total_velocity[:, None] > 0, velocity / total_velocity[:, None], 0)
+        cover = np.where(velocity > 0, stock / velocity, np.inf)
+    target = stock.sum(axis=1)[:, None] * share
+    
+    selling = total_velocity > 0
+    deficit = np.where(selling[:, None] & (cover < min_cover_days), np.floor(target - stock), 0).clip(min=0).astype(np.int64)
+    surplus = np.where(selling[:, None], np.floor(stock - target), 0).clip(min=0).astype(np.int64)
+    
+    transfers = []
+    for p in np.flatnonzero((deficit.sum(axis=1) > 0) & (surplus.sum(axis=1) > 0)):
+        give = surplus[p].copy()
+        need = deficit[p].copy()
+        # Largest shortfall first, fed from the largest surplus
+        for to in np.argsort(-need):
+            while need[to] > 0 and give.any():
+                source = int(np.argmax(give))
+                quantity = int(min(give[source], need[to]))
+                transfers.append((int(p), source, int(to), quantity))
+                give[source] -= quantity
+                need[to] -= quantity
+    return transfers, cover
+
+async def rebalance_inventory(
+    user: dict,
+    lookback_days: int = 30,
+    min_cover_days: float = 14,
+    create_documents: bool = False,
+    run_id: Optional[str] = None,
+    progress=None
+) -> dict:
+    """Plan transfers; with create_documents, write one draft transfer per route.
+    
+    Routes that already have a draft from the same run_id (a retried job) are not created again.
+    """
+    if progress:
+        await progress(0, None, "Loading stock and sales history")
+    warehouses, product_ids, stock, velocity, unit_cost = await rebalance_matrices(lookback_days)
+    if progress:
+        await progress(0, None, f"Planning {len(product_ids)} products x {len(warehouses)} warehouses")
+    transfers, cover = plan_rebalance(stock, velocity, min_cover_days)
+    
+    involved = list({product_ids[p] for p, _, _, _ in transfers})
+    products = {p['id']: p for p in await db.products.find(
+        {"id": {"$in": involved}}, {"_id": 0, "id": 1, "name": 1, "sku": 1, "track_serial": 1, "product_type": 1}
+    ).to_list(None)}
+    
+    # Serial-tracked products move specific units: take in-stock serials from the source warehouse
+    serial_pool = {}
+    tracked = [pid for pid in involved if products.get(pid, {}).get('track_serial')]
+    if tracked:
+        async for serial in db.serial_items.find(
+            {"product_id": {"$in": tracked}, "status": "in_stock"},
+            {"_id": 0, "serial_number": 1, "product_id": 1, "warehouse_id": 1}
+        ):
+            serial_pool.setdefault((serial['product_id'], serial['warehouse_id']), []).append(serial['serial_number'])
+    
+    suggestions = []
+    for p, source, dest, quantity in transfers:
+        product_id = product_ids[p]
+        product = products.get(product_id)
+        if not product or product.get('product_type') == 'service':
+            continue
+        serials = []
+        if product.get('track_serial'):
+            pool = serial_pool.get((product_id, warehouses[source]['id']), [])
+            serials, pool[:] = pool[:quantity], pool[quantity:]
+            quantity = len(serials)
+            if not quantity:
+                continue
+        daily = velocity[p]
+        suggestions.append({
+            "product_id": product_id,
+            "product_name": product['name'],
+            "sku": product.get('sku'),
+            "from_warehouse_id": warehouses[source]['id'],
+            "from_warehouse_name": warehouses[source]['name'],
+            "to_warehouse_id": warehouses[dest]['id'],
+            "to_warehouse_name": warehouses[dest]['name'],
+            "quantity": quantity,
+            "serial_numbers": serials,
+            "unit_cost": float(unit_cost[p, source]),
+            "from_cover_days": None if np.isinf(cover[p, source]) else round(float(cover[p, source]), 1),
+            "to_cover_days": round(float(cover[p, dest]), 1),
+            "to_cover_days_after": round(float((stock[p, dest] + quantity) / daily[dest]), 1)
+        })
     
-    if order['status'] == 'completed':
-        raise HTTPException(status_code=400, detail="Cannot delete completed order")
+    documents = []
+    if create_documents:
+        by_route = {}
+        for s in suggestions:
+            by_route.setdefault((s['from_warehouse_id'], s['to_warehouse_id']), []).append(s)
+        existing = {}
+        if run_id:
+            async for doc in db.inventory_docs.find(
+                {"run_id": run_id}, {"_id": 0, "id": 1, "doc_number": 1, "warehouse_id": 1, "dest_warehouse_id": 1, "lines": 1}
+            ):
+                existing[(doc['warehouse_id'], doc['dest_warehouse_id'])] = doc
+        for done, ((source_id, dest_id), rows) in enumerate(by_route.items()):
+            if progress:
+                await progress(done, len(by_route), "Creating transfer documents")
+            doc = existing.get((source_id, dest_id))
+            if doc:
+                documents.append({"id": doc['id'], "doc_number": doc['doc_number'], "lines": len(doc['lines'])})
+                continue
+            doc = await insert_inventory_doc(InventoryDocCreate(
+                doc_type='transfer',
+                warehouse_id=source_id,
+                dest_warehouse_id=dest_id,
+                reference='REBALANCE',
+                note=f"Cân bằng tồn kho (tồn tối thiểu {min_cover_days:g} ngày)",
+                lines=[InventoryLineCreate(
+                    product_id=r['product_id'], quantity=r['quantity'], unit_cost=r['unit_cost'], serial_numbers=r['serial_numbers']
+                ) for r in rows]
+            ), user, run_id, products)
+            documents.append({"id": doc['id'], "doc_number": doc['doc_number'], "lines": len(rows)})
     
-    await db.sales_orders.delete_one({"id": order_id})
-    return {"message": "Order deleted"}
+    return {
+        "lookback_days": lookback_days,
+        "min_cover_days": min_cover_days,
+        "products": len(product_ids),
+        "warehouses": len(warehouses),
+        "transfers": suggestions,
+        "documents": documents
+    }
+
+@api_router.post("/admin/inventory/rebalance")
+async def rebalance_inventory_route(
+    lookback_days: int = 30,
+    min_cover_days: float = 14,
+    create_documents: bool = False,
+    run_async: bool = Query(False, alias="async"),
+    user: dict = Depends(require_admin)
+):
+    """Suggest transfers evening out days of cover; create_documents=true also writes them as draft transfers"""
+    if lookback_days <= 0:
+        raise HTTPException(status_code=400, detail="lookback_days must be positive")
+    params = {"lookback_days": lookback_days, "min_cover_days": min_cover_days, "create_documents": create_documents}
+    if run_async:
+        return await submit_job('rebalance_inventory', params, user)
+    return await rebalance_inventory(user, **params)
 
 # ==================== COST ACCOUNTING MODELS ====================
 
@@ -2100,6 +4879,8 @@ class AccountResponse(BaseModel):
     description: Optional[str] = None
     is_header: bool = False
     balance: float = 0
+    total_debit: float = 0
+    total_credit: float = 0
     is_active: bool = True
     created_at: str
 
@@ -2159,38 +4940,17 @@ async def list_accounts(
         query['account_type'] = account_type
     
     accounts = await db.accounts.find(query, {"_id": 0}).sort("code", 1).to_list(1000)
+    if include_balances:
+        await with_account_totals(accounts)
     
     # Get parent names
     account_map = {a['id']: a for a in accounts}
     
-    # Calculate balances if requested
-    balances = {}
-    if include_balances:
-        # Get latest balances from journal lines
-        pipeline = [
-            {"$match": {"status": "posted"}},
-            {"$unwind": "$lines"},
-            {"$group": {
-                "_id": "$lines.account_id",
-                "total_debit": {"$sum": "$lines.debit"},
-                "total_credit": {"$sum": "$lines.credit"}
-            }}
-        ]
-        balance_results = await db.journal_entries.aggregate(pipeline).to_list(1000)
-        for b in balance_results:
-            # For asset/expense: balance = debit - credit
-            # For liability/equity/revenue: balance = credit - debit
-            account = account_map.get(b['_id'])
-            if account:
-                if account['account_type'] in ['asset', 'expense']:
-                    balances[b['_id']] = b['total_debit'] - b['total_credit']
-                else:
-                    balances[b['_id']] = b['total_credit'] - b['total_debit']
-    
     result = []
     for a in accounts:
         a['parent_name'] = account_map.get(a.get('parent_id'), {}).get('name')
-        a['balance'] = balances.get(a['id'], 0)
+        # Balances come from the running totals kept as entries post
+        a['balance'] = account_balance(a) if include_balances else 0
         result.append(AccountResponse(**a))
     
     return result
@@ -2204,6 +4964,7 @@ async def get_account(account_id: str, user: dict = Depends(get_current_user)):
     if account.get('parent_id'):
         parent = await db.accounts.find_one({"id": account['parent_id']}, {"_id": 0, "name": 1})
         account['parent_name'] = parent['name'] if parent else None
+    await with_account_totals([account])
     
     return AccountResponse(**account)
 
@@ -2229,6 +4990,8 @@ async def create_account(data: AccountCreate, user: dict = Depends(require_admin
         "id": account_id,
         **data.model_dump(),
         "balance": 0,
+        "total_debit": 0,
+        "total_credit": 0,
         "is_active": True,
         "created_at": now,
         "updated_at": now
@@ -2272,6 +5035,122 @@ async def delete_account(account_id: str, user: dict = Depends(require_admin)):
         raise HTTPException(status_code=404, detail="Account not found")
     return {"message": "Account deleted"}
 
+# ==================== ACCOUNT TOTALS ====================
+# Running total_debit/total_credit per account over its posted journal lines, $inc'd in the same
+# transaction that posts an entry. Totals are split over ACCOUNT_TOTAL_BUCKETS documents per account
+# (account_totals) and summed on read: every sale and stock posting hits the same few accounts, and
+# a single document per account would serialize concurrent postings through write conflicts.
+
+ACCOUNT_TOTAL_BUCKETS = int(os.environ.get('ACCOUNT_TOTAL_BUCKETS', '16'))
+
+def account_balance(account: dict) -> float:
+    """Normal-side balance: debit - credit for asset/expense, credit - debit otherwise"""
+    debit = account.get('total_debit', 0)
+    credit = account.get('total_credit', 0)
+    if account['account_type'] in ['asset', 'expense']:
+        return debit - credit
+    return credit - debit
+
+def account_totals_update(account_id: str, bucket: int, debit: float, credit: float) -> UpdateOne:
+    return UpdateOne(
+        {"account_id": account_id, "bucket": bucket},
+        {"$inc": {"total_debit": debit, "total_credit": credit}},
+        upsert=True
+    )
+
+async def apply_account_totals(lines: List[dict], session=None):
+    """Add an entry's lines to the totals, all in one randomly chosen bucket"""
+    totals = {}
+    for line in lines:
+        row = totals.setdefault(line['account_id'], [0, 0])
+        row[0] += line.get('debit', 0)
+        row[1] += line.get('credit', 0)
+    if totals:
+        bucket = random.randrange(ACCOUNT_TOTAL_BUCKETS)
+        await db.account_totals.bulk_write([
+            account_totals_update(account_id, bucket, debit, credit)
+            for account_id, (debit, credit) in totals.items()
+        ], ordered=False, session=session)
+
+async def load_account_totals(account_ids: Optional[List[str]] = None, session=None) -> dict:
+    """Summed {account_id: {total_debit, total_credit}} over every bucket"""
+    pipeline = [
+        {"$match": {"account_id": {"$in": account_ids}} if account_ids is not None else {}},
+        {"$group": {"_id": "$account_id", "total_debit": {"$sum": "$total_debit"}, "total_credit": {"$sum": "$total_credit"}}}
+    ]
+    return {
+        r['_id']: {"total_debit": r['total_debit'], "total_credit": r['total_credit']}
+        for r in await db.account_totals.aggregate(pipeline, session=session).to_list(None)
+    }
+
+async def with_account_totals(accounts: List[dict], session=None) -> List[dict]:
+    """Set total_debit/total_credit on account documents from the bucketed totals"""
+    totals = await load_account_totals([a['id'] for a in accounts], session)
+    for account in accounts:
+        account.update(totals.get(account['id'], {"total_debit": 0, "total_credit": 0}))
+    return accounts
+
+async def rebuild_account_totals(fix: bool = True) -> dict:
+    """Recompute account totals from posted journal entries; report and optionally correct drift.
+    
+    Reads and corrections share one transaction and corrections $inc bucket 0 by the difference found, so
+    an entry posted meanwhile is either in the snapshot on both sides (journal and totals) or on neither.
+    """
+    return await run_in_transaction(lambda session: check_account_totals(fix, session))
+
+async def check_account_totals(fix: bool, session=None) -> dict:
+    pipeline = [
+        {"$match": {"status": "posted"}},
+        {"$unwind": "$lines"},
+        {"$group": {
+            "_id": "$lines.account_id",
+            "total_debit": {"$sum": "$lines.debit"},
+            "total_credit": {"$sum": "$lines.credit"}
+        }}
+    ]
+    expected = {r['_id']: r for r in await db.journal_entries.aggregate(pipeline, session=session).to_list(None)}
+    accounts = await with_account_totals(
+        await db.accounts.find({}, {"_id": 0, "id": 1, "code": 1}, session=session).to_list(None), session
+    )
+    
+    mismatches = []
+    for account in accounts:
+        want = expected.get(account['id'], {"total_debit": 0, "total_credit": 0})
+        have_debit = account.get('total_debit', 0)
+        have_credit = account.get('total_credit', 0)
+        if abs(have_debit - want['total_debit']) > 0.01 or abs(have_credit - want['total_credit']) > 0.01:
+            mismatches.append({
+                "account_id": account['id'],
+                "account_code": account['code'],
+                "stored_debit": have_debit,
+                "stored_credit": have_credit,
+                "expected_debit": want['total_debit'],
+                "expected_credit": want['total_credit']
+            })
+    
+    if fix and mismatches:
+        await db.account_totals.bulk_write([
+            account_totals_update(
+                m['account_id'], 0,
+                m['expected_debit'] - m['stored_debit'],
+                m['expected_credit'] - m['stored_credit']
+            )
+            for m in mismatches
+        ], ordered=False, session=session)
+    
+    return {"accounts": len(accounts), "mismatches": mismatches, "fixed": fix and bool(mismatches)}
+
+@api_router.post("/admin/accounts/rebuild-totals")
+async def rebuild_account_totals_route(
+    verify_only: bool = False,
+    run_async: bool = Query(False, alias="async"),
+    user: dict = Depends(require_admin)
+):
+    """Check account running totals against the journal; verify_only=true reports without correcting"""
+    if run_async:
+        return await submit_job('rebuild_account_totals', {"fix": not verify_only}, user)
+    return await rebuild_account_totals(fix=not verify_only)
+
 # ==================== JOURNAL ENTRY ROUTES ====================
 
 async def generate_journal_number(journal_type: str) -> str:
@@ -2283,16 +5162,7 @@ async def generate_journal_number(journal_type: str) -> str:
         'purchase': 'PU',   # Purchase Journal
         'adjustment': 'ADJ' # Adjustment Journal
     }
-    prefix = prefix_map.get(journal_type, 'JV')
-    date_str = datetime.now(timezone.utc).strftime('%Y%m%d')
-    
-    start_of_day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    count = await db.journal_entries.count_documents({
-        "journal_type": journal_type,
-        "created_at": {"$gte": start_of_day.isoformat()}
-    })
-    
-    return f"{prefix}-{date_str}-{str(count + 1).zfill(3)}"
+    return await next_sequence(prefix_map.get(journal_type, 'JV'))
 
 @api_router.get("/admin/journal-entries", response_model=List[JournalEntryResponse])
 async def list_journal_entries(
@@ -2416,11 +5286,18 @@ async def post_journal_entry(entry_id: str, user: dict = Depends(get_current_use
     
     now = datetime.now(timezone.utc).isoformat()
     
-    await db.journal_entries.update_one(
-        {"id": entry_id},
-        {"$set": {"status": "posted", "posted_at": now, "updated_at": now}}
-    )
+    async def post(session):
+        # Guarded so a double submit cannot add the entry to the account totals twice
+        result = await db.journal_entries.update_one(
+            {"id": entry_id, "status": "draft"},
+            {"$set": {"status": "posted", "posted_at": now, "updated_at": now}},
+            session=session
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Journal entry is not in draft status")
+        await apply_account_totals(entry['lines'], session)
     
+    await run_in_transaction(post)
     return {"message": "Journal entry posted", "entry_number": entry['entry_number']}
 
 @api_router.delete("/admin/journal-entries/{entry_id}")
@@ -2443,7 +5320,8 @@ async def create_inventory_journal(
     doc_type: str,
     lines: List[dict],
     user_id: str,
-    description: str = None
+    description: str = None,
+    session=None
 ):
     """Create automated journal entry for inventory transactions"""
     
@@ -2452,9 +5330,9 @@ async def create_inventory_journal(
     # COGS (Giá vốn hàng bán): 632
     # Inventory Adjustment (Điều chỉnh tồn kho): 811
     
-    inventory_account = await db.accounts.find_one({"code": "156"}, {"_id": 0, "id": 1})
-    cogs_account = await db.accounts.find_one({"code": "632"}, {"_id": 0, "id": 1})
-    adjustment_account = await db.accounts.find_one({"code": "811"}, {"_id": 0, "id": 1})
+    inventory_account = await db.accounts.find_one({"code": "156"}, {"_id": 0, "id": 1}, session=session)
+    cogs_account = await db.accounts.find_one({"code": "632"}, {"_id": 0, "id": 1}, session=session)
+    adjustment_account = await db.accounts.find_one({"code": "811"}, {"_id": 0, "id": 1}, session=session)
     
     if not inventory_account:
         logger.warning("Inventory account 156 not found, skipping journal entry")
@@ -2473,7 +5351,7 @@ async def create_inventory_journal(
             "credit": 0
         })
         # Credit: Accounts Payable or Cash (331 or 111)
-        payable_account = await db.accounts.find_one({"code": "331"}, {"_id": 0, "id": 1})
+        payable_account = await db.accounts.find_one({"code": "331"}, {"_id": 0, "id": 1}, session=session)
         if payable_account:
             journal_lines.append({
                 "id": str(uuid.uuid4()),
@@ -2561,7 +5439,8 @@ async def create_inventory_journal(
         "updated_at": now
     }
     
-    await db.journal_entries.insert_one(entry)
+    await db.journal_entries.insert_one(entry, session=session)
+    await apply_account_totals(journal_lines, session)
     logger.info(f"Created inventory journal entry {entry_number} for {doc_number}")
     return entry_id
 
@@ -2570,7 +5449,8 @@ async def create_sales_journal(
     order_number: str,
     total_amount: float,
     cost_of_goods: float,
-    user_id: str
+    user_id: str,
+    session=None
 ):
     """Create automated journal entry for sales transactions"""
     
@@ -2580,10 +5460,10 @@ async def create_sales_journal(
     # COGS (632): Debit
     # Inventory (156): Credit
     
-    cash_account = await db.accounts.find_one({"code": "111"}, {"_id": 0, "id": 1})
-    revenue_account = await db.accounts.find_one({"code": "511"}, {"_id": 0, "id": 1})
-    cogs_account = await db.accounts.find_one({"code": "632"}, {"_id": 0, "id": 1})
-    inventory_account = await db.accounts.find_one({"code": "156"}, {"_id": 0, "id": 1})
+    cash_account = await db.accounts.find_one({"code": "111"}, {"_id": 0, "id": 1}, session=session)
+    revenue_account = await db.accounts.find_one({"code": "511"}, {"_id": 0, "id": 1}, session=session)
+    cogs_account = await db.accounts.find_one({"code": "632"}, {"_id": 0, "id": 1}, session=session)
+    inventory_account = await db.accounts.find_one({"code": "156"}, {"_id": 0, "id": 1}, session=session)
     
     if not all([cash_account, revenue_account]):
         logger.warning("Required accounts not found for sales journal")
@@ -2649,7 +5529,8 @@ async def create_sales_journal(
         "updated_at": now
     }
     
-    await db.journal_entries.insert_one(entry)
+    await db.journal_entries.insert_one(entry, session=session)
+    await apply_account_totals(journal_lines, session)
     logger.info(f"Created sales journal entry {entry_number} for {order_number}")
     return entry_id
 
@@ -2659,31 +5540,18 @@ async def create_sales_journal(
 async def get_trial_balance(user: dict = Depends(get_current_user)):
     """Get trial balance report - all accounts with their balances"""
     
-    # Get all posted journal entries
-    pipeline = [
-        {"$match": {"status": "posted"}},
-        {"$unwind": "$lines"},
-        {"$group": {
-            "_id": "$lines.account_id",
-            "total_debit": {"$sum": "$lines.debit"},
-            "total_credit": {"$sum": "$lines.credit"}
-        }}
-    ]
-    
-    balances = await db.journal_entries.aggregate(pipeline).to_list(1000)
-    balance_map = {b['_id']: b for b in balances}
-    
-    # Get all accounts
-    accounts = await db.accounts.find({"is_header": False}, {"_id": 0}).sort("code", 1).to_list(1000)
+    # Running totals are kept per account as entries post
+    accounts = await with_account_totals(
+        await db.accounts.find({"is_header": False}, {"_id": 0}).sort("code", 1).to_list(1000)
+    )
     
     result = []
     total_debit = 0
     total_credit = 0
     
     for account in accounts:
-        balance = balance_map.get(account['id'], {'total_debit': 0, 'total_credit': 0})
-        debit = balance['total_debit']
-        credit = balance['total_credit']
+        debit = account.get('total_debit', 0)
+        credit = account.get('total_credit', 0)
         
         # Calculate ending balance based on account type
         if account['account_type'] in ['asset', 'expense']:
@@ -2717,81 +5585,418 @@ async def get_trial_balance(user: dict = Depends(get_current_user)):
 @api_router.get("/admin/reports/inventory-valuation")
 async def get_inventory_valuation(
     user: dict = Depends(get_current_user),
-    warehouse_id: Optional[str] = None
+    warehouse_id: Optional[str] = None,
+    as_of: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000)
 ):
-    """Get inventory valuation report - stock value by product/warehouse"""
+    """Get inventory valuation report - stock value by product/warehouse.
+    
+    Items are keyset-paged by (product_id, warehouse_id): pass next_cursor back as cursor. Totals and
+    subtotals cover every row and come with the first page only. The full set is the CSV export.
+    """
+    after = parse_valuation_cursor(cursor)
+    
+    if as_of:
+        balances = [b for b in await stock_as_of(parse_as_of(as_of), warehouse_id=warehouse_id) if b['quantity'] > 0]
+        return await valuation_from_rows(balances, after, limit)
     
-    query = {"quantity": {"$gt": 0}}
+    match = {"quantity": {"$gt": 0}}
     if warehouse_id:
-        query['warehouse_id'] = warehouse_id
+        match['warehouse_id'] = warehouse_id
     
-    balances = await db.stock_balance.find(query, {"_id": 0}).to_list(10000)
+    # The page walks the unique (product_id, warehouse_id) index from the cursor; joins run on that page only
+    query = dict(match)
+    if after:
+        query['$or'] = [
+            {"product_id": {"$gt": after[0]}},
+            {"product_id": after[0], "warehouse_id": {"$gt": after[1]}}
+        ]
+    items = await db.stock_balance.aggregate([
+        {"$match": query},
+        {"$sort": {"product_id": 1, "warehouse_id": 1}},
+        {"$limit": limit},
+        {"$addFields": {"total_value": {"$multiply": ["$quantity", {"$ifNull": ["$avg_cost", 0]}]}}},
+        *valuation_join_stages()
+    ]).to_list(limit)
+    
+    report = {
+        "items": items,
+        "total_value": None,
+        "item_count": None,
+        "by_warehouse": None,
+        "by_product_type": None,
+        "value_known": True,
+        "next_cursor": valuation_cursor(items[-1]) if len(items) == limit else None
+    }
+    if after:
+        return report
     
-    # Enrich with names
-    products = {p['id']: p for p in await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "sku": 1, "product_type": 1}).to_list(10000)}
+    # Subtotals and totals over the whole set, once per report rather than once per page
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"total_value": {"$multiply": ["$quantity", {"$ifNull": ["$avg_cost", 0]}]}}},
+        {"$facet": {
+            "by_warehouse": [
+                {"$group": {"_id": "$warehouse_id", "quantity": {"$sum": "$quantity"}, "total_value": {"$sum": "$total_value"}}},
+                {"$lookup": {"from": "warehouses", "localField": "_id", "foreignField": "id", "as": "warehouse"}},
+                {"$project": {
+                    "_id": 0, "warehouse_id": "$_id", "quantity": 1, "total_value": 1,
+                    "warehouse_name": {"$ifNull": [{"$arrayElemAt": ["$warehouse.name", 0]}, ""]}
+                }},
+                {"$sort": {"total_value": -1}}
+            ],
+            "by_product_type": [
+                {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}, "total_value": {"$sum": "$total_value"}}},
+                {"$lookup": {"from": "products", "localField": "_id", "foreignField": "id", "as": "product"}},
+                {"$group": {
+                    "_id": {"$ifNull": [{"$arrayElemAt": ["$product.product_type", 0]}, ""]},
+                    "quantity": {"$sum": "$quantity"},
+                    "total_value": {"$sum": "$total_value"}
+                }},
+                {"$project": {"_id": 0, "product_type": "$_id", "quantity": 1, "total_value": 1}},
+                {"$sort": {"total_value": -1}}
+            ],
+            "totals": [
+                {"$group": {"_id": None, "total_value": {"$sum": "$total_value"}, "item_count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    result = (await db.stock_balance.aggregate(pipeline).to_list(1))[0]
+    totals = result['totals'][0] if result['totals'] else {"total_value": 0, "item_count": 0}
+    report.update(
+        total_value=totals['total_value'],
+        item_count=totals['item_count'],
+        by_warehouse=result['by_warehouse'],
+        by_product_type=result['by_product_type']
+    )
+    return report
+
+async def valuation_names(balances: List[dict]) -> tuple:
+    """Products and warehouse names referenced by valuation rows"""
+    products = {
+        p['id']: p for p in await db.products.find(
+            {"id": {"$in": list({b['product_id'] for b in balances})}},
+            {"_id": 0, "id": 1, "name": 1, "sku": 1, "product_type": 1}
+        ).to_list(None)
+    }
     warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
-    
-    result = []
+    return products, warehouses
+
+def valuation_item(balance: dict, products: dict, warehouses: dict) -> dict:
+    product = products.get(balance['product_id'], {})
+    return {
+        "product_id": balance['product_id'],
+        "product_name": product.get('name', ''),
+        "product_sku": product.get('sku', ''),
+        "product_type": product.get('product_type', ''),
+        "warehouse_id": balance['warehouse_id'],
+        "warehouse_name": warehouses.get(balance['warehouse_id'], ''),
+        "quantity": balance['quantity'],
+        "avg_cost": balance.get('avg_cost', 0),
+        "total_value": balance['quantity'] * balance.get('avg_cost', 0)
+    }
+
+def valuation_join_stages() -> list:
+    """$lookup product/warehouse names onto valuation rows"""
+    return [
+        {"$lookup": {"from": "products", "localField": "product_id", "foreignField": "id", "as": "product"}},
+        {"$lookup": {"from": "warehouses", "localField": "warehouse_id", "foreignField": "id", "as": "warehouse"}},
+        {"$project": {
+            "_id": 0,
+            "product_id": 1,
+            "product_name": {"$ifNull": [{"$arrayElemAt": ["$product.name", 0]}, ""]},
+            "product_sku": {"$ifNull": [{"$arrayElemAt": ["$product.sku", 0]}, ""]},
+            "product_type": {"$ifNull": [{"$arrayElemAt": ["$product.product_type", 0]}, ""]},
+            "warehouse_id": 1,
+            "warehouse_name": {"$ifNull": [{"$arrayElemAt": ["$warehouse.name", 0]}, ""]},
+            "quantity": 1,
+            "avg_cost": {"$ifNull": ["$avg_cost", 0]},
+            "total_value": 1
+        }}
+    ]
+
+def valuation_cursor(item: dict) -> str:
+    return f"{item['product_id']}:{item['warehouse_id']}"
+
+def parse_valuation_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    if not cursor:
+        return None
+    parts = cursor.split(':')
+    if len(parts) != 2:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple(parts)
+
+async def valuation_from_rows(balances: List[dict], after: Optional[tuple], limit: Optional[int]) -> dict:
+    """Valuation report over rows computed in Python (as_of queries), same shape as the live report"""
+    balances.sort(key=lambda b: (b['product_id'], b['warehouse_id']))
+    products, warehouses = await valuation_names(balances)
+    
+    items = []
+    by_warehouse = {}
+    by_product_type = {}
     total_value = 0
-    
     for b in balances:
         product = products.get(b['product_id'], {})
         value = b['quantity'] * b.get('avg_cost', 0)
-        
-        result.append({
-            "product_id": b['product_id'],
-            "product_name": product.get('name', ''),
-            "product_sku": product.get('sku', ''),
-            "product_type": product.get('product_type', ''),
-            "warehouse_id": b['warehouse_id'],
-            "warehouse_name": warehouses.get(b['warehouse_id'], ''),
-            "quantity": b['quantity'],
-            "avg_cost": b.get('avg_cost', 0),
-            "total_value": value
-        })
         total_value += value
-    
+        for groups, key in ((by_warehouse, b['warehouse_id']), (by_product_type, product.get('product_type', ''))):
+            group = groups.setdefault(key, {"quantity": 0, "total_value": 0})
+            group['quantity'] += b['quantity']
+            group['total_value'] += value
+        if (after is None or (b['product_id'], b['warehouse_id']) > after) and (not limit or len(items) < limit):
+            items.append(valuation_item(b, products, warehouses))
+    
+    # False when any as_of value crosses ledger rows without cost (see stock_as_of)
+    value_known = all(b.get('value_known', True) for b in balances)
+    if after:
+        return {
+            "items": items, "total_value": None, "item_count": None, "by_warehouse": None, "by_product_type": None,
+            "value_known": value_known,
+            "next_cursor": valuation_cursor(items[-1]) if limit and len(items) == limit else None
+        }
     return {
-        "items": result,
+        "items": items,
         "total_value": total_value,
-        "item_count": len(result)
+        "item_count": len(balances),
+        "value_known": value_known,
+        "by_warehouse": sorted(
+            [{"warehouse_id": k, "warehouse_name": warehouses.get(k, ''), **v} for k, v in by_warehouse.items()],
+            key=lambda g: -g['total_value']
+        ),
+        "by_product_type": sorted(
+            [{"product_type": k, **v} for k, v in by_product_type.items()],
+            key=lambda g: -g['total_value']
+        ),
+        "next_cursor": valuation_cursor(items[-1]) if limit and len(items) == limit else None
+    }
+
+@api_router.get("/admin/reports/inventory-valuation/export")
+async def export_inventory_valuation(
+    user: dict = Depends(get_current_user),
+    warehouse_id: Optional[str] = None,
+    as_of: Optional[str] = None
+):
+    """Full valuation as CSV, streamed row by row from the aggregation cursor"""
+    columns = ["product_sku", "product_name", "product_type", "warehouse_name", "quantity", "avg_cost", "total_value"]
+    
+    if as_of:
+        balances = [b for b in await stock_as_of(parse_as_of(as_of), warehouse_id=warehouse_id) if b['quantity'] > 0]
+        rows = (await valuation_from_rows(balances, None, None))['items']
+        
+        async def source():
+            for row in rows:
+                yield row
+    else:
+        match = {"quantity": {"$gt": 0}}
+        if warehouse_id:
+            match['warehouse_id'] = warehouse_id
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"product_id": 1, "warehouse_id": 1}},
+            {"$addFields": {"total_value": {"$multiply": ["$quantity", {"$ifNull": ["$avg_cost", 0]}]}}},
+            *valuation_join_stages()
+        ]
+        
+        def source():
+            return db.stock_balance.aggregate(pipeline, batchSize=1000)
+    
+    async def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        async for row in source():
+            writer.writerow([row[c] for c in columns])
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    filename = f"inventory-valuation-{as_of or datetime.now(timezone.utc).strftime('%Y-%m-%d')}.csv"
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+def parse_day_start(value: str) -> str:
+    """Start (00:00 UTC) of a YYYY-MM-DD date"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date, expected YYYY-MM-DD")
+
+def stock_card_line(entry: dict, balance: dict) -> dict:
+    """One stock card movement with the running balance after it"""
+    qty = entry['quantity_change']
+    value = entry.get('value_change', 0)
+    balance['quantity'] += qty
+    balance['value'] += value
+    return {
+        "created_at": entry['created_at'],
+        "doc_id": entry['doc_id'],
+        "doc_number": entry['doc_number'],
+        "doc_type": entry['doc_type'],
+        "warehouse_id": entry['warehouse_id'],
+        "unit_cost": entry.get('unit_cost', 0),
+        "receipt_qty": qty if qty > 0 else 0,
+        "receipt_value": value if qty > 0 else 0,
+        "issue_qty": -qty if qty < 0 else 0,
+        "issue_value": -value if qty < 0 else 0,
+        "balance_qty": balance['quantity'],
+        "balance_value": balance['value']
+    }
+
+@api_router.get("/admin/reports/stock-card")
+async def get_stock_card(
+    product_id: str,
+    from_date: str,
+    to_date: str,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Stock card (thẻ kho): opening balance, each receipt/issue with running totals, closing balance"""
+    start = parse_day_start(from_date)
+    end = parse_as_of(to_date)
+    
+    product = await db.products.find_one({"id": product_id}, {"_id": 0, "name": 1, "sku": 1})
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
+    
+    # Opening balance from the nearest snapshot plus ledger delta up to from_date
+    opening_rows = await stock_as_of(start, product_id, warehouse_id)
+    opening = {
+        "quantity": sum(r['quantity'] for r in opening_rows),
+        "value": sum(r['total_value'] for r in opening_rows),
+        "value_known": all(r['value_known'] for r in opening_rows)
     }
+    
+    query = {"product_id": product_id, "created_at": {"$gte": start, "$lt": end}}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    
+    balance = dict(opening)
+    lines = []
+    async for entry in db.stock_ledger.find(query, {"_id": 0}).sort("created_at", 1):
+        line = stock_card_line(entry, balance)
+        line['warehouse_name'] = warehouses.get(entry['warehouse_id'])
+        lines.append(line)
+    
+    return {
+        "product_id": product_id,
+        "product_name": product['name'],
+        "product_sku": product['sku'],
+        "warehouse_id": warehouse_id,
+        "warehouse_name": warehouses.get(warehouse_id) if warehouse_id else None,
+        "from_date": from_date,
+        "to_date": to_date,
+        "opening": opening,
+        "lines": lines,
+        "totals": {
+            "receipt_qty": sum(l['receipt_qty'] for l in lines),
+            "receipt_value": sum(l['receipt_value'] for l in lines),
+            "issue_qty": sum(l['issue_qty'] for l in lines),
+            "issue_value": sum(l['issue_value'] for l in lines)
+        },
+        "closing": balance
+    }
+
+@api_router.get("/admin/reports/stock-card/export")
+async def export_stock_cards(
+    from_date: str,
+    to_date: str,
+    warehouse_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Stock cards for every product/warehouse as CSV, streamed from one sorted ledger pass"""
+    start = parse_day_start(from_date)
+    end = parse_as_of(to_date)
+    
+    products = {p['id']: p for p in await db.products.find({}, {"_id": 0, "id": 1, "name": 1, "sku": 1}).to_list(None)}
+    warehouses = {w['id']: w['name'] for w in await db.warehouses.find({}, {"_id": 0, "id": 1, "name": 1}).to_list(100)}
+    openings = {
+        (r['product_id'], r['warehouse_id']): {"quantity": r['quantity'], "value": r['total_value']}
+        for r in await stock_as_of(start, warehouse_id=warehouse_id)
+    }
+    
+    query = {"created_at": {"$gte": start, "$lt": end}}
+    if warehouse_id:
+        query['warehouse_id'] = warehouse_id
+    cursor = db.stock_ledger.find(query, {"_id": 0}).sort([("product_id", 1), ("warehouse_id", 1), ("created_at", 1)])
+    
+    def csv_row(values: list) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        return buffer.getvalue()
+    
+    def card_row(key: tuple, date: str, doc_number: str, doc_type: str, line: Optional[dict], balance: dict) -> str:
+        product = products.get(key[0], {})
+        return csv_row([
+            product.get('sku', ''), product.get('name', ''), warehouses.get(key[1], ''),
+            date, doc_number, doc_type,
+            line['receipt_qty'] if line else '', line['receipt_value'] if line else '',
+            line['issue_qty'] if line else '', line['issue_value'] if line else '',
+            balance['quantity'], balance['value']
+        ])
+    
+    def opening_only(key: tuple) -> str:
+        balance = openings[key]
+        return card_row(key, from_date, "Tồn đầu kỳ", "opening", None, balance) + \
+            card_row(key, to_date, "Tồn cuối kỳ", "closing", None, balance)
+    
+    async def generate():
+        yield csv_row([
+            "product_sku", "product_name", "warehouse", "date", "doc_number", "doc_type",
+            "receipt_qty", "receipt_value", "issue_qty", "issue_value", "balance_qty", "balance_value"
+        ])
+        pending = sorted(k for k, b in openings.items() if b['quantity'] or b['value'])
+        current_key = None
+        balance = None
+        async for entry in cursor:
+            key = (entry['product_id'], entry['warehouse_id'])
+            if key != current_key:
+                if current_key:
+                    yield card_row(current_key, to_date, "Tồn cuối kỳ", "closing", None, balance)
+                # Cards with an opening balance but no movements sort before this key
+                while pending and pending[0] < key:
+                    yield opening_only(pending.pop(0))
+                if pending and pending[0] == key:
+                    pending.pop(0)
+                current_key = key
+                balance = dict(openings.get(key, {"quantity": 0, "value": 0}))
+                yield card_row(key, from_date, "Tồn đầu kỳ", "opening", None, balance)
+            line = stock_card_line(entry, balance)
+            yield card_row(key, entry['created_at'], entry['doc_number'], entry['doc_type'], line, balance)
+        if current_key:
+            yield card_row(current_key, to_date, "Tồn cuối kỳ", "closing", None, balance)
+        for key in pending:
+            yield opening_only(key)
+    
+    filename = f"the-kho-{from_date}-{to_date}.csv"
+    return StreamingResponse(
+        generate(),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
 @api_router.get("/admin/reports/profit-loss")
 async def get_profit_loss_report(user: dict = Depends(get_current_user)):
     """Get simplified profit & loss report"""
     
     # Get revenue and expense accounts
-    revenue_accounts = await db.accounts.find({"account_type": "revenue", "is_header": False}, {"_id": 0, "id": 1, "code": 1, "name": 1}).to_list(100)
-    expense_accounts = await db.accounts.find({"account_type": "expense", "is_header": False}, {"_id": 0, "id": 1, "code": 1, "name": 1}).to_list(100)
-    
-    revenue_ids = [a['id'] for a in revenue_accounts]
-    expense_ids = [a['id'] for a in expense_accounts]
-    
-    # Get totals from journal entries
-    pipeline = [
-        {"$match": {"status": "posted"}},
-        {"$unwind": "$lines"},
-        {"$match": {"$or": [
-            {"lines.account_id": {"$in": revenue_ids}},
-            {"lines.account_id": {"$in": expense_ids}}
-        ]}},
-        {"$group": {
-            "_id": "$lines.account_id",
-            "total_debit": {"$sum": "$lines.debit"},
-            "total_credit": {"$sum": "$lines.credit"}
-        }}
-    ]
-    
-    results = await db.journal_entries.aggregate(pipeline).to_list(200)
-    balance_map = {r['_id']: r for r in results}
+    # Totals come from the running debit/credit kept per account
+    projection = {"_id": 0, "id": 1, "code": 1, "name": 1}
+    revenue_accounts = await db.accounts.find({"account_type": "revenue", "is_header": False}, projection).to_list(100)
+    expense_accounts = await db.accounts.find({"account_type": "expense", "is_header": False}, projection).to_list(100)
+    await with_account_totals(revenue_accounts + expense_accounts)
     
     # Calculate revenue (credit - debit for revenue accounts)
     revenue_items = []
     total_revenue = 0
     for acc in revenue_accounts:
-        bal = balance_map.get(acc['id'], {'total_debit': 0, 'total_credit': 0})
-        amount = bal['total_credit'] - bal['total_debit']
+        amount = acc.get('total_credit', 0) - acc.get('total_debit', 0)
         if amount != 0:
             revenue_items.append({
                 "account_code": acc['code'],
@@ -2804,8 +6009,7 @@ async def get_profit_loss_report(user: dict = Depends(get_current_user)):
     expense_items = []
     total_expense = 0
     for acc in expense_accounts:
-        bal = balance_map.get(acc['id'], {'total_debit': 0, 'total_credit': 0})
-        amount = bal['total_debit'] - bal['total_credit']
+        amount = acc.get('total_debit', 0) - acc.get('total_credit', 0)
         if amount != 0:
             expense_items.append({
                 "account_code": acc['code'],
@@ -2830,12 +6034,7 @@ async def get_profit_loss_report(user: dict = Depends(get_current_user)):
 
 async def generate_ticket_number() -> str:
     """Generate repair ticket number like REP-20240206-001"""
-    date_str = datetime.now(timezone.utc).strftime('%Y%m%d')
-    start_of_day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    count = await db.repair_tickets.count_documents({
-        "created_at": {"$gte": start_of_day.isoformat()}
-    })
-    return f"REP-{date_str}-{str(count + 1).zfill(3)}"
+    return await next_sequence('REP')
 
 @api_router.get("/admin/repairs/tickets", response_model=List[RepairTicketResponse])
 async def list_repair_tickets(
@@ -3177,20 +6376,30 @@ async def reset_admin_password():
         }
 
 @api_router.post("/admin/seed")
-async def seed_data(user: dict = Depends(require_admin)):
+async def seed_data(run_async: bool = Query(False, alias="async"), user: dict = Depends(require_admin)):
     """Seed initial data for testing"""
+    if run_async:
+        return await submit_job('seed', {}, user)
+    return await seed_database()
+
+async def seed_database(progress=None) -> dict:
+    async def step(done: int, message: str):
+        if progress:
+            await progress(done, 5, message)
     
     # Seed warehouses
+    await step(0, "Warehouses")
     warehouses_data = [
-        {"id": str(uuid.uuid4()), "name": "Kho Hà Nội", "code": "WH-HN", "address": "123 Cầu Giấy, Hà Nội", "phone": "024-1234-5678", "is_default": True, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"id": str(uuid.uuid4()), "name": "Kho TP.HCM", "code": "WH-HCM", "address": "456 Quận 1, TP.HCM", "phone": "028-8765-4321", "is_default": False, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
-        {"id": str(uuid.uuid4()), "name": "Kho Đà Nẵng", "code": "WH-DN", "address": "789 Hải Châu, Đà Nẵng", "phone": "0236-111-2222", "is_default": False, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
+        {"id": str(uuid.uuid4()), "name": "Kho Hà Nội", "code": "WH-HN", "address": "123 Cầu Giấy, Hà Nội", "phone": "024-1234-5678", "latitude": 21.0285, "longitude": 105.8542, "is_default": True, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
+        {"id": str(uuid.uuid4()), "name": "Kho TP.HCM", "code": "WH-HCM", "address": "456 Quận 1, TP.HCM", "phone": "028-8765-4321", "latitude": 10.7769, "longitude": 106.7009, "is_default": False, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
+        {"id": str(uuid.uuid4()), "name": "Kho Đà Nẵng", "code": "WH-DN", "address": "789 Hải Châu, Đà Nẵng", "phone": "0236-111-2222", "latitude": 16.0544, "longitude": 108.2022, "is_default": False, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
     ]
     
     for wh in warehouses_data:
         await db.warehouses.update_one({"code": wh['code']}, {"$setOnInsert": wh}, upsert=True)
     
     # Seed categories
+    await step(1, "Categories")
     categories_data = [
         {"id": str(uuid.uuid4()), "name": "Robot hút bụi", "slug": "robot-hut-bui", "description": "Robot hút bụi thông minh", "sort_order": 1, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
         {"id": str(uuid.uuid4()), "name": "Gia dụng", "slug": "gia-dung", "description": "Thiết bị gia dụng", "sort_order": 2, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
@@ -3202,6 +6411,7 @@ async def seed_data(user: dict = Depends(require_admin)):
         await db.categories.update_one({"slug": cat['slug']}, {"$setOnInsert": cat}, upsert=True)
     
     # Seed brands
+    await step(2, "Brands")
     brands_data = [
         {"id": str(uuid.uuid4()), "name": "Ecovacs", "slug": "ecovacs", "country": "Trung Quốc", "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
         {"id": str(uuid.uuid4()), "name": "Roborock", "slug": "roborock", "country": "Trung Quốc", "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
@@ -3220,6 +6430,7 @@ async def seed_data(user: dict = Depends(require_admin)):
     roborock = await db.brands.find_one({"slug": "roborock"}, {"_id": 0, "id": 1})
     
     # Seed products
+    await step(3, "Products")
     products_data = [
         {
             "id": str(uuid.uuid4()), "name": "Ecovacs Deebot X2 Omni", "slug": "ecovacs-deebot-x2-omni",
@@ -3258,6 +6469,7 @@ async def seed_data(user: dict = Depends(require_admin)):
         await db.products.update_one({"sku": product['sku']}, {"$setOnInsert": product}, upsert=True)
     
     # Seed Chart of Accounts (Vietnamese Accounting Standards)
+    await step(4, "Chart of accounts")
     accounts_data = [
         # Assets (1xx)
         {"id": str(uuid.uuid4()), "code": "1", "name": "Tài sản", "account_type": "asset", "is_header": True, "is_active": True, "created_at": datetime.now(timezone.utc).isoformat()},
@@ -3295,6 +6507,7 @@ async def seed_data(user: dict = Depends(require_admin)):
     for account in accounts_data:
         await db.accounts.update_one({"code": account['code']}, {"$setOnInsert": account}, upsert=True)
     
+    await step(5, "Done")
     return {"message": "Seed data created successfully"}
 
 # ==================== ROOT ====================
@@ -3407,6 +6620,362 @@ async def delete_media(
     
     return {"message": "Media deleted successfully"}
 
+# ==================== BACKGROUND JOBS ====================
+# Long postings and imports run from the jobs collection instead of inside the HTTP request.
+# Workers claim a job with an atomic find_one_and_update and hold a lease they renew by heartbeat;
+# a job whose worker died is picked up again once the lease lapses. Handlers must be safe to re-run.
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '1'))
+JOB_LEASE_SECONDS = 60
+JOB_HEARTBEAT_SECONDS = 5
+
+JOB_HANDLERS = {}
+
+def job_handler(job_type: str):
+    """Register an async handler(job, user) for a job type"""
+    def register(handler):
+        JOB_HANDLERS[job_type] = handler
+        return handler
+    return register
+
+class JobCreate(BaseModel):
+    job_type: str
+    params: dict = {}
+    max_attempts: int = 3
+
+async def submit_job(job_type: str, params: dict, user: dict, max_attempts: int = 3) -> dict:
+    if job_type not in JOB_HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Unknown job type {job_type}")
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "job_type": job_type,
+        "params": params,
+        "status": "queued",
+        "progress": {"done": 0, "total": None, "message": None},
+        "result": None,
+        "error": None,
+        "attempts": 0,
+        "max_attempts": max(max_attempts, 1),
+        "cancel_requested": False,
+        "run_after": now,
+        "locked_by": None,
+        "locked_until": None,
+        "created_by": user['id'],
+        "created_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "updated_at": now
+    }
+    await db.jobs.insert_one(job)
+    return {"job_id": job['id'], "status": "queued"}
+
+async def report_job_progress(job: dict, done: int, total: Optional[int] = None, message: Optional[str] = None):
+    """Called by handlers to publish progress for status polling"""
+    await db.jobs.update_one(
+        {"id": job['id']},
+        {"$set": {"progress": {"done": done, "total": total, "message": message},
+                  "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+def job_progress(job: dict):
+    """progress= callback for long-running helpers, publishing to the job document"""
+    async def progress(done: int, total: Optional[int] = None, message: Optional[str] = None):
+        await report_job_progress(job, done, total, message)
+    return progress
+
+def lease_until() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+
+async def claim_job(worker_id: str) -> Optional[dict]:
+    now = datetime.now(timezone.utc).isoformat()
+    return await db.jobs.find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lt": now}}
+            ],
+            "cancel_requested": {"$ne": True}
+        },
+        {
+            "$set": {"status": "running", "locked_by": worker_id, "locked_until": lease_until(),
+                     "started_at": now, "updated_at": now},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        return_document=True,
+        projection={"_id": 0}
+    )
+
+async def finish_job(job: dict, worker_id: str, fields: dict):
+    """Final status update, only if this worker still owns the job"""
+    now = datetime.now(timezone.utc).isoformat()
+    await db.jobs.update_one(
+        {"id": job['id'], "locked_by": worker_id, "status": "running"},
+        {"$set": {**fields, "locked_by": None, "locked_until": None, "updated_at": now}}
+    )
+
+async def run_job(job: dict, worker_id: str):
+    now = datetime.now(timezone.utc).isoformat()
+    if job['attempts'] > job['max_attempts']:
+        await finish_job(job, worker_id, {"status": "failed", "error": "Worker lost too many times", "finished_at": now})
+        return
+    
+    handler = JOB_HANDLERS.get(job['job_type'])
+    user = await db.users.find_one({"id": job['created_by']}, {"_id": 0, "password": 0})
+    if not handler or not user:
+        await finish_job(job, worker_id, {"status": "failed", "error": "Unknown job type or user", "finished_at": now})
+        return
+    
+    task = asyncio.create_task(handler(job, user))
+    cancel_requested = False
+    try:
+        # Heartbeat: renew the lease and watch for cancellation while the handler runs
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=JOB_HEARTBEAT_SECONDS)
+            if done:
+                break
+            current = await db.jobs.find_one_and_update(
+                {"id": job['id'], "locked_by": worker_id},
+                {"$set": {"locked_until": lease_until()}},
+                projection={"_id": 0, "cancel_requested": 1},
+                return_document=True
+            )
+            if not current or current.get('cancel_requested'):
+                cancel_requested = True
+                task.cancel()
+        result = task.result()
+    except asyncio.CancelledError:
+        if not cancel_requested:
+            # The worker itself is shutting down; the lease lapses and another worker retries
+            task.cancel()
+            raise
+        await finish_job(job, worker_id, {"status": "cancelled", "finished_at": datetime.now(timezone.utc).isoformat()})
+        return
+    except HTTPException as e:
+        # Business rule failures (insufficient stock, already posted...) will not succeed on retry
+        await finish_job(job, worker_id, {"status": "failed", "error": str(e.detail),
+                                         "finished_at": datetime.now(timezone.utc).isoformat()})
+        return
+    except Exception as e:
+        logger.exception(f"Job {job['id']} ({job['job_type']}) failed on attempt {job['attempts']}")
+        if job['attempts'] < job['max_attempts']:
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=min(5 * 2 ** job['attempts'], 300))
+            await finish_job(job, worker_id, {"status": "queued", "error": str(e), "run_after": retry_at.isoformat()})
+        else:
+            await finish_job(job, worker_id, {"status": "failed", "error": str(e),
+                                             "finished_at": datetime.now(timezone.utc).isoformat()})
+        return
+    
+    await finish_job(job, worker_id, {"status": "succeeded", "result": result, "error": None,
+                                     "finished_at": datetime.now(timezone.utc).isoformat()})
+
+async def job_worker(worker_id: str):
+    """Claim and run jobs until cancelled"""
+    while True:
+        try:
+            job = await claim_job(worker_id)
+        except Exception as e:
+            logger.warning(f"Job worker {worker_id} could not claim a job: {e}")
+            job = None
+        if not job:
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            continue
+        await run_job(job, worker_id)
+
+@job_handler('post_inventory_doc')
+async def post_inventory_doc_job(job: dict, user: dict):
+    doc_id = job['params']['doc_id']
+    doc = await db.inventory_docs.find_one({"id": doc_id}, {"_id": 0, "status": 1, "doc_number": 1})
+    if doc and doc['status'] == 'posted' and job['attempts'] > 1:
+        # An earlier attempt committed before the job could be marked done
+        return {"message": "Document posted successfully", "doc_number": doc['doc_number']}
+    return await run_in_transaction(lambda session: post_inventory_doc_in_session(doc_id, user, session))
+
+@job_handler('complete_sales_order')
+async def complete_sales_order_job(job: dict, user: dict):
+    order_id = job['params']['order_id']
+    order = await db.sales_orders.find_one({"id": order_id}, {"_id": 0, "status": 1, "order_number": 1})
+    if order and order['status'] == 'completed' and job['attempts'] > 1:
+        return {"message": "Order completed, warranty activated", "order_number": order['order_number']}
+    return await run_in_transaction(lambda session: complete_sales_order_in_session(order_id, user, session))
+
+@job_handler('stock_snapshot')
+async def stock_snapshot_job(job: dict, user: dict):
+    period = job['params'].get('period', 'daily')
+    as_of = job['params'].get('as_of')
+    cutoff = parse_as_of(as_of) if as_of else period_cutoff(period)
+    return {"cutoff": cutoff, "rows": await build_stock_snapshot(cutoff, period, progress=job_progress(job))}
+
+@job_handler('rebuild_sales_rollups')
+async def rebuild_sales_rollups_job(job: dict, user: dict):
+    return {"rows": await rebuild_sales_rollups(progress=job_progress(job))}
+
+@job_handler('normalize_customer_phones')
+async def normalize_customer_phones_job(job: dict, user: dict):
+    return await normalize_customer_phones(progress=job_progress(job))
+
+@job_handler('rebalance_inventory')
+async def rebalance_inventory_job(job: dict, user: dict):
+    # The job id tags the drafts, so a retried job reuses the transfers its earlier attempt created
+    result = await rebalance_inventory(user, **job['params'], run_id=job['id'], progress=job_progress(job))
+    # Keep the job document well under the BSON size limit for very large catalogs
+    return {**result, "transfer_count": len(result['transfers']), "transfers": result['transfers'][:1000]}
+
+@job_handler('rebuild_account_totals')
+async def rebuild_account_totals_job(job: dict, user: dict):
+    return await rebuild_account_totals(**job['params'])
+
+@job_handler('seed')
+async def seed_job(job: dict, user: dict):
+    return await seed_database(progress=job_progress(job))
+
+@api_router.post("/admin/jobs")
+async def create_job(data: JobCreate, user: dict = Depends(require_admin)):
+    return await submit_job(data.job_type, data.params, user, data.max_attempts)
+
+def job_scope(user: dict) -> dict:
+    """Admins and managers see every job; other staff only the jobs they submitted (e.g. async postings)"""
+    if user.get('role') in ['admin', 'manager']:
+        return {}
+    return {"created_by": user['id']}
+
+@api_router.get("/admin/jobs")
+async def list_jobs(
+    user: dict = Depends(get_current_user),
+    status: Optional[str] = None,
+    job_type: Optional[str] = None,
+    limit: int = 50
+):
+    query = job_scope(user)
+    if status:
+        query['status'] = status
+    if job_type:
+        query['job_type'] = job_type
+    return await db.jobs.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str, user: dict = Depends(get_current_user)):
+    job = await db.jobs.find_one({"id": job_id, **job_scope(user)}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.post("/admin/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Cancel a queued job, or ask the worker to stop a running one"""
+    now = datetime.now(timezone.utc).isoformat()
+    scope = job_scope(user)
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, "status": "queued", **scope},
+        {"$set": {"status": "cancelled", "cancel_requested": True, "finished_at": now, "updated_at": now}},
+        projection={"_id": 0},
+        return_document=True
+    )
+    if job:
+        return {"message": "Job cancelled", "status": "cancelled"}
+    
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, "status": "running", **scope},
+        {"$set": {"cancel_requested": True, "updated_at": now}},
+        projection={"_id": 0},
+        return_document=True
+    )
+    if job:
+        return {"message": "Cancellation requested", "status": "running"}
+    
+    if not await db.jobs.find_one({"id": job_id, **scope}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="Job not found")
+    raise HTTPException(status_code=400, detail="Job already finished")
+
+# ==================== IDEMPOTENCY KEYS ====================
+# POS clients on flaky networks retry POSTs with the same Idempotency-Key header; the first
+# response is stored and replayed so a retried create/post/complete is applied only once.
+
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_LOCK_SECONDS = 120
+
+def idempotency_scope(request: Request) -> Optional[str]:
+    """Keys are per user so two tablets cannot collide; None when the token is missing or invalid"""
+    auth = request.headers.get('authorization', '')
+    if not auth.lower().startswith('bearer '):
+        return None
+    try:
+        payload = jwt.decode(auth[7:], JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    return payload.get('sub')
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get('idempotency-key')
+    if not key or request.method != 'POST' or not request.url.path.startswith('/api/admin/'):
+        return await call_next(request)
+    subject = idempotency_scope(request)
+    if not subject:
+        # Let the endpoint reject the request as unauthenticated
+        return await call_next(request)
+    
+    body = await request.body()
+    fingerprint = hashlib.sha256(
+        request.method.encode() + b' ' + str(request.url.path).encode() + b'?' +
+        str(request.url.query).encode() + b'\n' + body
+    ).hexdigest()
+    record_id = hashlib.sha256(f"{subject}:{key}".encode()).hexdigest()
+    now = datetime.now(timezone.utc)
+    
+    try:
+        # created_at is a BSON date so the TTL index can expire it
+        await db.idempotency_keys.insert_one({
+            "_id": record_id, "fingerprint": fingerprint, "status": "in_progress", "created_at": now
+        })
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record and record['fingerprint'] != fingerprint:
+            return JSONResponse(status_code=422, content={"detail": "Idempotency-Key was already used for a different request"})
+        if record and record['status'] == 'completed':
+            return Response(
+                content=record['body'],
+                status_code=record['status_code'],
+                media_type=record.get('media_type'),
+                headers={"Idempotent-Replayed": "true"}
+            )
+        # Take over a placeholder left behind by a crashed request, otherwise report it in flight
+        stale = now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        claimed = await db.idempotency_keys.update_one(
+            {"_id": record_id, "status": "in_progress", "created_at": {"$lt": stale}},
+            {"$set": {"created_at": now}}
+        )
+        if record and claimed.modified_count == 0:
+            return JSONResponse(status_code=409, content={"detail": "A request with this Idempotency-Key is still in progress"})
+        if not record:
+            return await idempotency_middleware(request, call_next)
+    
+    try:
+        response = await call_next(request)
+        content = b"".join([chunk async for chunk in response.body_iterator])
+    except Exception:
+        await db.idempotency_keys.delete_one({"_id": record_id})
+        raise
+    
+    if response.status_code >= 500:
+        # Server errors are not final; let the client retry for real
+        await db.idempotency_keys.delete_one({"_id": record_id})
+    else:
+        await db.idempotency_keys.update_one(
+            {"_id": record_id},
+            {"$set": {"status": "completed", "status_code": response.status_code,
+                      "media_type": response.media_type or response.headers.get('content-type'),
+                      "body": content}}
+        )
+    return Response(
+        content=content,
+        status_code=response.status_code,
+        headers={k: v for k, v in response.headers.items() if k.lower() != 'content-length'},
+        media_type=response.media_type
+    )
+
 # Include router and middleware
 app.include_router(api_router)
 
@@ -3421,6 +6990,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Indexes backing hot query paths; failures (e.g. legacy duplicates) are logged, not fatal
+INDEXES = [
+    ("stock_balance", [("product_id", 1), ("warehouse_id", 1)], {"unique": True}),
+    ("stock_ledger", [("doc_id", 1)], {}),
+    ("stock_ledger", [("created_at", 1)], {}),
+    ("stock_ledger", [("product_id", 1), ("warehouse_id", 1), ("created_at", 1)], {}),
+    ("stock_snapshots", [("cutoff", 1), ("product_id", 1), ("warehouse_id", 1)], {"unique": True}),
+    ("stock_balance", [("low_stock", 1), ("warehouse_id", 1)], {"partialFilterExpression": {"low_stock": True}}),
+    ("cost_layers", [("product_id", 1), ("warehouse_id", 1)], {"unique": True}),
+    ("serial_items", [("serial_number", 1)], {"unique": True}),
+    ("serial_items", [("imei", 1)], {"unique": True, "partialFilterExpression": {"imei": {"$gt": ""}}}),
+    ("products", [("barcode", 1)], {"unique": True, "partialFilterExpression": {"barcode": {"$gt": ""}}}),
+    ("stocktake_lines", [("stocktake_id", 1), ("product_id", 1)], {"unique": True}),
+    ("stock_reservations", [("order_id", 1)], {}),
+    ("jobs", [("id", 1)], {"unique": True}),
+    ("jobs", [("status", 1), ("run_after", 1)], {}),
+    ("customers", [("phone", 1)], {"unique": True}),
+    ("customers", [("phone_national", 1)], {}),
+    ("customers", [("phone_last4", 1)], {}),
+    ("sales_orders", [("customer_id", 1), ("created_at", -1)], {}),
+    ("serial_items", [("customer_id", 1), ("warranty_end", 1)], {}),
+    ("serial_items", [("status", 1), ("warranty_end", 1), ("serial_number", 1)], {}),
+    ("repair_tickets", [("customer_id", 1), ("created_at", -1)], {}),
+    ("sales_daily", [("day", 1), ("product_id", 1), ("warehouse_id", 1)], {"unique": True}),
+    ("sales_daily_orders", [("day", 1), ("warehouse_id", 1)], {"unique": True}),
+    ("account_totals", [("account_id", 1), ("bucket", 1)], {"unique": True}),
+    ("inventory_docs", [("run_id", 1), ("warehouse_id", 1), ("dest_warehouse_id", 1)],
+     {"unique": True, "partialFilterExpression": {"run_id": {"$type": "string"}}}),
+    ("sales_orders", [("status", 1), ("completed_at", 1)], {}),
+    ("idempotency_keys", [("created_at", 1)], {"expireAfterSeconds": IDEMPOTENCY_TTL_HOURS * 3600}),
+    ("stock_reservations", [("status", 1), ("expires_at", 1)], {}),
+    ("inventory_docs", [("doc_number", 1)], {"unique": True}),
+    ("sales_orders", [("order_number", 1)], {"unique": True}),
+    ("journal_entries", [("entry_number", 1)], {"unique": True}),
+    ("repair_tickets", [("ticket_number", 1)], {"unique": True}),
+]
+
+@app.on_event("startup")
+async def create_indexes():
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Failed to create index {keys} on {collection}: {e}")
+
+async def migrate_customer_phones():
+    """Run the phone backfill once when customers from before phone normalization remain"""
+    if await db.customers.find_one({"phone_national": {"$exists": False}}, {"_id": 1}):
+        result = await normalize_customer_phones()
+        logger.info(
+            f"Normalized {result['normalized']} customer phones; "
+            f"{len(result['duplicates'])} duplicates and {len(result['invalid'])} invalid numbers need review"
+        )
+
+@app.on_event("startup")
+async def start_phone_migration():
+    asyncio.create_task(migrate_customer_phones())
+
+@app.on_event("startup")
+async def start_reservation_sweeper():
+    if RESERVATION_SWEEP_SECONDS > 0:
+        asyncio.create_task(reservation_sweeper())
+
+@app.on_event("startup")
+async def start_job_workers():
+    for i in range(JOB_WORKERS):
+        asyncio.create_task(job_worker(f"{os.uname().nodename}-{os.getpid()}-{i}"))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
@@ -0,0 +1,25 @@
+"""
+Write stock snapshots used by as_of inventory queries.
+
+Schedule from cron just after the UTC period boundary, e.g.:
+    5 0 * * *  cd /app/backend && python snapshot_stock.py daily
+    15 0 1 * * cd /app/backend && python snapshot_stock.py monthly
+"""
+import asyncio
+import sys
+
+from server import build_stock_snapshot, period_cutoff, client
+
+
+async def main(period: str):
+    cutoff = period_cutoff(period)
+    rows = await build_stock_snapshot(cutoff, period)
+    print(f"{period} snapshot at {cutoff}: {rows} rows")
+    client.close()
+
+
+if __name__ == "__main__":
+    period = sys.argv[1] if len(sys.argv) > 1 else "daily"
+    if period not in ("daily", "monthly"):
+        sys.exit("Usage: python snapshot_stock.py [daily|monthly]")
+    asyncio.run(main(period))
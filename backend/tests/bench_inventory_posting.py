@@ -0,0 +1,93 @@
+"""
+Benchmark inventory document posting for OTNT ERP
+Posts receipt + matching issue documents with 10/100/1000 lines and reports /post latency.
+Posting time should stay roughly flat as the line count grows.
+
+Usage:
+    REACT_APP_BACKEND_URL=http://localhost:8000 python tests/bench_inventory_posting.py
+"""
+import os
+import time
+import requests
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+TEST_EMAIL = "admin@otnt.vn"
+TEST_PASSWORD = "admin123"
+
+LINE_COUNTS = [10, 100, 1000]
+RUNS = 3
+
+
+def login():
+    response = requests.post(f"{BASE_URL}/api/auth/login", json={
+        "email": TEST_EMAIL,
+        "password": TEST_PASSWORD
+    })
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def create_doc(headers, doc_type, warehouse_id, products, line_count):
+    lines = [
+        {
+            "product_id": products[i % len(products)]["id"],
+            "quantity": 1,
+            "unit_cost": 100000,
+            "serial_numbers": []
+        }
+        for i in range(line_count)
+    ]
+    response = requests.post(
+        f"{BASE_URL}/api/admin/inventory/documents",
+        json={
+            "doc_type": doc_type,
+            "warehouse_id": warehouse_id,
+            "note": f"Benchmark {doc_type} {line_count} lines",
+            "lines": lines
+        },
+        headers=headers
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def timed_post(headers, doc_id):
+    start = time.perf_counter()
+    response = requests.post(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post", headers=headers)
+    elapsed = time.perf_counter() - start
+    response.raise_for_status()
+    return elapsed
+
+
+def main():
+    headers = login()
+    warehouses = requests.get(f"{BASE_URL}/api/admin/warehouses", headers=headers).json()
+    products = requests.get(
+        f"{BASE_URL}/api/admin/products",
+        params={"limit": 1000},
+        headers=headers
+    ).json()
+    products = [p for p in products if p["product_type"] != "service"]
+    if not warehouses or not products:
+        raise SystemExit("Need at least one warehouse and one product (run /api/admin/seed first)")
+
+    warehouse_id = warehouses[0]["id"]
+    print(f"Posting against {warehouses[0]['name']} with {len(products)} distinct products")
+    print(f"{'lines':>6} {'receipt (ms)':>14} {'issue (ms)':>12}")
+
+    for line_count in LINE_COUNTS:
+        receipt_times = []
+        issue_times = []
+        for _ in range(RUNS):
+            receipt_id = create_doc(headers, "receipt", warehouse_id, products, line_count)
+            receipt_times.append(timed_post(headers, receipt_id))
+            # Issue the same quantities back out so repeated runs leave stock unchanged
+            issue_id = create_doc(headers, "issue", warehouse_id, products, line_count)
+            issue_times.append(timed_post(headers, issue_id))
+
+        print(f"{line_count:>6} {min(receipt_times) * 1000:>14.1f} {min(issue_times) * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark sales order creation for OTNT ERP
+Creates draft orders with 1/50/500 lines and reports create latency.
+Products, serials and stock are fetched in a fixed number of queries, so
+creation time should grow slowly with the line count.
+
+Usage:
+    REACT_APP_BACKEND_URL=http://localhost:8000 python tests/bench_sales_order_create.py
+"""
+import os
+import time
+import requests
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+TEST_EMAIL = "admin@otnt.vn"
+TEST_PASSWORD = "admin123"
+
+LINE_COUNTS = [1, 50, 500]
+RUNS = 3
+
+
+def login():
+    response = requests.post(f"{BASE_URL}/api/auth/login", json={
+        "email": TEST_EMAIL,
+        "password": TEST_PASSWORD
+    })
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def receive_stock(headers, warehouse_id, products, quantity):
+    """Receive enough stock that every benchmark order passes availability checks"""
+    response = requests.post(
+        f"{BASE_URL}/api/admin/inventory/documents",
+        json={
+            "doc_type": "receipt",
+            "warehouse_id": warehouse_id,
+            "note": "Benchmark sales order stock",
+            "lines": [
+                {"product_id": p["id"], "quantity": quantity, "unit_cost": 100000, "serial_numbers": []}
+                for p in products
+            ]
+        },
+        headers=headers
+    )
+    response.raise_for_status()
+    doc_id = response.json()["id"]
+    requests.post(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post", headers=headers).raise_for_status()
+
+
+def get_customer(headers):
+    customers = requests.get(f"{BASE_URL}/api/admin/customers", headers=headers).json()
+    if customers:
+        return customers[0]["id"]
+    response = requests.post(
+        f"{BASE_URL}/api/admin/customers",
+        json={"name": "Benchmark Customer", "phone": "0900000000"},
+        headers=headers
+    )
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def timed_create(headers, customer_id, warehouse_id, products, line_count):
+    lines = [
+        {
+            "product_id": products[i % len(products)]["id"],
+            "quantity": 1,
+            "unit_price": 150000,
+            "serial_numbers": []
+        }
+        for i in range(line_count)
+    ]
+    start = time.perf_counter()
+    response = requests.post(
+        f"{BASE_URL}/api/admin/sales/orders",
+        json={"customer_id": customer_id, "warehouse_id": warehouse_id, "lines": lines},
+        headers=headers
+    )
+    elapsed = time.perf_counter() - start
+    response.raise_for_status()
+    # Drafts hold no stock; delete so repeated runs do not pile up orders
+    requests.delete(f"{BASE_URL}/api/admin/sales/orders/{response.json()['id']}", headers=headers)
+    return elapsed
+
+
+def main():
+    headers = login()
+    warehouses = requests.get(f"{BASE_URL}/api/admin/warehouses", headers=headers).json()
+    products = requests.get(
+        f"{BASE_URL}/api/admin/products",
+        params={"limit": 1000},
+        headers=headers
+    ).json()
+    products = [p for p in products if p["product_type"] != "service" and not p.get("track_serial")]
+    if not warehouses or not products:
+        raise SystemExit("Need at least one warehouse and one non-serial product (run /api/admin/seed first)")
+
+    warehouse_id = warehouses[0]["id"]
+    customer_id = get_customer(headers)
+    receive_stock(headers, warehouse_id, products, max(LINE_COUNTS))
+    print(f"Creating orders in {warehouses[0]['name']} with {len(products)} distinct products")
+    print(f"{'lines':>6} {'create (ms)':>13}")
+
+    for line_count in LINE_COUNTS:
+        times = [timed_create(headers, customer_id, warehouse_id, products, line_count) for _ in range(RUNS)]
+        print(f"{line_count:>6} {min(times) * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Test Idempotency-Key handling for OTNT ERP
+Tests: Stored response replay, Reused key with a different body, Concurrent retries
+"""
+import pytest
+import requests
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+TEST_EMAIL = "admin@otnt.vn"
+TEST_PASSWORD = "admin123"
+
+
+class TestIdempotencyKeys:
+    """Test that retried admin POSTs with the same Idempotency-Key are applied once"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Setup - get auth token, a warehouse and a stock product"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": TEST_EMAIL,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        
+        warehouses = requests.get(f"{BASE_URL}/api/admin/warehouses", headers=self.headers).json()
+        products = requests.get(f"{BASE_URL}/api/admin/products", headers=self.headers).json()
+        stock_products = [p for p in products if p["product_type"] != "service" and not p.get("track_serial")]
+        if not warehouses or not stock_products:
+            pytest.skip("No warehouses or stock products available")
+        self.warehouse_id = warehouses[0]["id"]
+        self.product_id = stock_products[0]["id"]
+    
+    def receipt_body(self, reference, quantity=1):
+        return {
+            "doc_type": "receipt",
+            "warehouse_id": self.warehouse_id,
+            "reference": reference,
+            "lines": [{"product_id": self.product_id, "quantity": quantity, "unit_cost": 1000}]
+        }
+    
+    def count_documents(self, reference):
+        docs = requests.get(
+            f"{BASE_URL}/api/admin/inventory/documents",
+            params={"doc_type": "receipt", "status": "draft", "limit": 200},
+            headers=self.headers
+        ).json()
+        return len([d for d in docs if d.get("reference") == reference])
+    
+    def test_replayed_key_returns_stored_response(self):
+        """Test that a retry with the same key and body replays the first response"""
+        reference = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        headers = {**self.headers, "Idempotency-Key": str(uuid.uuid4())}
+        
+        first = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json=self.receipt_body(reference), headers=headers)
+        assert first.status_code == 200, f"Failed to create document: {first.text}"
+        assert first.headers.get("Idempotent-Replayed") is None
+        
+        second = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json=self.receipt_body(reference), headers=headers)
+        assert second.status_code == 200
+        assert second.headers.get("Idempotent-Replayed") == "true"
+        assert second.json()["id"] == first.json()["id"]
+        assert second.json()["doc_number"] == first.json()["doc_number"]
+        
+        assert self.count_documents(reference) == 1, "Retry created a second document"
+        print(f"✓ Retry replayed {first.json()['doc_number']} without creating a new document")
+    
+    def test_replayed_post_is_applied_once(self):
+        """Test that retrying a document posting does not move stock twice"""
+        reference = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        create = requests.post(
+            f"{BASE_URL}/api/admin/inventory/documents",
+            json=self.receipt_body(reference, quantity=3),
+            headers=self.headers
+        )
+        assert create.status_code == 200
+        doc_id = create.json()["id"]
+        
+        headers = {**self.headers, "Idempotency-Key": str(uuid.uuid4())}
+        first = requests.post(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post", headers=headers)
+        assert first.status_code == 200, f"Failed to post document: {first.text}"
+        second = requests.post(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post", headers=headers)
+        assert second.status_code == 200, "Retry was not replayed (a real second post answers 400)"
+        assert second.headers.get("Idempotent-Replayed") == "true"
+        assert second.json() == first.json()
+        print("✓ Retried posting replayed the first response")
+    
+    def test_reused_key_with_different_body_rejected(self):
+        """Test that reusing a key for a different request returns 422"""
+        reference = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        headers = {**self.headers, "Idempotency-Key": str(uuid.uuid4())}
+        
+        first = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json=self.receipt_body(reference), headers=headers)
+        assert first.status_code == 200
+        
+        second = requests.post(
+            f"{BASE_URL}/api/admin/inventory/documents",
+            json=self.receipt_body(reference, quantity=2),
+            headers=headers
+        )
+        assert second.status_code == 422, f"Expected 422, got {second.status_code}"
+        assert self.count_documents(reference) == 1
+        print("✓ Reused key with a different body rejected")
+    
+    def test_keys_are_scoped_per_request_path(self):
+        """Test that the same key on a different endpoint is treated as a different request"""
+        headers = {**self.headers, "Idempotency-Key": str(uuid.uuid4())}
+        reference = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        
+        first = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json=self.receipt_body(reference), headers=headers)
+        assert first.status_code == 200
+        other = requests.post(f"{BASE_URL}/api/admin/reports/sales/rebuild", headers=headers)
+        assert other.status_code == 422
+        print("✓ Key reused on another endpoint rejected")
+    
+    def test_concurrent_retries_apply_once(self):
+        """Test that retries racing the first request get 409 or the replay, never a second execution"""
+        reference = f"TEST-IDEM-{uuid.uuid4().hex[:8]}"
+        headers = {**self.headers, "Idempotency-Key": str(uuid.uuid4())}
+        body = self.receipt_body(reference)
+        
+        def send(_):
+            return requests.post(f"{BASE_URL}/api/admin/inventory/documents", json=body, headers=headers)
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            responses = list(pool.map(send, range(8)))
+        
+        statuses = [r.status_code for r in responses]
+        fresh = [r for r in responses if r.status_code == 200 and r.headers.get("Idempotent-Replayed") is None]
+        assert set(statuses) <= {200, 409}, f"Unexpected statuses: {statuses}"
+        assert len(fresh) == 1, f"Expected one execution, got {len(fresh)}"
+        for r in responses:
+            if r.status_code == 409:
+                assert "in progress" in r.json()["detail"]
+        assert self.count_documents(reference) == 1
+        print(f"✓ Concurrent retries: {statuses.count(409)} in flight (409), one execution")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,170 @@
+"""
+Test Background Jobs for OTNT ERP
+Tests: Async posting, Status polling, Cancel, Per-user job scope
+"""
+import pytest
+import requests
+import os
+import time
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+TEST_EMAIL = "admin@otnt.vn"
+TEST_PASSWORD = "admin123"
+
+# Workers poll every JOB_POLL_SECONDS (1s by default)
+JOB_WAIT_SECONDS = 30
+
+
+class TestJobs:
+    """Test job submission, status polling and cancellation through async document posting"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Setup - get auth token, a warehouse and a stock product"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": TEST_EMAIL,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        
+        warehouses = requests.get(f"{BASE_URL}/api/admin/warehouses", headers=self.headers).json()
+        products = requests.get(f"{BASE_URL}/api/admin/products", headers=self.headers).json()
+        stock_products = [p for p in products if p["product_type"] != "service" and not p.get("track_serial")]
+        if not warehouses or not stock_products:
+            pytest.skip("No warehouses or stock products available")
+        self.warehouse_id = warehouses[0]["id"]
+        self.product_id = stock_products[0]["id"]
+    
+    def create_receipt(self, headers=None):
+        response = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json={
+            "doc_type": "receipt",
+            "warehouse_id": self.warehouse_id,
+            "reference": f"TEST-JOB-{uuid.uuid4().hex[:8]}",
+            "lines": [{"product_id": self.product_id, "quantity": 1, "unit_cost": 1000}]
+        }, headers=headers or self.headers)
+        assert response.status_code == 200, f"Failed to create document: {response.text}"
+        return response.json()["id"]
+    
+    def submit_post(self, doc_id, headers=None):
+        response = requests.post(
+            f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post",
+            params={"async": "true"},
+            headers=headers or self.headers
+        )
+        assert response.status_code == 200, f"Failed to submit job: {response.text}"
+        data = response.json()
+        assert data["status"] == "queued"
+        return data["job_id"]
+    
+    def wait_for_job(self, job_id):
+        deadline = time.time() + JOB_WAIT_SECONDS
+        while time.time() < deadline:
+            job = requests.get(f"{BASE_URL}/api/admin/jobs/{job_id}", headers=self.headers).json()
+            if job["status"] in ["succeeded", "failed", "cancelled"]:
+                return job
+            time.sleep(0.5)
+        pytest.fail(f"Job {job_id} did not finish within {JOB_WAIT_SECONDS}s")
+    
+    def staff_headers(self):
+        suffix = uuid.uuid4().hex[:8]
+        response = requests.post(f"{BASE_URL}/api/auth/register", json={
+            "email": f"test_job_staff_{suffix}@otnt.vn",
+            "password": "staff123",
+            "full_name": f"Test Job Staff {suffix}",
+            "role": "staff"
+        })
+        assert response.status_code == 200, f"Failed to register staff user: {response.text}"
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    
+    def test_async_post_runs_to_completion(self):
+        """Test that an async posting is queued, then picked up and finished by a worker"""
+        doc_id = self.create_receipt()
+        job_id = self.submit_post(doc_id)
+        
+        job = self.wait_for_job(job_id)
+        assert job["status"] == "succeeded", f"Job ended {job['status']}: {job.get('error')}"
+        assert job["job_type"] == "post_inventory_doc"
+        assert job["attempts"] == 1
+        assert job["finished_at"]
+        assert job["result"]["doc_number"]
+        
+        doc = requests.get(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}", headers=self.headers).json()
+        assert doc["status"] == "posted"
+        print(f"✓ Job posted {job['result']['doc_number']}")
+    
+    def test_failed_job_reports_error(self):
+        """Test that a business rule failure ends the job as failed with the error message"""
+        doc_id = self.create_receipt()
+        requests.post(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}/post", headers=self.headers)
+        
+        job = self.wait_for_job(self.submit_post(doc_id))
+        assert job["status"] == "failed"
+        assert "already posted" in job["error"]
+        print("✓ Posting an already posted document failed the job without retrying")
+    
+    def test_job_listed_by_type(self):
+        """Test that a submitted job shows up in the filtered job list"""
+        job_id = self.submit_post(self.create_receipt())
+        
+        response = requests.get(
+            f"{BASE_URL}/api/admin/jobs",
+            params={"job_type": "post_inventory_doc", "limit": 200},
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        jobs = response.json()
+        assert job_id in [j["id"] for j in jobs]
+        assert all(j["job_type"] == "post_inventory_doc" for j in jobs)
+        print(f"✓ Job list returned {len(jobs)} posting jobs")
+    
+    def test_cancel_job(self):
+        """Test that cancel stops a queued job, flags a running one and rejects a finished one"""
+        doc_id = self.create_receipt()
+        job_id = self.submit_post(doc_id)
+        
+        response = requests.post(f"{BASE_URL}/api/admin/jobs/{job_id}/cancel", headers=self.headers)
+        # A worker may already have claimed or finished the job
+        assert response.status_code in [200, 400], f"Unexpected status: {response.status_code}"
+        job = self.wait_for_job(job_id)
+        if job["status"] == "cancelled":
+            doc = requests.get(f"{BASE_URL}/api/admin/inventory/documents/{doc_id}", headers=self.headers).json()
+            assert doc["status"] == "draft", "Cancelled job still posted the document"
+        
+        again = requests.post(f"{BASE_URL}/api/admin/jobs/{job_id}/cancel", headers=self.headers)
+        assert again.status_code == 400
+        assert again.json()["detail"] == "Job already finished"
+        print(f"✓ Job ended {job['status']}; cancelling a finished job rejected")
+    
+    def test_unknown_job_not_found(self):
+        """Test that status and cancel return 404 for a job that does not exist"""
+        job_id = str(uuid.uuid4())
+        assert requests.get(f"{BASE_URL}/api/admin/jobs/{job_id}", headers=self.headers).status_code == 404
+        assert requests.post(f"{BASE_URL}/api/admin/jobs/{job_id}/cancel", headers=self.headers).status_code == 404
+        print("✓ Unknown job returns 404")
+    
+    def test_staff_only_sees_own_jobs(self):
+        """Test that staff can follow their own jobs but not see or cancel other users' jobs"""
+        admin_job = self.submit_post(self.create_receipt())
+        staff = self.staff_headers()
+        
+        assert requests.get(f"{BASE_URL}/api/admin/jobs/{admin_job}", headers=staff).status_code == 404
+        assert requests.post(f"{BASE_URL}/api/admin/jobs/{admin_job}/cancel", headers=staff).status_code == 404
+        listed = requests.get(f"{BASE_URL}/api/admin/jobs", params={"limit": 200}, headers=staff).json()
+        assert admin_job not in [j["id"] for j in listed]
+        
+        staff_job = self.submit_post(self.create_receipt(), headers=staff)
+        response = requests.get(f"{BASE_URL}/api/admin/jobs/{staff_job}", headers=staff)
+        assert response.status_code == 200
+        assert [j["id"] for j in requests.get(f"{BASE_URL}/api/admin/jobs", headers=staff).json()] == [staff_job]
+        
+        job = requests.get(f"{BASE_URL}/api/admin/jobs/{admin_job}", headers=self.headers).json()
+        assert job["status"] != "cancelled"
+        print("✓ Staff see only their own jobs")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
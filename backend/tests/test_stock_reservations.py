@@ -0,0 +1,172 @@
+"""
+Test Stock Reservations for OTNT ERP
+Tests: Reserve on confirm, Oversell rejection, Release on cancel, Consume on completion, Adjustment guard
+"""
+import pytest
+import requests
+import os
+import random
+import uuid
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
+
+# Test credentials
+TEST_EMAIL = "admin@otnt.vn"
+TEST_PASSWORD = "admin123"
+
+
+class TestStockReservations:
+    """Test that confirmed orders reserve stock and cancel/complete settle the reservation"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Setup - get auth token, a fresh product with 5 units in stock and a customer"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": TEST_EMAIL,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        
+        warehouses = requests.get(f"{BASE_URL}/api/admin/warehouses", headers=self.headers).json()
+        if not warehouses:
+            pytest.skip("No warehouses available")
+        self.warehouse_id = warehouses[0]["id"]
+        
+        suffix = uuid.uuid4().hex[:8]
+        product_response = requests.post(f"{BASE_URL}/api/admin/products", json={
+            "name": f"Test Reservation Product {suffix}",
+            "slug": f"test-reservation-{suffix}",
+            "sku": f"TEST-RSV-{suffix}",
+            "product_type": "accessory",
+            "price": 100000,
+            "cost_price": 50000
+        }, headers=self.headers)
+        assert product_response.status_code == 200, f"Failed to create product: {product_response.text}"
+        self.product_id = product_response.json()["id"]
+        
+        doc_response = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json={
+            "doc_type": "receipt",
+            "warehouse_id": self.warehouse_id,
+            "lines": [{"product_id": self.product_id, "quantity": 5, "unit_cost": 50000}]
+        }, headers=self.headers)
+        post_response = requests.post(
+            f"{BASE_URL}/api/admin/inventory/documents/{doc_response.json()['id']}/post",
+            headers=self.headers
+        )
+        assert post_response.status_code == 200, f"Failed to post receipt: {post_response.text}"
+        
+        customer_response = requests.post(f"{BASE_URL}/api/admin/customers", json={
+            "name": f"Test Reservation Customer {suffix}",
+            "phone": f"09{random.randint(0, 99999999):08d}"
+        }, headers=self.headers)
+        assert customer_response.status_code == 200, f"Failed to create customer: {customer_response.text}"
+        self.customer_id = customer_response.json()["id"]
+    
+    def create_order(self, quantity):
+        response = requests.post(f"{BASE_URL}/api/admin/sales/orders", json={
+            "customer_id": self.customer_id,
+            "warehouse_id": self.warehouse_id,
+            "lines": [{"product_id": self.product_id, "quantity": quantity, "unit_price": 100000}]
+        }, headers=self.headers)
+        assert response.status_code == 200, f"Failed to create order: {response.text}"
+        return response.json()["id"]
+    
+    def stock(self):
+        rows = requests.get(
+            f"{BASE_URL}/api/admin/inventory/stock",
+            params={"product_id": self.product_id, "warehouse_id": self.warehouse_id},
+            headers=self.headers
+        ).json()
+        assert len(rows) == 1
+        return rows[0]
+    
+    def reservations(self, order_id, status):
+        return requests.get(
+            f"{BASE_URL}/api/admin/inventory/reservations",
+            params={"order_id": order_id, "status": status},
+            headers=self.headers
+        ).json()
+    
+    def test_confirm_reserves_stock(self):
+        """Test that confirming an order reserves its quantity"""
+        order_id = self.create_order(2)
+        response = requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/confirm", headers=self.headers)
+        assert response.status_code == 200, f"Failed to confirm order: {response.text}"
+        assert response.json().get("reserved_until")
+        
+        row = self.stock()
+        assert row["quantity"] == 5
+        assert row["reserved"] == 2
+        assert row["available"] == 3
+        active = self.reservations(order_id, "active")
+        assert len(active) == 1 and active[0]["quantity"] == 2
+        print("✓ Confirmed order reserved 2 of 5 units")
+    
+    def test_confirm_beyond_available_rejected(self):
+        """Test that a second order cannot reserve stock already reserved by the first"""
+        # Both drafts are created while 5 units are free; only confirmation reserves
+        first = self.create_order(4)
+        second = self.create_order(2)
+        assert requests.post(f"{BASE_URL}/api/admin/sales/orders/{first}/confirm", headers=self.headers).status_code == 200
+        
+        response = requests.post(f"{BASE_URL}/api/admin/sales/orders/{second}/confirm", headers=self.headers)
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        assert self.stock()["reserved"] == 4
+        assert self.reservations(second, "active") == []
+        print("✓ Oversell on confirm rejected")
+    
+    def test_cancel_releases_reservation(self):
+        """Test that cancelling a confirmed order releases its reservation"""
+        order_id = self.create_order(2)
+        requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/confirm", headers=self.headers)
+        
+        response = requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/cancel", headers=self.headers)
+        assert response.status_code == 200, f"Failed to cancel order: {response.text}"
+        assert self.stock()["reserved"] == 0
+        assert self.reservations(order_id, "active") == []
+        assert len(self.reservations(order_id, "released")) == 1
+        
+        again = requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/cancel", headers=self.headers)
+        assert again.status_code == 400
+        print("✓ Cancel released the reservation")
+    
+    def test_complete_consumes_reservation(self):
+        """Test that completing a confirmed order consumes its reservation and cannot then be cancelled"""
+        order_id = self.create_order(2)
+        requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/confirm", headers=self.headers)
+        
+        response = requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/complete", headers=self.headers)
+        assert response.status_code == 200, f"Failed to complete order: {response.text}"
+        row = self.stock()
+        assert row["quantity"] == 3
+        assert row["reserved"] == 0
+        assert len(self.reservations(order_id, "consumed")) == 1
+        
+        cancel = requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/cancel", headers=self.headers)
+        assert cancel.status_code == 400
+        assert self.stock()["quantity"] == 3
+        print("✓ Completion consumed the reservation; cancel after completion rejected")
+    
+    def test_adjustment_below_reserved_rejected(self):
+        """Test that a stock adjustment cannot leave less on hand than is reserved"""
+        order_id = self.create_order(3)
+        requests.post(f"{BASE_URL}/api/admin/sales/orders/{order_id}/confirm", headers=self.headers)
+        
+        doc_response = requests.post(f"{BASE_URL}/api/admin/inventory/documents", json={
+            "doc_type": "adjustment",
+            "warehouse_id": self.warehouse_id,
+            "lines": [{"product_id": self.product_id, "quantity": 2, "unit_cost": 50000}]
+        }, headers=self.headers)
+        response = requests.post(
+            f"{BASE_URL}/api/admin/inventory/documents/{doc_response.json()['id']}/post",
+            headers=self.headers
+        )
+        assert response.status_code == 400, f"Expected 400, got {response.status_code}"
+        assert "reserved" in response.json()["detail"]
+        assert self.stock()["quantity"] == 5
+        print("✓ Adjustment below reserved quantity rejected")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
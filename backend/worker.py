@@ -0,0 +1,27 @@
+"""
+Run background jobs (async postings, order completion, snapshots, seeding) outside the web process.
+
+Set JOB_WORKERS=0 on the API servers when jobs should only run here, then:
+    cd /app/backend && python worker.py 2
+"""
+import asyncio
+import os
+import sys
+
+from server import job_worker, client
+
+
+async def main(concurrency: int):
+    prefix = f"{os.uname().nodename}-{os.getpid()}"
+    try:
+        await asyncio.gather(*(job_worker(f"{prefix}-{i}") for i in range(concurrency)))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    try:
+        asyncio.run(main(concurrency))
+    except KeyboardInterrupt:
+        pass
@@ -50,6 +50,7 @@ export default function ProductsPage() {
     name: '',
     slug: '',
     sku: '',
+    barcode: '',
     product_type: 'robot',
     category_id: '',
     brand_id: '',
@@ -60,6 +61,7 @@ export default function ProductsPage() {
     sale_price: null,
     warranty_months: 12,
     track_serial: false,
+    costing_method: 'average',
     images: [],
     specifications: {},
     compatible_models: [],
@@ -112,6 +114,7 @@ export default function ProductsPage() {
       name: '',
       slug: '',
       sku: '',
+      barcode: '',
       product_type: 'robot',
       category_id: '',
       brand_id: '',
@@ -122,6 +125,7 @@ export default function ProductsPage() {
       sale_price: null,
       warranty_months: 12,
       track_serial: false,
+      costing_method: 'average',
       images: [],
       specifications: {},
       compatible_models: [],
@@ -141,6 +145,7 @@ export default function ProductsPage() {
       name: product.name,
       slug: product.slug,
       sku: product.sku,
+      barcode: product.barcode || '',
       product_type: product.product_type,
       category_id: product.category_id || '',
       brand_id: product.brand_id || '',
@@ -151,6 +156,7 @@ export default function ProductsPage() {
       sale_price: product.sale_price,
       warranty_months: product.warranty_months,
       track_serial: product.track_serial,
+      costing_method: product.costing_method || 'average',
       images: product.images || [],
       specifications: product.specifications || {},
       compatible_models: product.compatible_models || [],
@@ -166,6 +172,8 @@ export default function ProductsPage() {
         ...formData,
         category_id: formData.category_id || null,
         brand_id: formData.brand_id || null,
+        // An empty barcode on edit clears the stored one; null would leave it unchanged
+        barcode: formData.barcode || (editingProduct ? '' : null),
       };
 
       if (editingProduct) {
@@ -279,6 +287,14 @@ export default function ProductsPage() {
                       required
                     />
                   </div>
+                  <div className="space-y-2">
+                    <Label>Mã vạch (EAN)</Label>
+                    <Input
+                      value={formData.barcode}
+                      onChange={(e) => setFormData({ ...formData, barcode: e.target.value.trim() })}
+                      placeholder="8931234567890"
+                    />
+                  </div>
                   <div className="space-y-2">
                     <Label>Loại sản phẩm *</Label>
                     <Select
@@ -368,6 +384,21 @@ export default function ProductsPage() {
                       onChange={(e) => setFormData({ ...formData, cost_price: parseFloat(e.target.value) || 0 })}
                     />
                   </div>
+                  <div className="col-span-2 space-y-2">
+                    <Label>Phương pháp tính giá vốn</Label>
+                    <Select
+                      value={formData.costing_method}
+                      onValueChange={(v) => setFormData({ ...formData, costing_method: v })}
+                    >
+                      <SelectTrigger>
+                        <SelectValue />
+                      </SelectTrigger>
+                      <SelectContent>
+                        <SelectItem value="average">Bình quân gia quyền</SelectItem>
+                        <SelectItem value="fifo">Nhập trước xuất trước (FIFO)</SelectItem>
+                      </SelectContent>
+                    </Select>
+                  </div>
                   <div className="col-span-2 flex items-center justify-between p-4 rounded-lg bg-muted/30">
                     <div>
                       <p className="font-medium">Tracking Serial/IMEI</p>
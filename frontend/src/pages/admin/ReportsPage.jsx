@@ -73,7 +73,8 @@ export default function ReportsPage() {
     try {
       setLoading(true);
       const params = selectedWarehouse !== 'all' ? { warehouse_id: selectedWarehouse } : {};
-      const response = await api.get('/admin/reports/inventory-valuation', { params });
+      // Totals come with the first page; further rows are loaded on demand
+      const response = await api.get('/admin/reports/inventory-valuation', { params: { ...params, limit: 500 } });
       setInventoryValuation(response.data);
     } catch (error) {
       toast.error('Không thể tải báo cáo tồn kho');
@@ -82,6 +83,22 @@ export default function ReportsPage() {
     }
   };
 
+  const fetchMoreInventoryValuation = async () => {
+    try {
+      const params = selectedWarehouse !== 'all' ? { warehouse_id: selectedWarehouse } : {};
+      const response = await api.get('/admin/reports/inventory-valuation', {
+        params: { ...params, limit: 500, cursor: inventoryValuation.next_cursor }
+      });
+      setInventoryValuation({
+        ...inventoryValuation,
+        items: inventoryValuation.items.concat(response.data.items),
+        next_cursor: response.data.next_cursor
+      });
+    } catch (error) {
+      toast.error('Không thể tải báo cáo tồn kho');
+    }
+  };
+
   const fetchProfitLoss = async () => {
     try {
       setLoading(true);
@@ -288,6 +305,13 @@ export default function ReportsPage() {
                       </TableBody>
                     </Table>
                   </div>
+                  {inventoryValuation.next_cursor && (
+                    <div className="text-center">
+                      <Button variant="outline" onClick={fetchMoreInventoryValuation}>
+                        Tải thêm ({inventoryValuation.items.length}/{inventoryValuation.item_count})
+                      </Button>
+                    </div>
+                  )}
                 </div>
               ) : null}
             </CardContent>
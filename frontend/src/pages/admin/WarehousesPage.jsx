@@ -26,6 +26,8 @@ export default function WarehousesPage() {
     code: '',
     address: '',
     phone: '',
+    latitude: '',
+    longitude: '',
     is_default: false,
   });
 
@@ -45,7 +47,7 @@ export default function WarehousesPage() {
   }, []);
 
   const resetForm = () => {
-    setFormData({ name: '', code: '', address: '', phone: '', is_default: false });
+    setFormData({ name: '', code: '', address: '', phone: '', latitude: '', longitude: '', is_default: false });
     setEditingWarehouse(null);
   };
 
@@ -61,6 +63,8 @@ export default function WarehousesPage() {
       code: warehouse.code,
       address: warehouse.address || '',
       phone: warehouse.phone || '',
+      latitude: warehouse.latitude ?? '',
+      longitude: warehouse.longitude ?? '',
       is_default: warehouse.is_default,
     });
     setDialogOpen(true);
@@ -68,12 +72,17 @@ export default function WarehousesPage() {
 
   const handleSubmit = async (e) => {
     e.preventDefault();
+    const payload = {
+      ...formData,
+      latitude: formData.latitude === '' ? null : parseFloat(formData.latitude),
+      longitude: formData.longitude === '' ? null : parseFloat(formData.longitude),
+    };
     try {
       if (editingWarehouse) {
-        await adminAPI.updateWarehouse(editingWarehouse.id, formData);
+        await adminAPI.updateWarehouse(editingWarehouse.id, payload);
         toast.success('Cập nhật kho thành công!');
       } else {
-        await adminAPI.createWarehouse(formData);
+        await adminAPI.createWarehouse(payload);
         toast.success('Thêm kho thành công!');
       }
       setDialogOpen(false);
@@ -230,6 +239,28 @@ export default function WarehousesPage() {
                 placeholder="024-1234-5678"
               />
             </div>
+            <div className="grid grid-cols-2 gap-4">
+              <div className="space-y-2">
+                <Label>Vĩ độ</Label>
+                <Input
+                  type="number"
+                  step="any"
+                  value={formData.latitude}
+                  onChange={(e) => setFormData({ ...formData, latitude: e.target.value })}
+                  placeholder="21.0285"
+                />
+              </div>
+              <div className="space-y-2">
+                <Label>Kinh độ</Label>
+                <Input
+                  type="number"
+                  step="any"
+                  value={formData.longitude}
+                  onChange={(e) => setFormData({ ...formData, longitude: e.target.value })}
+                  placeholder="105.8542"
+                />
+              </div>
+            </div>
             <div className="flex items-center justify-between p-4 rounded-lg bg-muted/30">
               <div>
                 <p className="font-medium">Kho mặc định</p>